@@ -0,0 +1,184 @@
+"""
+不调用大模型的内置代理
+
+在apis配置中把某个模型写成 {"agent": "random"} 或 {"agent": "rule"}，扮演它的玩家就由这里的代理在进程内回答，
+不发出任何网络请求，回答格式与大模型相同（编号放在[]中），游戏流程完全不变。可以用来：
+- 测试游戏引擎本身的吞吐量（上下文增长、get_players、game_over等），不受网络延迟影响
+- 用大量模拟对局估计不同角色配置下各阵营的基准胜率
+- 作为锦标赛中的基准对手
+
+代理的接口只有一个协程 reply(player, question, messages)，返回依次产出 ("reasoning"或"content", 文本) 的异步迭代器，
+question 为本次上帝的提问，messages 为发给大模型的完整对话。
+有内部状态的代理可以提供 state() 和 restore(state)，检查点会保存并恢复这些状态（见checkpoint.py）。
+"""
+import random
+import re
+
+
+async def single(text):
+    yield "content", text
+
+
+class RandomAgent:
+    def __init__(self, api = None, seed = None):
+        """
+        随机代理：所有选择都在存活的其他玩家中均匀随机
+
+        Args:
+            api (dict, optional): apis配置中的一项，可选 seed. Defaults to None.
+            seed (int, optional): 随机种子，由 Game.agent_seed 给出；不指定时使用api中的seed，
+                都没有时由全局random生成. Defaults to None.
+        """
+        api = api or {}
+        if seed is None:
+            seed = api["seed"] if "seed" in api else random.getrandbits(64)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+    async def reply(self, player, question, messages):
+        return single(self.answer(player, question))
+
+    def state(self):
+        """检查点中保存的状态：种子和随机数生成器的状态"""
+        version, internal, gauss = self.rng.getstate()
+        return {"seed": self.seed, "rng": [version, list(internal), gauss]}
+
+    def restore(self, state):
+        """从检查点恢复状态，与state()对应；没有rng时（按新种子分出的分支）保留新的种子和随机数"""
+        if "rng" in state:
+            self.seed = state["seed"]
+            version, internal, gauss = state["rng"]
+            self.rng.setstate((version, tuple(internal), gauss))
+
+    def answer(self, player, question):
+        """
+        根据上帝的提问给出回答
+
+        Args:
+            player (Player): 回答的玩家
+            question (str): 上帝的提问
+
+        Returns:
+            str: 回答
+        """
+        if "你今晚要查的玩家是" in question:
+            self.learn(player, question)
+            return "收到。"
+        if "救" in question and "不救" in question:
+            return self.save(player, question)
+        if "毒杀" in question:
+            target = self.poison(player)
+            return f"毒杀[{target}]" if target else "不毒杀[0]"
+        if "你今晚要查谁" in question:
+            return f"我要查询[{self.check(player)}]号玩家"
+        if "杀" in question:
+            return f"杀[{self.kill(player)}]"
+        if "请投票" in question:
+            return f"我投[{self.vote(player)}]"
+        if "请公开讨论" in question:
+            return self.discuss(player)
+        return f"[{self.pick(self.others(player))}]"
+
+    def others(self, player):
+        return [i for i in player.game.get_players("id") if i != player.id]
+
+    def pick(self, candidates):
+        return self.rng.choice(candidates) if candidates else 0
+
+    def learn(self, player, question):
+        pass
+
+    def save(self, player, question):
+        """女巫是否使用解药，提示中有“救请写[1]”时用[1]表示救"""
+        victim = player.game.kill_tonight[0] if player.game.kill_tonight else 0
+        if self.rng.random() < 0.5 or not victim:
+            return "不救[0]"
+        return "救[1]" if "救请写[1]" in question else f"救[{victim}]"
+
+    def poison(self, player):
+        return self.pick(self.others(player)) if self.rng.random() < 0.2 else 0
+
+    def check(self, player):
+        return self.pick(self.others(player))
+
+    def kill(self, player):
+        return self.pick(self.others(player))
+
+    def vote(self, player):
+        return self.pick(self.others(player))
+
+    def discuss(self, player):
+        return "我没有什么特别的信息。"
+
+
+class RuleAgent(RandomAgent):
+    def __init__(self, api = None, seed = None):
+        """
+        简单规则代理：
+        - 狼人只杀、只投好人，每晚狼人队友杀同一个目标（由代理的种子和当晚的阶段决定）
+        - 预言家查验没有查过的玩家，白天公布查到的狼人并投票给他
+        - 其他好人跟随最近一次自称预言家的玩家公布的狼人投票，没有时随机投票
+        - 女巫第一次有人被杀时一定救人，之后随机使用毒药
+        """
+        super().__init__(api, seed)
+        self.known = {}
+
+    def state(self):
+        return {**super().state(), "known": self.known}
+
+    def restore(self, state):
+        super().restore(state)
+        self.known = {int(k): v for k, v in state["known"].items()}
+
+    def alive_good(self, player):
+        return [i.id for i in player.game.get_players() if i.role != "werewolf" and i.id != player.id]
+
+    def learn(self, player, question):
+        found = re.search(r"玩家(\d+)（.*身份是(\w+)", question)
+        if found:
+            self.known[int(found.group(1))] = found.group(2)
+
+    def save(self, player, question):
+        victim = player.game.kill_tonight[0] if player.game.kill_tonight else 0
+        if not victim:
+            return "不救[0]"
+        return "救[1]" if "救请写[1]" in question else f"救[{victim}]"
+
+    def check(self, player):
+        unchecked = [i for i in self.others(player) if i not in self.known]
+        return self.pick(unchecked or self.others(player))
+
+    def kill(self, player):
+        # 狼人队友的种子相同（见 Game.agent_seed），同一晚使用相同的随机数，保证目标一致
+        targets = self.alive_good(player)
+        if not targets:
+            return self.pick(self.others(player))
+        return targets[random.Random(f"{self.seed}-{player.game.stage}").randrange(len(targets))]
+
+    def wolves_found(self, player):
+        alive = player.game.get_players("id")
+        return [i for i, role in self.known.items() if role == "werewolf" and i in alive]
+
+    def accused(self, player):
+        """今天自称预言家的玩家公布的狼人"""
+        target = 0
+        for i in player.game.chat_log(player.game.stage):
+            found = re.search(r"我是预言家，(\d+)号玩家是狼人", i.content) if i.source_id else None
+            if found and i.source_id != player.id:
+                target = int(found.group(1))
+        return target if target in self.others(player) else 0
+
+    def discuss(self, player):
+        if player.role == "seer" and self.wolves_found(player):
+            return f"我是预言家，{self.wolves_found(player)[0]}号玩家是狼人，请大家投他。"
+        return "我没有什么特别的信息。"
+
+    def vote(self, player):
+        if player.role == "werewolf":
+            return self.pick(self.alive_good(player))
+        if player.role == "seer" and self.wolves_found(player):
+            return self.wolves_found(player)[0]
+        return self.accused(player) or self.pick(self.others(player))
+
+
+AGENTS = {"random": RandomAgent, "rule": RuleAgent}
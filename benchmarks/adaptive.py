@@ -0,0 +1,98 @@
+"""
+自适应调度与均匀轮次对局的比较（模拟，不调用大模型）
+
+按已知的真实实力模拟对局结果，两种方式使用相同的停止条件（每对模型的实力差的置信区间不包含0，
+或达到局数上限），统计达到停止条件所需的总局数，以及已确定的模型对中高低判断正确的比例。
+- 均匀：每一轮所有（狼人方，好人方）组合各对局一次，每轮结束后检查
+- 自适应：每次按 AdaptiveScheduler 挑选一批（相当于同时进行的对局数）
+
+运行：python -m benchmarks.adaptive [--models 6] [--trials 5]
+"""
+import argparse
+import itertools
+import math
+
+import numpy as np
+
+from ratings import SCALE
+from tournament import AdaptiveScheduler, make_lineup, team_of
+from benchmarks.soak import players_info
+
+SIDE = 60
+
+
+def play(lineup, truth, rng):
+    """按真实实力模拟一局，返回与 tournament.run_game 格式相同的结果"""
+    diff = SIDE + truth[lineup["werewolf_model"]] - truth[lineup["good_model"]]
+    wolf_won = rng.random() < 1 / (1 + math.exp(-diff / SCALE))
+    return {
+        "key": lineup["key"], "seed": lineup["seed"], "error": None,
+        "werewolf_model": lineup["werewolf_model"], "good_model": lineup["good_model"],
+        "winner": "狼人" if wolf_won else "好人",
+        "players": [{"model": i["model"], "role": i["role"], "team": team_of(i["role"])}
+                    for seat, i in lineup["players_info"].items() if seat != "0"],
+    }
+
+
+def accuracy(scheduler, truth):
+    """已确定的模型对数量，以及其中高低判断正确的数量"""
+    decided = correct = 0
+    for i in scheduler.status():
+        if i["decided"] == "确定":
+            a, b = i["pair"]
+            decided += 1
+            correct += (i["diff"] > 0) == (truth[a] > truth[b])
+    return decided, correct
+
+
+def uniform(truth, rng, max_games):
+    models = list(truth)
+    scheduler = AdaptiveScheduler(models, players_info(), max_games=max_games)
+    games = 0
+    while not scheduler.done():
+        for wolf_model, good_model in itertools.permutations(models, 2):
+            scheduler.record(play(make_lineup(wolf_model, good_model, scheduler.players_info, games), truth, rng))
+            games += 1
+    return games, scheduler
+
+
+def adaptive(truth, rng, max_games, batch):
+    scheduler = AdaptiveScheduler(list(truth), players_info(), max_games=max_games)
+    games = 0
+    while True:
+        lineups = scheduler.next_lineups(batch)
+        if not lineups:
+            break
+        for lineup in lineups:
+            scheduler.record(play(lineup, truth, rng))
+        games += len(lineups)
+    return games, scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=int, default=6)
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--spread", type=float, default=150, help="真实实力的标准差（Elo分）")
+    parser.add_argument("--max-games", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=8, help="自适应模式每批同时进行的局数")
+    args = parser.parse_args()
+
+    pairs = args.models * (args.models - 1) // 2
+    print(f"{args.models}个模型，{pairs}对，每对最多{args.max_games}局")
+    print(f"{'trial':>5} {'uniform':>8} {'correct':>8} {'adaptive':>9} {'correct':>8} {'saving':>7}")
+    totals = np.zeros(2)
+    for trial in range(args.trials):
+        rng = np.random.default_rng(trial)
+        truth = {f"m{i}": v for i, v in enumerate(rng.normal(0, args.spread, args.models))}
+        row = []
+        for games, scheduler in (uniform(truth, rng, args.max_games), adaptive(truth, rng, args.max_games, args.batch)):
+            decided, correct = accuracy(scheduler, truth)
+            row += [games, f"{correct}/{decided}"]
+        totals += row[0], row[2]
+        print(f"{trial:>5} {row[0]:>8} {row[1]:>8} {row[2]:>9} {row[3]:>8} {row[0] / row[2]:>6.1f}x", flush=True)
+    print(f"总计：均匀{totals[0]:.0f}局，自适应{totals[1]:.0f}局，减少到{totals[1] / totals[0]:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+上下文查询开销的基准测试
+
+模拟一局不断变长的游戏记录（公共发言、狼人私聊、女巫/预言家私聊混合），
+在记录长度达到不同规模时测量单次"轮到某个玩家发言"的查询开销：
+
+- legacy：旧实现，每次遍历整局记录并检查 visible_ids
+- indexed_delta：按玩家索引 + 偏移量，只取上次之后新增的信息
+- chat_log：按阶段索引取当前阶段的聊天记录（webui 每次刷新调用两次）
+
+运行：python -m benchmarks.context_store
+"""
+import logging
+import re
+import time
+
+from main import Context
+
+
+class BenchGame:
+    """只包含 Context 需要的属性的游戏替身，不创建玩家和客户端"""
+    def __init__(self, name):
+        self.id = name
+        self.stage = 0
+        self.logger = logging.getLogger(f"bench-{name}")
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, value):
+        return self.id == value.id
+
+
+PLAYERS = list(range(1, 9))
+WOLVES = [1, 2, 8]
+MESSAGES_PER_STAGE = 40
+
+
+def add_message(game, n):
+    """按固定模式追加第n条信息"""
+    if n % MESSAGES_PER_STAGE == 0:
+        game.stage += 1
+    kind = n % 5
+    if kind == 0:
+        Context(game, 0, f"上帝广播{n}", PLAYERS)
+    elif kind in (1, 2):
+        Context(game, PLAYERS[n % 8], f"公开发言{n}", PLAYERS, reasoning=f"思考{n}")
+    elif kind == 3:
+        Context(game, WOLVES[n % 3], f"狼人私聊{n}", WOLVES)
+    else:
+        Context(game, 7, f"预言家私聊{n}", [7])
+
+
+def legacy_get_context(id, game):
+    pub_messages = []
+    for i in Context.get_store(game).items:
+        if id in i.visible_ids:
+            pub_messages.append(re.sub(r'<think>.*?</think>', '', i.log_text(), flags=re.DOTALL))
+    return pub_messages
+
+
+def legacy_get_chat_log(game, stage):
+    return [i for i in Context.get_store(game).items if i.stage == stage]
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main(sizes = (1000, 2500, 5000, 10000, 20000), repeat = 20):
+    game = BenchGame("context_store")
+    offsets = {i: 0 for i in PLAYERS}
+    n = 0
+    print(f"{'messages':>10} {'legacy(us)':>12} {'indexed_delta(us)':>18} {'legacy_log(us)':>15} {'chat_log(us)':>13}")
+    for size in sizes:
+        while n < size:
+            add_message(game, n)
+            n += 1
+        store = Context.get_store(game)
+
+        def indexed_turn():
+            # 一个玩家的一轮：取出上次之后新增的可见信息
+            for i in (3, 7):
+                Context.get_context(i, game, offsets[i])
+                offsets[i] = store.count_visible(i)
+            # 模拟这一轮产生的一条新发言
+            add_message(game, size)
+
+        legacy = timeit(lambda: (legacy_get_context(3, game), legacy_get_context(7, game)), repeat)
+        # 把已有记录标为已读，之后只测量新增部分
+        for i in PLAYERS:
+            offsets[i] = store.count_visible(i)
+        indexed = timeit(indexed_turn, repeat)
+        n += repeat
+        legacy_log = timeit(lambda: legacy_get_chat_log(game, game.stage), repeat)
+        chat_log = timeit(lambda: Context.get_chat_log(game, game.stage), repeat)
+        print(f"{size:>10} {legacy:>12.1f} {indexed:>18.1f} {legacy_log:>15.1f} {chat_log:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+基准测试用的进程内假客户端
+
+接口与 AsyncOpenAI 客户端的 chat.completions.create 一致，
+按固定随机种子返回带方括号数字的回复，并记录每次请求的 messages。
+"""
+import random
+from types import SimpleNamespace
+
+
+def make_chunk(content = None, reasoning = None):
+    delta = SimpleNamespace(content=content, reasoning_content=reasoning)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCompletions:
+    def __init__(self, seed = 0, reply_chars = 120, reasoning_chars = 0):
+        self.rng = random.Random(seed)
+        self.reply_chars = reply_chars
+        self.reasoning_chars = reasoning_chars
+        self.requests = []
+
+    async def create(self, model, messages, stream = False, **kwargs):
+        self.requests.append([dict(i) for i in messages])
+        if not stream:
+            message = SimpleNamespace(content="摘要：" + "某玩家发言" * (self.reply_chars // 10), reasoning_content=None)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+        chunks = []
+        if self.reasoning_chars:
+            chunks.append(make_chunk(reasoning="嗯" * self.reasoning_chars))
+        text = "我认为" + "这个玩家很可疑" * (self.reply_chars // 7)
+        chunks.append(make_chunk(content=text))
+        # 只看本轮上帝的提问（位于最后一条消息末尾），
+        # 女巫的救人/毒人问题一律回答[0]，其余问题随机选择一名玩家
+        question = messages[-1]["content"].rsplit("上帝：", 1)[-1]
+        target = 0 if "请写[0]" in question else self.rng.randint(1, 8)
+        chunks.append(make_chunk(content=f"[{target}]"))
+        return FakeStream(chunks)
+
+
+class FakeClient:
+    def __init__(self, **kwargs):
+        self.chat = SimpleNamespace(completions=FakeCompletions(**kwargs))
@@ -0,0 +1,77 @@
+"""
+分支（Game.fork）的开销，以及同时进行多个分支与逐个进行的耗时对比
+
+先用本地模拟服务器进行一局游戏到第--day天，然后：
+- 分别用 Game.fork（共享聊天记录）和 snapshot + 重建（从检查点恢复的方式，复制全部Context）各分出K个分支，
+  比较每个分支的创建耗时和新分配的内存
+- K个分支使用不同的种子，逐个进行与用 play_branches 同时进行，比较总耗时
+
+运行：python -m benchmarks.fork [--branches 4] [--day 3] [--ttft 0.05]
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+import tracemalloc
+
+from main import Game, auto_play, play_branches, registry
+from benchmarks.mock_server import MockConfig, MockServer
+from benchmarks.soak import INSTRUCTIONS, players_info
+
+
+def measure(make, count):
+    """创建count个分支，返回 (分支, 平均耗时秒, 平均新分配的字节数)"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    branches = [make(i) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    allocated = sum(i.size_diff for i in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+    return branches, elapsed / count, allocated / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--day", type=int, default=3, help="从第几天开始分出")
+    parser.add_argument("--ttft", type=float, default=0.05, help="模拟服务器首个token的延迟")
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp(prefix="werewolf-fork-"))
+
+    server = MockServer(config=MockConfig(ttft=args.ttft, tps=0))
+    apis = {"mock": {"api_key": "mock", "base_url": server.start(), "model_name": "mock"}}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        parent = Game("fork", players_info(), apis, INSTRUCTIONS, webui_mode=True, from_dict=True)
+        auto_play(parent, args.day - 1)
+        if parent.game_over():
+            print(f"第{args.day}天之前游戏已经结束，换一个更小的--day")
+            return
+        parent.resume_phase = "day_night_change"
+        print(f"第{args.day}天开始时：{len(parent.transcript())}条记录，{sum(len(i.messages) for i in parent.players)}条消息")
+
+        state = parent.snapshot("day_night_change")
+        copies, copy_time, copy_bytes = measure(
+            lambda i: Game(f"copy-{i}", parent.players_info, apis, INSTRUCTIONS, webui_mode=True, from_dict=True, restore=state), args.branches)
+        forks, fork_time, fork_bytes = measure(lambda i: parent.fork(f"fork-{i}", seed=i), args.branches)
+        print(f"{'':>8} {'ms/branch':>10} {'KiB/branch':>11}")
+        print(f"{'restore':>8} {copy_time * 1000:>10.2f} {copy_bytes / 1024:>11.1f}")
+        print(f"{'fork':>8} {fork_time * 1000:>10.2f} {fork_bytes / 1024:>11.1f}")
+        for i in copies:
+            registry.close(i)
+
+        start = time.perf_counter()
+        for i in range(args.branches):
+            auto_play(parent.fork(f"serial-{i}", seed=i), 20)
+        serial_time = time.perf_counter() - start
+        start = time.perf_counter()
+        winners = play_branches(forks, 20)
+        concurrent_time = time.perf_counter() - start
+    server.stop()
+    print(f"{args.branches}个分支逐个进行 {serial_time:.1f}s，同时进行 {concurrent_time:.1f}s（{serial_time / concurrent_time:.1f}倍）")
+    print("各分支的胜方：", winners)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+本地的 OpenAI 兼容模拟服务器，用于离线的压力测试和延迟测试
+
+实现流式和非流式的 /v1/chat/completions（包括 get_response 识别的 reasoning_content 增量）
+以及 /v1/models，另外 /stats 返回请求数、出错数和正在进行的流数量。只使用标准库，不需要联网。
+
+可以配置：
+- 首个token的延迟（--ttft，可加抖动 --ttft-jitter）和生成速度（--tps，每秒token数）
+- 思考过程的长度（--reasoning-tokens）和回复的长度（--reply-tokens）
+- 出错率（--error-rate，直接返回HTTP错误）和断流率（--drop-rate，输出一半后断开连接）
+- 回复内容：默认与 fake_llm 相同，女巫问题回答[0]，其余问题随机回答一名玩家的编号；
+  --reply 指定固定回复，--script 指定按正则匹配的回复规则（JSON列表，每项包含match和reply，可选model），
+  回复中的 {target} 会被替换为随机的玩家编号
+
+随机数由 --seed、请求内容（包括请求中的seed参数）以及这个请求是第几次出现共同决定：相同的请求总是得到相同的回复和相同的出错情况，
+与并发的先后顺序无关，而客户端重试同一个请求时会重新抽取，因此可以测试重试能否恢复。
+
+运行：python -m benchmarks.mock_server --port 8765 --ttft 0.5 --tps 50
+然后把apis配置中的base_url设为 http://127.0.0.1:8765/v1
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def estimate_tokens(text):
+    """
+    粗略估计文本的token数（与引擎中的估计方法相同）：中日韩字符按每个1个token计算，其余字符按每4个1个token计算
+    """
+    cjk = sum(1 for i in text if '\u2e80' <= i <= '\u9fff' or '\uff00' <= i <= '\uffef')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class MockConfig:
+    def __init__(self, ttft = 0.2, ttft_jitter = 0.0, tps = 50.0, reasoning_tokens = 0, reply_tokens = 60,
+                 error_rate = 0.0, error_status = 500, drop_rate = 0.0, players = 8, reply = None, script = (), seed = 0):
+        """
+        模拟服务器的行为配置
+
+        Args:
+            ttft (float, optional): 首个token的延迟（秒）. Defaults to 0.2.
+            ttft_jitter (float, optional): 首个token延迟的随机抖动幅度（秒）. Defaults to 0.0.
+            tps (float, optional): 每秒生成的token数，0表示不限速. Defaults to 50.0.
+            reasoning_tokens (int, optional): 每次回复的思考过程token数. Defaults to 0.
+            reply_tokens (int, optional): 每次回复在结论之前的token数. Defaults to 60.
+            error_rate (float, optional): 请求直接出错的概率. Defaults to 0.0.
+            error_status (int, optional): 出错时的HTTP状态码. Defaults to 500.
+            drop_rate (float, optional): 流式输出到一半时断开连接的概率. Defaults to 0.0.
+            players (int, optional): 随机回答的玩家编号范围. Defaults to 8.
+            reply (str, optional): 固定回复. Defaults to None.
+            script (list, optional): 回复规则，每项包含match（正则）、reply和可选的model. Defaults to ().
+            seed (int, optional): 随机种子. Defaults to 0.
+        """
+        self.ttft = ttft
+        self.ttft_jitter = ttft_jitter
+        self.tps = tps
+        self.reasoning_tokens = reasoning_tokens
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.players = players
+        self.reply = reply
+        self.script = [dict(i, pattern=re.compile(i["match"])) for i in script]
+        self.seed = seed
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def rng(self, body):
+        key = [self.seed, body.get("model"), body.get("messages")]
+        if "seed" in body:
+            # 请求中的seed（例如分支使用不同的种子）参与随机，不带seed的请求与之前相同
+            key.append(body["seed"])
+        digest = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode()).digest()
+        with self.lock:
+            repeat = self.seen[digest] = self.seen.get(digest, -1) + 1
+        return random.Random(digest + repeat.to_bytes(4, "big") if repeat else digest)
+
+    def answer(self, body, rng):
+        """
+        根据本轮上帝的提问（最后一条消息中最后一个“上帝：”之后的内容）决定回复
+        """
+        last = body["messages"][-1]["content"] if body.get("messages") else ""
+        question = last.rsplit("上帝：", 1)[-1]
+        target = rng.randint(1, self.players)
+        template = self.reply
+        if template is None:
+            for rule in self.script:
+                if rule.get("model") not in (None, body.get("model")):
+                    continue
+                if rule["pattern"].search(question):
+                    template = rule["reply"]
+                    break
+        if template is None:
+            template = "我认为" + "这个玩家很可疑" * max(self.reply_tokens // 7, 0) + ("[0]" if "请写[0]" in question else "[{target}]")
+        return template.replace("{target}", str(target))
+
+
+def split_tokens(text, size = 2):
+    """把文本切成近似token的小段（每段size个字符）"""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.drops = 0
+        self.active = 0
+        self.peak = 0
+        self.tokens = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "drops": self.drops,
+                    "active": self.active, "peak_active": self.peak, "completion_tokens": self.tokens}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockLLM/1.0"
+    # 响应头和正文（以及每个SSE片段）分成多次小块写出，开着Nagle算法时会与客户端的延迟确认互相等待，
+    # 每次请求平白多出约40毫秒，掩盖了引擎本身的开销
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        elif self.path.rstrip("/") == "/stats":
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        config, stats = self.server.config, self.server.stats
+        rng = config.rng(body)
+        with stats.lock:
+            stats.requests += 1
+            stats.active += 1
+            stats.peak = max(stats.peak, stats.active)
+        try:
+            if rng.random() < config.error_rate:
+                with stats.lock:
+                    stats.errors += 1
+                self.send_json(config.error_status, {"error": {"message": "mock error", "type": "server_error", "code": config.error_status}})
+                return
+            content = config.answer(body, rng)
+            reasoning = "嗯" * config.reasoning_tokens
+            time.sleep(max(config.ttft + rng.uniform(-config.ttft_jitter, config.ttft_jitter), 0))
+            if body.get("stream"):
+                self.stream(body, reasoning, content, rng)
+            else:
+                self.complete(body, reasoning, content)
+        except ConnectionError:
+            # 客户端超时或取消请求后断开了连接
+            self.close_connection = True
+        finally:
+            with stats.lock:
+                stats.active -= 1
+
+    def usage(self, body, completion):
+        prompt = sum(estimate_tokens(str(i.get("content", ""))) for i in body.get("messages", []))
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def complete(self, body, reasoning, content):
+        tokens = len(split_tokens(reasoning)) + len(split_tokens(content))
+        if self.server.config.tps:
+            time.sleep(tokens / self.server.config.tps)
+        with self.server.stats.lock:
+            self.server.stats.tokens += tokens
+        message = {"role": "assistant", "content": content}
+        if reasoning:
+            message["reasoning_content"] = reasoning
+        self.send_json(200, {
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": self.usage(body, tokens),
+        })
+
+    def stream(self, body, reasoning, content, rng):
+        config = self.server.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [("reasoning_content", i) for i in split_tokens(reasoning)] + [("content", i) for i in split_tokens(content)]
+        drop_at = len(pieces) // 2 if rng.random() < config.drop_rate else None
+        created = int(time.time())
+        for n, (field, text) in enumerate(pieces):
+            if n == drop_at:
+                with self.server.stats.lock:
+                    self.server.stats.drops += 1
+                # 不发送结束块，直接断开连接
+                self.close_connection = True
+                return
+            if n and config.tps:
+                time.sleep(1 / config.tps)
+            self.send_event({"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": body.get("model", "mock"),
+                             "choices": [{"index": 0, "delta": {field: text}, "finish_reason": None}]})
+        with self.server.stats.lock:
+            self.server.stats.tokens += len(pieces)
+        self.send_event({"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": body.get("model", "mock"),
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.send_event({"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": body.get("model", "mock"),
+                             "choices": [], "usage": self.usage(body, len(pieces))})
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def send_event(self, obj):
+        self.send_chunk(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode())
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, host = "127.0.0.1", port = 0, config = None):
+        """
+        模拟服务器，port为0时自动选择空闲端口
+
+        Args:
+            host (str, optional): 监听地址. Defaults to "127.0.0.1".
+            port (int, optional): 端口. Defaults to 0.
+            config (MockConfig, optional): 行为配置. Defaults to None.
+        """
+        super().__init__((host, port), MockHandler)
+        self.config = config or MockConfig()
+        self.stats = Stats()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """
+        在后台线程中运行
+
+        Returns:
+            str: 服务器的base_url（不是服务器对象），可以直接写入apis配置，停止时仍然调用服务器的stop
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name="mock-llm", daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI兼容的本地模拟服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.2, help="首个token的延迟（秒）")
+    parser.add_argument("--ttft-jitter", type=float, default=0.0)
+    parser.add_argument("--tps", type=float, default=50.0, help="每秒生成的token数，0表示不限速")
+    parser.add_argument("--reasoning-tokens", type=int, default=0)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--reply", default=None, help="固定回复，例如 \"我投[3]\"")
+    parser.add_argument("--script", default=None, help="回复规则的JSON文件")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    script = ()
+    if args.script:
+        with open(args.script, encoding="UTF-8") as f:
+            script = json.load(f)
+    config = MockConfig(args.ttft, args.ttft_jitter, args.tps, args.reasoning_tokens, args.reply_tokens, args.error_rate,
+                        args.error_status, args.drop_rate, args.players, args.reply, script, args.seed)
+    server = MockServer(args.host, args.port, config)
+    print(f"模拟服务器已启动：{server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+全量上下文与增量上下文两种模式下，每局游戏发送的prompt token总量对比
+
+用进程内假客户端跑完整局游戏（相同随机种子，两种模式下对局过程相同），
+统计每次请求的输入token估计值、同一玩家相邻两次请求之间可复用的前缀占比
+（服务端前缀缓存能够命中的部分），以及不能命中缓存、需要重新预填充的token数。
+
+运行：python -m benchmarks.prompt_tokens [--seeds 5]
+"""
+import argparse
+import json
+import os
+import tempfile
+
+from main import Game, estimate_tokens, registry
+from tournament import play
+from benchmarks.fake_llm import FakeClient
+from benchmarks.soak import APIS, INSTRUCTIONS, players_info
+
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def measure(incremental, seed):
+    game = Game(f"prompt-{seed}", players_info(), APIS, INSTRUCTIONS, webui_mode=True, from_dict=True, incremental_context=incremental)
+    total = reused = requests = 0
+    for i in game.players:
+        i.client = FakeClient(seed=seed * 100 + i.id)
+    play(game)
+    for i in game.players:
+        previous = ""
+        for messages in i.client.chat.completions.requests:
+            text = json.dumps(messages, ensure_ascii=False)
+            total += estimate_tokens(text)
+            reused += estimate_tokens(text[:common_prefix(previous, text)])
+            previous = text
+            requests += 1
+    registry.close(game)
+    return total, reused, requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", type=int, default=5)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp(prefix="werewolf-prompt-"))
+
+    print(f"{'mode':>12} {'seed':>5} {'requests':>9} {'prompt_tokens':>14} {'prefix_reused':>14} {'uncached_tokens':>16}")
+    for incremental in (False, True):
+        for seed in range(args.seeds):
+            total, reused, requests = measure(incremental, seed)
+            mode = "incremental" if incremental else "full"
+            print(f"{mode:>12} {seed:>5} {requests:>9} {total:>14} {reused / total:>13.1%} {total - reused:>16}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+评分引擎的速度与准确性
+
+按已知的真实实力模拟大量对局（每个座位随机分配模型，狼人阵营带有固定优势），
+统计全量计算、增量更新各自的耗时，以及估计值与真实实力的偏差和95%置信区间的覆盖率。
+
+运行：python -m benchmarks.ratings [--games 100000] [--models 8]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ratings import SCALE, RatingTable, model_key
+from benchmarks.soak import ROLES
+
+
+def simulate(truth, games, rng, side = 60):
+    """
+    Args:
+        truth (np.ndarray): 每个模型的真实实力（Elo分，均值为0）
+        games (int): 局数
+        side (float, optional): 狼人阵营优势（Elo分）. Defaults to 60.
+
+    Returns:
+        list: 与 tournament.run_game 格式相同的结果
+    """
+    wolves = np.array([i == "werewolf" for i in ROLES])
+    seats = rng.integers(0, len(truth), size=(games, len(ROLES)))
+    diff = truth[seats][:, wolves].mean(axis=1) - truth[seats][:, ~wolves].mean(axis=1)
+    wolf_won = rng.random(games) < 1 / (1 + np.exp(-(side + diff) / SCALE))
+    return [
+        {"winner": "狼人" if won else "好人",
+         "players": [{"model": f"m{m}", "role": role, "team": "狼人" if role == "werewolf" else "好人"} for m, role in zip(row, ROLES)]}
+        for row, won in zip(seats.tolist(), wolf_won.tolist())
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--models", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=1000, help="增量更新每批的局数")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    truth = rng.normal(0, 150, args.models)
+    truth -= truth.mean()
+    results = simulate(truth, args.games + args.batch, rng)
+
+    table = RatingTable(model_key)
+    start = time.perf_counter()
+    table.add(results[:args.games])
+    added = time.perf_counter()
+    iterations = table.fit()
+    fitted = time.perf_counter()
+    print(f"全量：{args.games}局，{len(table.rows)}种阵容，累加{added - start:.2f}秒，求解{fitted - added:.2f}秒（{iterations}次迭代）")
+
+    start = time.perf_counter()
+    table.add(results[args.games:])
+    iterations = table.fit()
+    print(f"增量：{args.batch}局，{(time.perf_counter() - start) * 1000:.0f}毫秒（{iterations}次迭代）")
+
+    board = {i["name"]: i for i in table.leaderboard()}
+    estimate = np.array([board[f"m{i}"]["rating"] for i in range(args.models)])
+    shift = estimate.mean() - truth.mean()
+    low = np.array([board[f"m{i}"]["low"] for i in range(args.models)]) - shift
+    high = np.array([board[f"m{i}"]["high"] for i in range(args.models)]) - shift
+    error = np.abs(estimate - shift - truth)
+    covered = np.mean((low <= truth) & (truth <= high))
+    print(f"平均误差{error.mean():.1f}分，最大误差{error.max():.1f}分，置信区间半宽{np.mean(high - low) / 2:.1f}分，覆盖率{covered:.0%}")
+    print(f"阵营优势估计：{table.side_advantage()[0]:+.1f}（真实值+60）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+游戏生命周期的浸泡测试
+
+在同一个进程中连续模拟很多局游戏（不调用大模型，只产生上下文并随机淘汰玩家），
+每隔一段时间记录进程的常驻内存（RSS）和打开的文件描述符数量。
+游戏结束后交给 registry.finish 处理时，两者应当保持平稳；
+加上 --no-close 可以看到不释放资源时的增长情况。
+
+运行：python -m benchmarks.soak [--games 1000] [--no-close]
+"""
+import argparse
+import gc
+import os
+import random
+import tempfile
+
+from main import Context, Game, registry
+
+ROLES = ["werewolf", "werewolf", "villager", "villager", "villager", "witch", "seer", "werewolf"]
+APIS = {"mock": {"api_key": "sk-soak", "base_url": "http://127.0.0.1:9/v1", "model_name": "mock"}}
+INSTRUCTIONS = {"general": "", "werewolf": "", "villager": "", "witch": "", "seer": ""}
+
+
+def players_info():
+    info = {"0": "这是一局有8名玩家的狼人杀游戏"}
+    for i, role in enumerate(ROLES, 1):
+        info[str(i)] = {"role": role, "model": "mock"}
+    return info
+
+
+def rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def fd_count():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def simulate(game, rng):
+    """随机推进一局游戏直到结束，每个阶段每个存活玩家发言一次"""
+    while not game.game_over():
+        game.day_night_change()
+        for i in game.get_players():
+            Context(game, i.id, "这是一段模拟的发言。" * 20, game.get_players("id", alive=False))
+        game.out([rng.choice(game.get_players("id"))])
+    game.get_winner()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--every", type=int, default=100)
+    parser.add_argument("--no-close", action="store_true", help="不释放结束的游戏，用于对比")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="werewolf-soak-"))
+    rng = random.Random(0)
+    kept = []
+    print(f"{'games':>6} {'rss(MB)':>9} {'fds':>6} {'stores':>7} {'registry':>9}", flush=True)
+    for n in range(1, args.games + 1):
+        game = Game(f"soak{n}", players_info(), APIS, INSTRUCTIONS, from_dict=True)
+        simulate(game, rng)
+        if args.no_close:
+            kept.append(game)
+        else:
+            registry.finish(game)
+        del game
+        if n % args.every == 0:
+            gc.collect()
+            print(f"{n:>6} {rss_kb() / 1024:>9.1f} {fd_count():>6} {len(Context.contexts):>7} {len(registry):>9}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+游戏引擎的基准测试套件
+
+微基准（每次操作的耗时）：
+- context.stream：一次流式发言（创建流式Context、追加50个片段、finish）
+- context.init：创建一条普通Context
+- context.get_context@N：记录长度为N时，一名玩家取全部可见信息
+- game.get_players / game.get_players_role / game.game_over：8人局中的查询
+- extract_numbers：从一段发言中提取方括号中的编号
+
+宏基准（每局耗时，同时给出每分钟局数）：
+- games.rule_agents：规则代理在进程内完成整局，只测引擎本身
+- games.mock_server：通过本地模拟服务器（无延迟）完成整局，包括客户端和HTTP的开销
+
+结果保存为JSON，compare命令比较两次结果，耗时增加超过阈值时返回非零退出码，
+可以在提交之间发现性能退化。
+
+运行：python -m benchmarks.suite run [--quick] [--out results.json]
+     python -m benchmarks.suite compare old.json new.json [--threshold 0.1]
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from main import Context, Game, extract_numbers_from_brackets, registry
+from tournament import play
+from benchmarks.context_store import BenchGame, add_message
+from benchmarks.mock_server import MockConfig, MockServer
+from benchmarks.soak import INSTRUCTIONS, players_info
+
+AGENT_APIS = {"mock": {"agent": "rule", "seed": 0}}
+
+
+def measure(func, number, repeat):
+    """
+    运行 repeat 组，每组调用 func number 次
+
+    Returns:
+        dict: 每次操作耗时（秒）的中位数、最小值和最大值
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return {"seconds": statistics.median(samples), "min": min(samples), "max": max(samples), "number": number, "repeat": repeat}
+
+
+def new_game(name, apis = AGENT_APIS):
+    return Game(name, players_info(), apis, INSTRUCTIONS, webui_mode=True, from_dict=True)
+
+
+def bench_context_stream(scale):
+    game = BenchGame("suite-stream")
+    chunks = ["片段"] * 50
+
+    def once():
+        stream = Context(game, 1, "", [1, 2, 3], is_streaming=True)
+        for i in chunks:
+            stream.append(i)
+        stream.finish()
+    result = measure(once, 200 * scale, 5)
+    Context.release(game)
+    return result
+
+
+def bench_context_init(scale):
+    game = BenchGame("suite-init")
+    result = measure(lambda: Context(game, 1, "这是一段发言", [1, 2, 3]), 2000 * scale, 5)
+    Context.release(game)
+    return result
+
+
+def bench_get_context(length, scale):
+    game = BenchGame(f"suite-get-{length}")
+    for n in range(length):
+        add_message(game, n)
+    result = measure(lambda: Context.get_context(3, game), max(2000 * scale // length, 5), 5)
+    Context.release(game)
+    return result
+
+
+def bench_game_queries(scale):
+    game = new_game("suite-queries")
+    results = {
+        "game.get_players": measure(lambda: game.get_players(), 5000 * scale, 5),
+        "game.get_players_role": measure(lambda: game.get_players("id", role="werewolf"), 5000 * scale, 5),
+        "game.game_over": measure(game.game_over, 5000 * scale, 5),
+    }
+    registry.finish(game)
+    return results
+
+
+def bench_extract_numbers(scale):
+    text = "我认为3号玩家的发言很可疑，他昨天说自己是预言家，但是没有给出查验结果。所以我投[3]，理由如上。"
+    return measure(lambda: extract_numbers_from_brackets(text), 5000 * scale, 5)
+
+
+def bench_games(apis, games):
+    """依次完成games局，返回每局耗时"""
+    samples = []
+    for n in range(games):
+        game = new_game(f"suite-game-{n}", apis)
+        start = time.perf_counter()
+        play(game)
+        samples.append(time.perf_counter() - start)
+        registry.finish(game)
+    return {"seconds": statistics.median(samples), "min": min(samples), "max": max(samples), "number": 1, "repeat": games,
+            "games_per_minute": 60 / statistics.median(samples)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(quick = False):
+    """
+    运行全部基准测试
+
+    Args:
+        quick (bool, optional): 减少次数，用于快速检查. Defaults to False.
+
+    Returns:
+        dict: 包含meta和results的结果
+    """
+    scale = 1 if quick else 5
+    results = {}
+
+    def record(name, result):
+        results[name] = result
+        extra = f"，{result['games_per_minute']:.1f}局/分钟" if "games_per_minute" in result else ""
+        print(f"{name:<28}{result['seconds'] * 1e6:>14.2f} µs{extra}", flush=True)
+
+    record("context.stream", bench_context_stream(scale))
+    record("context.init", bench_context_init(scale))
+    for length in (100, 1000, 10000):
+        record(f"context.get_context@{length}", bench_get_context(length, scale))
+    for name, result in bench_game_queries(scale).items():
+        record(name, result)
+    record("extract_numbers", bench_extract_numbers(scale))
+
+    record("games.rule_agents", bench_games(AGENT_APIS, 20 if quick else 100))
+    server = MockServer(config=MockConfig(ttft=0, tps=0, reply_tokens=30))
+    base_url = server.start()
+    try:
+        apis = {"mock": {"api_key": "sk-suite", "base_url": base_url, "model_name": "mock"}}
+        record("games.mock_server", bench_games(apis, 2 if quick else 5))
+    finally:
+        server.stop()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, threshold = 0.1):
+    """
+    比较两次结果，打印每项的变化
+
+    Args:
+        old (dict): 旧结果
+        new (dict): 新结果
+        threshold (float, optional): 耗时增加超过这个比例视为退化. Defaults to 0.1.
+
+    Returns:
+        list: 退化的基准名称
+    """
+    regressions = []
+    print(f"{'benchmark':<28}{'old (µs)':>14}{'new (µs)':>14}{'change':>9}")
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        if name not in old["results"] or name not in new["results"]:
+            print(f"{name:<28}{'仅存在于' + ('新结果' if name in new['results'] else '旧结果'):>37}")
+            continue
+        a, b = old["results"][name]["seconds"], new["results"][name]["seconds"]
+        change = b / a - 1
+        mark = ""
+        if change > threshold:
+            mark = "  退化"
+            regressions.append(name)
+        elif change < -threshold:
+            mark = "  提升"
+        print(f"{name:<28}{a * 1e6:>14.2f}{b * 1e6:>14.2f}{change:>+9.1%}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="游戏引擎基准测试")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="运行基准测试并保存结果")
+    run_parser.add_argument("--quick", action="store_true")
+    run_parser.add_argument("--out", default=None, help="结果文件，默认为 benchmarks/results/<commit>.json")
+    compare_parser = commands.add_parser("compare", help="比较两次结果")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old, encoding="UTF-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="UTF-8") as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    out = os.path.abspath(args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{git_commit() or 'local'}.json"))
+    os.chdir(tempfile.mkdtemp(prefix="werewolf-bench-"))
+    # 游戏的控制台日志输出到创建时的sys.stderr，测试期间直接丢弃
+    with contextlib.redirect_stderr(open(os.devnull, "w")):
+        result = run(args.quick)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="UTF-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""
+大模型请求的录制与回放（cassette）
+
+录制模式下，玩家的每一次请求都照常发给大模型，同时把请求的摘要和流式返回的每个片段
+（相对请求开始的时间、思考过程还是发言、文本）记录下来；回放模式下不再联网，
+按记录把同样的片段交给 get_response，可以全速回放，也可以按原来的时间间隔回放。
+
+请求按（玩家编号，该玩家的第几次请求）对应，与多个玩家同时请求时的先后顺序无关。
+多个玩家同时发言时，发言按完成的先后进入聊天记录，所以每次请求还记录了完成的次序，
+回放时按同样的次序结束各个请求。游戏的进程只由大模型的回复和这个次序决定，
+所以回放会完整重现录制时的对局，可以用于性能分析和回归测试。
+
+文件为JSON Lines，以.gz结尾时用gzip压缩。第一行记录游戏配置（不含api_key和base_url，包括对冲的备用配置），之后每行一次请求。
+
+录制：Game(..., cassette=Cassette.record("game.jsonl.gz"))，或 tournament.py --record
+回放：python cassette.py game.jsonl.gz [--speed 1]
+"""
+import argparse
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from llm_client import strip_secrets
+
+VERSION = 1
+
+
+class CassetteError(RuntimeError):
+    """回放时找不到对应的记录，或请求与记录不一致（strict模式）"""
+
+
+class ReplayedError(RuntimeError):
+    """录制时这次请求出错，回放时原样抛出"""
+    # 录制时出错之后紧接着的是重试的那次请求，回放时同样重试才能对上
+    retryable = True
+
+
+def open_file(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="UTF-8")
+    return open(path, mode, encoding="UTF-8")
+
+
+def digest(messages):
+    """请求内容的摘要，用于回放时检查请求是否与录制时一致"""
+    return hashlib.sha1(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def make_chunk(kind, text):
+    delta = SimpleNamespace(content=text if kind == "c" else None, reasoning_content=text if kind == "r" else None)
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)], usage=None)
+
+
+class Cassette:
+    def __init__(self, path, mode, speed = None, strict = False, order_timeout = 2.0):
+        """
+        一局游戏的录制文件，请使用 Cassette.record 或 Cassette.replay 创建
+
+        Args:
+            path (str): 文件路径
+            mode (str): "record"或"replay"
+            speed (float, optional): 回放速度，1为原速，None为不等待. Defaults to None.
+            strict (bool, optional): 回放时请求与记录不一致就报错，否则只记录在mismatches中. Defaults to False.
+            order_timeout (float, optional): 回放时等待先完成的请求的最长时间（秒），
+                对局与录制时不一致、先完成的请求不会再出现时，超时后不再等待. Defaults to 2.0.
+
+        Attributes:
+            header (dict): 游戏配置
+            entries (dict): (玩家编号, 请求序号) -> 记录，仅回放模式
+            turns (dict): 玩家编号 -> 已经发出的请求数
+            mismatches (list): 请求内容与记录不一致的 (玩家编号, 请求序号)
+        """
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.strict = strict
+        self.header = None
+        self.entries = {}
+        self.turns = {}
+        self.mismatches = []
+        self.order_timeout = order_timeout
+        self.completed = 0
+        self.waiting = {}
+        self.file = None
+        if mode == "replay":
+            self.load()
+
+    @classmethod
+    def record(cls, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        return cls(path, "record")
+
+    @classmethod
+    def replay(cls, path, speed = None, strict = False):
+        return cls(path, "replay", speed, strict)
+
+    def load(self):
+        with open_file(self.path, "r") as f:
+            try:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if self.header is None:
+                        self.header = record
+                    else:
+                        self.entries[(record["player"], record["turn"])] = record
+            except (EOFError, json.JSONDecodeError):
+                # 录制中断时文件末尾可能不完整，保留已经读到的记录
+                pass
+        if not self.header or self.header.get("cassette") != VERSION:
+            raise CassetteError(f"{self.path}不是录制文件")
+
+    def start(self, game):
+        """
+        由 Game 在创建玩家之前调用，录制模式下写入游戏配置
+        """
+        if self.mode != "record":
+            return
+        self.header = {
+            "cassette": VERSION,
+            "game_name": game.game_name,
+            "players_info": game.players_info,
+            "instructions": game.instructions,
+            "models": {k: strip_secrets(v, ("api_key", "base_url")) for k, v in game.apis.items()},
+            "options": {
+                "incremental_context": game.incremental_context,
+                "concurrent_werewolves": game.concurrent_werewolves,
+                "werewolf_rounds": game.werewolf_rounds,
+                "sealed_votes": game.sealed_votes,
+            },
+        }
+        self.file = open_file(self.path, "w")
+        self.write(self.header)
+
+    def write(self, record):
+        if "player" in record:
+            record["order"] = self.completed
+            self.completed += 1
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    async def wait_turn(self, record):
+        """
+        回放时等待录制时比这次请求先完成的请求全部完成
+        """
+        order = record.get("order")
+        if order is None:
+            return
+        if self.completed < order:
+            event = self.waiting.setdefault(order, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), self.order_timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.completed = max(self.completed, order + 1)
+        for i in [i for i in self.waiting if i <= self.completed]:
+            self.waiting.pop(i).set()
+
+    def next_turn(self, player_id):
+        turn = self.turns.get(player_id, 0)
+        self.turns[player_id] = turn + 1
+        return turn
+
+    def client(self, client, player_id):
+        """
+        包装玩家使用的客户端
+
+        Args:
+            client: AsyncOpenAI客户端（回放模式下不会被调用）
+            player_id (int): 玩家编号
+
+        Returns:
+            CassetteClient: 接口与 client.chat.completions.create 一致
+        """
+        return CassetteClient(self, client, player_id)
+
+    def unused(self):
+        """
+        Returns:
+            int: 回放模式下还没有被请求过的记录数
+        """
+        return sum(1 for player, turn in self.entries if turn >= self.turns.get(player, 0))
+
+
+class CassetteClient:
+    def __init__(self, cassette, client, player_id):
+        self.cassette = cassette
+        self.inner = client
+        self.player_id = player_id
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream = False, **kwargs):
+        turn = self.cassette.next_turn(self.player_id)
+        entry = {"player": self.player_id, "turn": turn, "model": model, "digest": digest(messages), "stream": stream}
+        if self.cassette.mode == "replay":
+            return await self.replay(entry)
+        start = time.perf_counter()
+        try:
+            response = await self.inner.chat.completions.create(model=model, messages=messages, stream=stream, **kwargs)
+        except BaseException as e:
+            self.cassette.write({**entry, "error": f"{type(e).__name__}: {e}"})
+            raise
+        if not stream:
+            message = response.choices[0].message
+            self.cassette.write({**entry, "content": message.content, "reasoning": getattr(message, "reasoning_content", None),
+                                 "elapsed": round(time.perf_counter() - start, 4)})
+            return response
+        return RecordingStream(self.cassette, entry, response, start)
+
+    async def replay(self, entry):
+        cassette = self.cassette
+        key = (entry["player"], entry["turn"])
+        record = cassette.entries.get(key)
+        if record is None:
+            raise CassetteError(f"录制文件中没有{key[0]}号玩家的第{key[1] + 1}次请求")
+        if record["digest"] != entry["digest"]:
+            if cassette.strict:
+                raise CassetteError(f"{key[0]}号玩家的第{key[1] + 1}次请求与录制时不一致")
+            cassette.mismatches.append(key)
+        if "error" in record:
+            await cassette.wait_turn(record)
+            raise ReplayedError(record["error"])
+        if not entry["stream"]:
+            if cassette.speed:
+                await asyncio.sleep(record.get("elapsed", 0) / cassette.speed)
+            await cassette.wait_turn(record)
+            message = SimpleNamespace(role="assistant", content=record["content"], reasoning_content=record.get("reasoning"))
+            return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")], usage=None)
+        return ReplayStream(cassette, record)
+
+
+class RecordingStream:
+    def __init__(self, cassette, entry, response, start):
+        """
+        原样转发流式回复，同时记录每个片段，流结束时写入录制文件
+        """
+        self.cassette = cassette
+        self.entry = entry
+        self.source = response
+        self.response = response.__aiter__()
+        self.start = start
+        self.chunks = []
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.response.__anext__()
+        except StopAsyncIteration:
+            self.finish()
+            raise
+        except BaseException as e:
+            self.finish(f"{type(e).__name__}: {e}")
+            raise
+        if chunk.choices:
+            delta = chunk.choices[0].delta
+            offset = round(time.perf_counter() - self.start, 4)
+            reasoning = getattr(delta, "reasoning_content", None)
+            if reasoning:
+                self.chunks.append([offset, "r", reasoning])
+            if delta.content:
+                self.chunks.append([offset, "c", delta.content])
+        return chunk
+
+    async def close(self):
+        """
+        不再读取（例如超时后放弃）：已经收到的片段记为中断，并关闭底层的流
+        """
+        self.finish("StreamClosed: 读取被中断")
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            await close()
+
+    def finish(self, error = None):
+        if self.done:
+            return
+        self.done = True
+        record = {**self.entry, "chunks": self.chunks, "elapsed": round(time.perf_counter() - self.start, 4)}
+        if error:
+            # 流中途出错：回放时先给出已经收到的片段，再抛出错误
+            record["interrupted"] = error
+        self.cassette.write(record)
+
+
+class ReplayStream:
+    def __init__(self, cassette, record):
+        self.cassette = cassette
+        self.record = record
+        self.chunks = iter(record["chunks"])
+        self.start = time.perf_counter()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            offset, kind, text = next(self.chunks)
+        except StopIteration:
+            await self.cassette.wait_turn(self.record)
+            if self.record.get("interrupted"):
+                raise ReplayedError(self.record["interrupted"])
+            raise StopAsyncIteration
+        if self.cassette.speed:
+            delay = offset / self.cassette.speed - (time.perf_counter() - self.start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return make_chunk(kind, text)
+
+
+def replay_game(path, speed = None, strict = False, max_days = 20, webui_mode = True):
+    """
+    按录制文件重新进行一局游戏
+
+    Args:
+        path (str): 录制文件
+        speed (float, optional): 回放速度，1为原速，None为全速. Defaults to None.
+        strict (bool, optional): 请求与记录不一致时报错. Defaults to False.
+        max_days (int, optional): 天数上限. Defaults to 20.
+        webui_mode (bool, optional): 为True时不在控制台打印发言. Defaults to True.
+
+    Returns:
+        tuple: (游戏, 录制文件)
+    """
+    from main import Game
+    from tournament import play
+
+    cassette = Cassette.replay(path, speed, strict)
+    header = cassette.header
+    apis = {k: v if v.get("agent") else {**v, "api_key": "replay", "base_url": "http://127.0.0.1:9/v1"} for k, v in header["models"].items()}
+    game = Game(f"replay-{header['game_name']}", header["players_info"], apis, header["instructions"],
+                webui_mode=webui_mode, from_dict=True, cassette=cassette, **header["options"])
+    play(game, max_days)
+    return game, cassette
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的对局")
+    parser.add_argument("path", help="录制文件")
+    parser.add_argument("--speed", type=float, default=None, help="回放速度，1为原速，不指定时全速回放")
+    parser.add_argument("--strict", action="store_true", help="请求与录制时不一致就停止")
+    parser.add_argument("--max-days", type=int, default=20)
+    parser.add_argument("--verbose", action="store_true", help="在控制台打印发言")
+    args = parser.parse_args()
+
+    from main import registry
+
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(sys.stderr if args.verbose else open(os.devnull, "w")):
+        # 游戏的控制台日志输出到创建时的sys.stderr，不需要时直接丢弃
+        game, cassette = replay_game(args.path, args.speed, args.strict, args.max_days, not args.verbose)
+    print(f"回放结束：{game.winner() or '未分胜负'}，共{game.get_game_stage()[0]}天，用时{time.perf_counter() - start:.2f}秒，"
+          f"回放{sum(cassette.turns.values())}次请求，{len(cassette.mismatches)}次与录制时不一致，{cassette.unused()}条记录未使用")
+    registry.finish(game)
+
+
+if __name__ == "__main__":
+    main()
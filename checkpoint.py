@@ -0,0 +1,142 @@
+"""
+游戏的检查点
+
+每个环节（昼夜交替、夜晚、公开讨论、投票等）开始前把恢复游戏所需的全部状态写入检查点文件：
+- 阶段（stage）、接下来要进行的环节（phase）、今晚被杀的玩家（kill_tonight）以及游戏选项
+- 每名玩家的模型、角色、存活状态、女巫的解药和毒药、发给大模型的消息历史、已经生成的阶段摘要，以及内置代理的状态
+- 完整的聊天记录（阶段、来源、内容、思考过程和可见玩家）
+- 游戏说明、玩家配置和api配置（去掉api_key）
+
+进程崩溃、webui页面刷新或者服务商长时间不可用时，已经进行的环节不会丢失，
+恢复后从中断的那个环节重新开始，之前花掉的token不需要再花一次。
+
+文件为JSON Lines，路径以.gz结尾时用gzip压缩。第一次保存时写入新文件（先写临时文件再替换）：
+第一行是游戏配置，第二行是完整的状态。之后每次保存只追加一行增量：聊天记录、消息历史和阶段摘要都只增不改，
+只写上次保存之后新增的部分（since给出从哪里接上），其余的状态很小，每次完整写入。这样每次保存的开销与游戏进行了多久无关。
+读取时依次合并每一行；追加到一半时崩溃，最后一行不完整，读取时忽略它，相当于停在上一个检查点。
+
+保存：Game(..., checkpoint=Checkpoint())，默认写入 log/<游戏名>-id=<id>.checkpoint.json.gz
+恢复：game = Game.from_checkpoint(path)，再用 main.auto_play(game) 从中断的环节继续
+"""
+import gzip
+import json
+import os
+
+VERSION = 2
+# 只在第一行写一次的游戏配置
+HEADER = ("game_name", "id", "options", "instructions", "players_info", "apis")
+
+
+def open_file(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="UTF-8")
+    return open(path, mode, encoding="UTF-8")
+
+
+class Checkpoint:
+    def __init__(self, path = None):
+        """
+        一局游戏的检查点文件
+
+        Args:
+            path (str, optional): 文件路径，不指定时写在log文件夹中，与游戏日志同名. Defaults to None.
+
+        Attributes:
+            written (dict): 已经写入的聊天记录条数，以及每名玩家已经写入的消息数和摘要数，
+                传给Game.snapshot的since；还没有写入过时为None
+        """
+        self.path = path
+        self.saved = 0
+        self.written = None
+
+    def start(self, game):
+        if self.path is None:
+            self.path = f"./log/{game.game_name}-id={game.id}.checkpoint.json.gz"
+
+    def save(self, state):
+        """
+        写入检查点：第一次保存时原子地写入新文件，之后只追加一行增量
+
+        Args:
+            state (dict): Game.snapshot(phase, since=self.written)的返回值
+        """
+        record = {k: v for k, v in state.items() if k not in HEADER}
+        if self.written is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # 临时文件与目标文件后缀相同，open_file按同样的方式压缩
+            tmp = os.path.join(os.path.dirname(self.path), ".tmp-" + os.path.basename(self.path))
+            with open_file(tmp, "w") as f:
+                write(f, {"checkpoint": VERSION, **{k: state[k] for k in HEADER}})
+                write(f, record)
+            os.replace(tmp, self.path)
+        else:
+            with open_file(self.path, "a") as f:
+                write(f, record)
+        self.written = {
+            "transcript": record.get("since", 0) + len(record["transcript"]),
+            "players": {
+                i["id"]: {
+                    "messages": i.get("since", {}).get("messages", 0) + len(i["messages"]),
+                    "summaries": i.get("since", {}).get("summaries", 0) + len(i["summaries"]),
+                }
+                for i in record["players"]
+            },
+        }
+        self.saved += 1
+
+
+def write(f, record):
+    f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def merge(state, record):
+    """
+    把一行检查点合并进已经读出的状态，没有since的一行是完整的状态
+    """
+    players = {i["id"]: i for i in state.get("players", ())}
+    for i in record["players"]:
+        since = i.pop("since", None)
+        if since is None or i["id"] not in players:
+            continue
+        previous = players[i["id"]]
+        for key in ("messages", "message_stages"):
+            previous[key][since["messages"]:] = i[key]
+            i[key] = previous[key]
+        i["summaries"] = {**previous["summaries"], **i["summaries"]}
+    transcript = state.setdefault("transcript", [])
+    transcript[record.pop("since", 0):] = record.pop("transcript")
+    state.update(record)
+
+
+def load(path):
+    """
+    读取检查点
+
+    Args:
+        path (str): 检查点文件路径
+
+    Returns:
+        dict: 最后一次保存时的游戏状态
+    """
+    state = None
+    with open_file(path, "r") as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 追加到一半时崩溃留下的不完整的一行
+                    break
+                if state is None:
+                    if not isinstance(record, dict) or record.get("checkpoint") != VERSION:
+                        break
+                    state = record
+                else:
+                    merge(state, record)
+        except EOFError:
+            # gzip的最后一段没有写完
+            pass
+    if state is None or "players" not in state:
+        raise ValueError(f"{path}不是检查点文件")
+    return state
@@ -0,0 +1,612 @@
+"""
+大模型客户端层
+
+所有玩家共用一个后台事件循环和一组连接池：
+- 同一个 base_url 的所有请求共用一个 httpx.AsyncClient 连接池
+- 同一个 base_url + api_key 只创建一个 AsyncOpenAI 客户端
+- 同步代码（控制台模式、webui 的阶段线程）通过 runtime.run 提交协程并等待结果，
+  需要并发的地方用 runtime.gather 一次提交多个协程
+- 重试由游戏统一处理（见 RetryPolicy），客户端自身不再重试；同一个 base_url 共用一个熔断器（CircuitBreaker）
+- 同一个 base_url 的请求经过同一个限流器（RateLimiter）：每分钟请求数和token数的令牌桶，排队的请求在各局游戏之间轮流放行
+- 每个模型记录最近的首个片段延迟（LatencyWindow），配置了对冲时用来决定何时向备用地址再发一次请求
+"""
+import asyncio
+import atexit
+import collections
+import threading
+import time
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, stop_after_delay, wait_random_exponential
+
+from telemetry import percentile
+
+
+class LLMRuntime:
+    def __init__(self):
+        """
+        在后台线程中运行的事件循环，所有大模型请求都在这个循环中执行
+
+        连接池绑定在这个循环上，所以无论从哪个线程发起请求，连接都可以复用。
+        """
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        启动后台事件循环（重复调用是安全的）
+
+        Returns:
+            asyncio.AbstractEventLoop: 后台事件循环
+        """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="llm-runtime", daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def in_loop(self):
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    def run(self, coro):
+        """
+        在后台事件循环中执行协程，并阻塞等待结果
+
+        Args:
+            coro: 协程
+
+        Returns:
+            协程的返回值，协程抛出的异常会原样抛出
+        """
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("不能在事件循环内部同步等待，请直接await")
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def gather(self, coros):
+        """
+        并发执行多个协程，等待全部完成
+
+        Args:
+            coros (list): 协程列表
+
+        Returns:
+            list: 与coros顺序一致的返回值
+        """
+        async def gather_all():
+            return await asyncio.gather(*coros)
+        return self.run(gather_all())
+
+    def stop(self):
+        """
+        关闭连接池并停止后台事件循环
+        """
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = self.thread = None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(pool.aclose(), loop).result(timeout=5)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        loop.close()
+
+
+class CircuitOpenError(RuntimeError):
+    """服务商的熔断器处于打开状态，请求被直接拒绝"""
+
+
+class CircuitBreaker:
+    def __init__(self, failures = 5, reset = 30.0):
+        """
+        单个服务商的熔断器
+
+        连续失败（连接错误、超时、5xx）达到 failures 次后打开，之后的请求立即失败，不再等待超时；
+        reset 秒后进入半开状态，只放行一个试探请求，成功则关闭，失败则重新打开。限流（429）不计入失败。
+        试探请求既没有成功也没有失败时（限流、被取消、不计入失败的错误）必须调用release放回名额，否则之后的请求会一直被拒绝。
+
+        Args:
+            failures (int, optional): 打开熔断器的连续失败次数. Defaults to 5.
+            reset (float, optional): 打开后多久允许试探（秒）. Defaults to 30.0.
+        """
+        self.failures = failures
+        self.reset = reset
+        self.state = "closed"
+        self.count = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before(self):
+        """
+        请求之前调用，熔断器打开时抛出 CircuitOpenError
+
+        Returns:
+            bool: 这个请求是否为半开状态下的试探请求，请求结束时把它交给release
+        """
+        with self.lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            raise CircuitOpenError(f"熔断器已打开，{max(self.reset - (time.monotonic() - self.opened_at), 0):.0f}秒后重试")
+
+    def release(self, probe):
+        """
+        请求结束时调用（放在finally中），已经调用过success或failure时什么也不做；
+        试探请求的结果既不算成功也不算失败时放回名额，让下一个请求继续试探
+
+        Args:
+            probe (bool): before的返回值
+        """
+        if not probe:
+            return
+        with self.lock:
+            if self.state == "half_open":
+                self.probing = False
+
+    def success(self):
+        with self.lock:
+            self.state = "closed"
+            self.count = 0
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.count += 1
+            if self.state == "half_open" or self.count >= self.failures:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+def retryable(e):
+    """
+    是否为值得重试的错误：连接错误、超时、限流、服务端错误以及流中途断开
+    """
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, httpx.TransportError, TimeoutError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409) or e.status_code >= 500
+    # 例如回放录制文件时重现的错误
+    return getattr(e, "retryable", False)
+
+
+def counts_as_failure(e):
+    """是否说明服务商不可用，计入熔断器的失败次数"""
+    return retryable(e) and not isinstance(e, openai.RateLimitError) and not getattr(e, "retryable", False)
+
+
+def retry_after(e):
+    """
+    服务端在Retry-After中要求等待的秒数，没有时返回0
+    """
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers.get("retry-after", 0)) if response is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class RetryPolicy:
+    def __init__(self, max_retries = 4, first_token_timeout = 120.0, idle_timeout = 60.0, turn_timeout = 600.0, backoff = 1.0, max_backoff = 30.0):
+        """
+        一次发言（一轮请求）的超时和重试策略，可以在apis配置中为每个模型单独设置同名的项
+
+        Args:
+            max_retries (int, optional): 最多重试次数. Defaults to 4.
+            first_token_timeout (float, optional): 发出请求后等待第一个片段的时间（秒）. Defaults to 120.0.
+            idle_timeout (float, optional): 相邻两个片段之间的最长间隔（秒）. Defaults to 60.0.
+            turn_timeout (float, optional): 整轮（包括所有重试）的期限（秒）. Defaults to 600.0.
+            backoff (float, optional): 退避时间的基数（秒），实际等待时间带随机抖动. Defaults to 1.0.
+            max_backoff (float, optional): 单次退避的上限（秒）. Defaults to 30.0.
+        """
+        self.max_retries = max_retries
+        self.first_token_timeout = first_token_timeout
+        self.idle_timeout = idle_timeout
+        self.turn_timeout = turn_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_api(cls, api):
+        return cls(**{k: api[k] for k in ("max_retries", "first_token_timeout", "idle_timeout", "turn_timeout", "backoff", "max_backoff") if k in api})
+
+    def retrying(self, sleep = True):
+        """
+        返回tenacity的AsyncRetrying：带抖动的指数退避，服务端给出Retry-After时至少等待这么久
+
+        Args:
+            sleep (bool, optional): 为False时不等待（回放录制文件时）. Defaults to True.
+        """
+        jitter = wait_random_exponential(multiplier=self.backoff, max=self.max_backoff)
+        def wait(retry_state):
+            if not sleep:
+                return 0
+            return max(jitter(retry_state), min(retry_after(retry_state.outcome.exception()), self.max_backoff))
+        return AsyncRetrying(
+            retry=retry_if_exception(retryable),
+            stop=stop_after_attempt(self.max_retries + 1) | stop_after_delay(self.turn_timeout),
+            wait=wait,
+            reraise=True,
+        )
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        """
+        每分钟补充per_minute个令牌的令牌桶，最多存一分钟的量
+
+        Args:
+            per_minute (float): 每分钟的额度
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, amount, now):
+        """
+        还要等多久才够amount个令牌（超过桶容量的按容量算）
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        # 可以扣成负数：实际用量超过预留时，之后的请求多等一会儿
+        self.level -= amount
+
+
+class RateLimiter:
+    def __init__(self, rpm = None, tpm = None):
+        """
+        单个服务商的限流器和请求调度
+
+        额度够用时请求直接通过；不够时按游戏分别排队，轮流放行每局游戏最早的请求，
+        同时进行的多局游戏中请求多的一局不会让其它游戏一直等待。
+        TPM按估计的提示token数预留，请求结束后再用charge补上回复的token数。
+
+        Args:
+            rpm (float, optional): 每分钟请求数，None为不限. Defaults to None.
+            tpm (float, optional): 每分钟token数，None为不限. Defaults to None.
+        """
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.queues = {}
+        self.turns = collections.deque()
+        self.timer = None
+        self.granted = 0
+        self.delayed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def tpm(self):
+        return self.tokens is not None
+
+    def delay(self, tokens, now):
+        return max(self.requests.delay(1, now) if self.requests else 0.0,
+                   self.tokens.delay(tokens, now) if self.tokens else 0.0)
+
+    def take(self, tokens):
+        self.granted += 1
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+
+    async def acquire(self, tokens = 0, key = None):
+        """
+        等待额度，返回排队的秒数
+
+        Args:
+            tokens (int, optional): 预留的token数. Defaults to 0.
+            key (optional): 请求所属的游戏，同一局游戏的请求排在同一个队列中. Defaults to None.
+
+        Returns:
+            float: 排队等待的时间（秒），没有排队时为0
+        """
+        start = time.monotonic()
+        with self.lock:
+            if not self.turns and self.delay(tokens, start) <= 0:
+                self.take(tokens)
+                return 0.0
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = collections.deque()
+                self.turns.append(key)
+            queue.append((future, tokens))
+            if self.timer is None:
+                self.timer = loop.call_soon(self.dispatch)
+        # 取消（例如超过整轮期限）时future也被取消，dispatch会跳过它
+        await future
+        waited = time.monotonic() - start
+        with self.lock:
+            self.delayed += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def dispatch(self):
+        """
+        按游戏轮流放行排队的请求，额度不够时在额度恢复的时刻再次调用
+        """
+        with self.lock:
+            self.timer = None
+            now = time.monotonic()
+            while self.turns:
+                key = self.turns[0]
+                queue = self.queues[key]
+                while queue and queue[0][0].done():
+                    queue.popleft()
+                if queue:
+                    future, tokens = queue[0]
+                    delay = self.delay(tokens, now)
+                    if delay > 0:
+                        self.timer = future.get_loop().call_later(delay, self.dispatch)
+                        return
+                    queue.popleft()
+                    self.take(tokens)
+                    future.set_result(None)
+                self.turns.popleft()
+                if queue:
+                    self.turns.append(key)
+                else:
+                    del self.queues[key]
+
+    def charge(self, tokens):
+        """
+        请求结束后补记预留之外用掉的token数
+        """
+        if self.tokens and tokens > 0:
+            with self.lock:
+                self.tokens.take(tokens)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: 排队的请求数和游戏数、放行的请求数、排过队的请求数以及平均和最长等待时间（秒）
+        """
+        with self.lock:
+            queued = {key: sum(1 for i in queue if not i[0].done()) for key, queue in self.queues.items()}
+            return {
+                "rpm": self.requests.capacity if self.requests else None,
+                "tpm": self.tokens.capacity if self.tokens else None,
+                "queued": sum(queued.values()),
+                "games_waiting": sum(1 for i in queued.values() if i),
+                "granted": self.granted,
+                "delayed": self.delayed,
+                "wait_avg": self.wait_total / self.delayed if self.delayed else 0.0,
+                "wait_max": self.wait_max,
+            }
+
+
+class LatencyWindow:
+    def __init__(self, size = 200):
+        """
+        一个模型最近size次请求的首个片段延迟
+
+        Args:
+            size (int, optional): 保留的样本数. Defaults to 200.
+        """
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q, min_samples = 20):
+        """
+        Returns:
+            float: 最近延迟的q分位数，样本少于min_samples时返回None
+        """
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            samples = list(self.samples)
+        return percentile(samples, q)
+
+
+class ClientPool:
+    def __init__(self, max_connections = 100, max_keepalive_connections = 20, timeout = 600):
+        """
+        按 base_url 共享连接池的客户端缓存
+
+        Args:
+            max_connections (int, optional): 每个base_url的最大连接数. Defaults to 100.
+            max_keepalive_connections (int, optional): 每个base_url保持的空闲连接数. Defaults to 20.
+            timeout (float, optional): 单次请求的超时时间（秒）. Defaults to 600.
+        """
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.timeout = timeout
+        self.http_clients = {}
+        self.clients = {}
+        self.breakers = {}
+        self.limiters = {}
+        self.latencies = {}
+        # 多个进程共用同一份额度时（锦标赛的工作进程），每个进程只使用其中的这一部分
+        self.share = 1.0
+        self.lock = threading.Lock()
+
+    def get(self, api):
+        """
+        返回api配置对应的客户端，相同的base_url和api_key只创建一次
+
+        Args:
+            api (dict): apis配置中的一项，包含api_key和base_url
+
+        Returns:
+            AsyncOpenAI: 异步客户端
+        """
+        base_url = api.get("base_url") or "https://api.openai.com/v1"
+        key = (base_url, api["api_key"])
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                http_client = self.http_clients.get(base_url)
+                if http_client is None:
+                    http_client = self.http_clients[base_url] = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+                client = self.clients[key] = AsyncOpenAI(api_key=api["api_key"], base_url=base_url, http_client=http_client, max_retries=0)
+            return client
+
+    def breaker(self, api):
+        """
+        返回api配置对应服务商（base_url）的熔断器，参数取自第一次使用它的配置中的breaker_failures和breaker_reset
+
+        Args:
+            api (dict): apis配置中的一项
+
+        Returns:
+            CircuitBreaker: 熔断器
+        """
+        base_url = api.get("base_url") or "https://api.openai.com/v1"
+        with self.lock:
+            breaker = self.breakers.get(base_url)
+            if breaker is None:
+                breaker = self.breakers[base_url] = CircuitBreaker(api.get("breaker_failures", 5), api.get("breaker_reset", 30.0))
+            return breaker
+
+    def limiter(self, api):
+        """
+        返回api配置对应服务商（base_url）的限流器，额度取自第一次使用它的配置中的rpm和tpm
+
+        Args:
+            api (dict): apis配置中的一项
+
+        Returns:
+            RateLimiter: 限流器
+        """
+        base_url = api.get("base_url") or "https://api.openai.com/v1"
+        with self.lock:
+            limiter = self.limiters.get(base_url)
+            if limiter is None:
+                rpm, tpm = api.get("rpm"), api.get("tpm")
+                limiter = self.limiters[base_url] = RateLimiter(rpm and rpm * self.share, tpm and tpm * self.share)
+            return limiter
+
+    def latency(self, api):
+        """
+        返回api配置对应模型（base_url + model_name）的延迟记录
+        """
+        key = (api.get("base_url") or "https://api.openai.com/v1", api.get("model_name"))
+        with self.lock:
+            latency = self.latencies.get(key)
+            if latency is None:
+                latency = self.latencies[key] = LatencyWindow()
+            return latency
+
+    async def aclose(self):
+        """
+        关闭所有连接池
+        """
+        with self.lock:
+            http_clients = list(self.http_clients.values())
+            self.http_clients.clear()
+            self.clients.clear()
+        for i in http_clients:
+            await i.aclose()
+
+    def __len__(self):
+        return len(self.clients)
+
+
+runtime = LLMRuntime()
+pool = ClientPool()
+atexit.register(runtime.stop)
+
+
+def get_client(api):
+    """
+    返回api配置对应的共享异步客户端
+
+    Args:
+        api (dict): apis配置中的一项
+
+    Returns:
+        AsyncOpenAI: 异步客户端
+    """
+    return pool.get(api)
+
+
+def get_breaker(api):
+    """
+    返回api配置对应服务商的共享熔断器
+
+    Args:
+        api (dict): apis配置中的一项
+
+    Returns:
+        CircuitBreaker: 熔断器
+    """
+    return pool.breaker(api)
+
+
+def get_limiter(api):
+    """
+    返回api配置对应服务商的共享限流器
+
+    Args:
+        api (dict): apis配置中的一项
+
+    Returns:
+        RateLimiter: 限流器
+    """
+    return pool.limiter(api)
+
+
+def get_latency(api):
+    """
+    返回api配置对应模型的最近首个片段延迟
+
+    Args:
+        api (dict): apis配置中的一项
+
+    Returns:
+        LatencyWindow: 延迟记录
+    """
+    return pool.latency(api)
+
+
+def limiter_stats():
+    """
+    Returns:
+        dict: base_url -> 该服务商限流器的排队情况（见 RateLimiter.snapshot）
+    """
+    with pool.lock:
+        limiters = dict(pool.limiters)
+    return {base_url: limiter.snapshot() for base_url, limiter in limiters.items()}
+
+
+def strip_secrets(api, secrets = ("api_key",)):
+    """
+    去掉api配置（包括对冲的备用配置）中的密钥等项，用于写入检查点和录制文件
+
+    Args:
+        api (dict): apis配置中的一项
+        secrets (tuple, optional): 要去掉的项. Defaults to ("api_key",).
+
+    Returns:
+        dict: 不含这些项的副本
+    """
+    return {k: strip_secrets(v, secrets) if isinstance(v, dict) else v for k, v in api.items() if k not in secrets}
@@ -1,9 +1,27 @@
-from openai import OpenAI
 import json
 import logging
 import os
-import time
+import random
 import re
+import time
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from llm_client import runtime, get_client, get_breaker, get_limiter, get_latency, counts_as_failure, strip_secrets, CircuitOpenError, RetryPolicy
+from agents import AGENTS
+from telemetry import CallTimer, Telemetry, format_summary
+from checkpoint import Checkpoint, load as load_checkpoint
+
+# 控制台模式下是否逐字打印回复。并发执行多个行动时关闭，改为整条打印，避免输出交错
+live_echo = contextvars.ContextVar("live_echo", default=True)
+# 当前执行的游戏环节，用于遥测记录。夜晚的行动在各自的任务中执行，互不影响
+current_phase = contextvars.ContextVar("current_phase", default="")
 
 # 工具函数
 def read_json(file_path):
@@ -53,6 +71,21 @@ def extract_numbers_from_brackets(text):
 
     return numbers
 
+NON_CJK = re.compile('[^\u2e80-\u9fff\uff00-\uffef]+')
+
+def estimate_tokens(text):
+    """
+    粗略估计文本的token数：中日韩字符按每个1个token计算，其余字符按每4个1个token计算
+
+    Args:
+        text (str): 文本
+
+    Returns:
+        int: 估计的token数
+    """
+    other = sum(map(len, NON_CJK.findall(text)))
+    return len(text) - other + (other + 3) // 4
+
 def find_max_key(vote_dict):
     """
     Finds the key with the maximum value in a dictionary.
@@ -71,62 +104,616 @@ def find_max_key(vote_dict):
     return max_keys[0] if len(max_keys) == 1 else 0
 
 
+async def iter_deltas(response):
+    """
+    异步遍历流式回复，把每个片段区分为思考过程和发言内容
+
+    推理模型会在delta中给出reasoning_content，普通模型没有这个字段。
+
+    Args:
+        response: chat.completions.create(stream=True)的返回值
+
+    Yields:
+        tuple: ("reasoning"或"content", 文本片段)，服务端在流中给出用量时还会产出 ("usage", usage)
+    """
+    async for chunk in response:
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            yield "usage", usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning_message = getattr(delta, "reasoning_content", None)
+        if reasoning_message:
+            yield "reasoning", reasoning_message
+        if delta.content:
+            yield "content", delta.content
+
+
+async def chain(head, deltas):
+    """先产出已经收到的片段，再接着读取剩下的"""
+    for item in head:
+        yield item
+    async for item in deltas:
+        yield item
+
+
+def sampling(api):
+    """
+    apis配置中原样传给chat.completions.create的采样参数：目前只有seed（例如分支使用不同的种子）
+    """
+    return {"seed": api["seed"]} if "seed" in api else {}
+
+
+async def close_response(response):
+    close = getattr(response, "close", None)
+    if close is not None:
+        await close()
+
+
+class LLMAgent:
+    """
+    默认的代理：把对话发给玩家的大模型，返回流式回复
+
+    其它代理（见 agents.py）实现同样的 reply 协程，在进程内直接给出回答。
+    """
+    async def reply(self, player, question, messages):
+        """
+        Args:
+            player (Player): 回答的玩家
+            question (str): 本次上帝的提问
+            messages (list): 发给大模型的完整对话
+
+        Returns:
+            异步迭代器，依次产出 ("reasoning"或"content", 文本片段)，可以另外产出 ("usage", usage) 报告实际的token用量，
+            ("retry", 原因) 表示之前收到的片段作废、整轮重新提问，以及 ("queue", 秒数) 报告在限流器中排队的时间
+        """
+        return self.stream(player, messages)
+
+    async def stream(self, player, messages):
+        """
+        带限流、超时、重试和熔断的流式请求，策略见 llm_client.RetryPolicy 和 llm_client.RateLimiter
+
+        连接错误、超时、限流、服务端错误以及流中途断开都会在带抖动的退避之后重新提问；
+        服务商的熔断器打开时立即失败，不再等待超时。
+        """
+        api = player.game.apis[player.model]
+        policy = RetryPolicy.from_api(api)
+        breaker = get_breaker(api)
+        cassette = player.game.cassette
+        deadline = asyncio.get_running_loop().time() + policy.turn_timeout
+        reason = None
+        # 回放录制文件时重现当时的重试，但不需要真的等待，也不占用服务商的额度
+        replaying = cassette is not None and cassette.mode == "replay"
+        limiter = None if replaying else get_limiter(api)
+        async for attempt in policy.retrying(sleep=not replaying):
+            with attempt:
+                if reason is not None:
+                    yield "retry", reason
+                async for item in self.attempt(player, api, messages, policy, deadline, breaker, limiter):
+                    yield item
+            outcome = attempt.retry_state.outcome
+            if outcome is not None and outcome.failed:
+                e = outcome.exception()
+                reason = f"{type(e).__name__}: {e}"
+
+    async def attempt(self, player, api, messages, policy, deadline, breaker, limiter = None):
+        """
+        一次请求：先在限流器中排队，等待第一个片段不超过first_token_timeout，之后相邻片段的间隔不超过idle_timeout，
+        全部不超过整轮的期限。排过队时先产出 ("queue", 等待秒数)；
+        配置了对冲并且向备用地址发出了请求时，产出 ("hedge", "primary"或"backup") 说明最终用的是哪一路
+        """
+        loop = asyncio.get_running_loop()
+        generated = [] if limiter is not None and limiter.tpm else None
+        usage = None
+        if limiter is not None:
+            reserved = sum(estimate_tokens(i["content"]) for i in messages) if generated is not None else 0
+            waited = await self.within(limiter.acquire(reserved, player.game.id), deadline, deadline, "排队超过整轮期限")
+            if waited:
+                yield "queue", waited
+        probe = breaker.before()
+        response = None
+        active = breaker
+        backup_probe = False
+        try:
+            limit, what = policy.first_token_timeout, "等待首个片段"
+            start = loop.time()
+            backup = self.backup_api(player, api)
+            if backup is None:
+                response = await self.within(player.client.chat.completions.create(
+                    model = api["model_name"],
+                    messages = messages,
+                    stream = True,
+                    **sampling(api)
+                ), start + limit, deadline, f"{what}超过{limit}秒")
+                deltas = iter_deltas(response)
+            else:
+                response, deltas, winner, active, backup_probe = await self.within(self.race(player, api, backup, messages, breaker),
+                                                                     start + limit, deadline, f"{what}超过{limit}秒")
+                if winner is not None:
+                    yield "hedge", winner
+            while True:
+                try:
+                    kind, text = await self.within(anext(deltas), start + limit, deadline, f"{what}超过{limit}秒")
+                except StopAsyncIteration:
+                    break
+                yield kind, text
+                if generated is not None:
+                    if kind == "usage":
+                        usage = text
+                    else:
+                        generated.append(text)
+                if kind != "usage":
+                    limit, what = policy.idle_timeout, "片段间隔"
+                    start = loop.time()
+            active.success()
+        except BaseException as e:
+            # 对冲时由实际使用的那一路承担失败
+            if counts_as_failure(e):
+                active.failure()
+            raise
+        finally:
+            # 限流、取消以及输掉对冲时既不算成功也不算失败，放回试探的名额
+            breaker.release(probe)
+            if active is not breaker:
+                active.release(backup_probe)
+            if generated is not None:
+                # 中途失败时已经生成的部分同样占用额度
+                completion = getattr(usage, "completion_tokens", None)
+                limiter.charge(completion if completion is not None else estimate_tokens("".join(generated)))
+            await close_response(response)
+
+    def backup_api(self, player, api):
+        """
+        配置了对冲（hedge）时返回备用地址的api配置，没有写的项沿用主配置；录制和回放时不对冲，保证请求一一对应
+        """
+        hedge = api.get("hedge")
+        if not hedge or player.game.cassette is not None:
+            return None
+        return {**api, **hedge}
+
+    async def open(self, client, api, messages):
+        """
+        发出流式请求并等到第一个片段
+
+        Returns:
+            tuple: (response, 从第一个片段开始的异步迭代器)
+        """
+        response = await client.chat.completions.create(
+            model = api["model_name"],
+            messages = messages,
+            stream = True,
+            **sampling(api)
+        )
+        deltas = iter_deltas(response)
+        head = []
+        try:
+            while not head or head[-1][0] == "usage":
+                try:
+                    head.append(await anext(deltas))
+                except StopAsyncIteration:
+                    break
+        except BaseException:
+            await close_response(response)
+            raise
+        return response, chain(head, deltas)
+
+    async def race(self, player, api, backup, messages, breaker):
+        """
+        对冲：先只向主地址请求，等待首个片段的时间超过最近延迟的分位数（hedge.percentile）时，
+        再向备用地址发出同样的请求，先给出片段的一路胜出，另一路被取消
+
+        Returns:
+            tuple: (response, 片段迭代器, 胜出的一路（没有发出备用请求时为None）, 胜出一路的熔断器,
+                    备用地址胜出时它是否为试探请求（由调用者在请求结束时release）)
+        """
+        hedge = api["hedge"]
+        loop = asyncio.get_running_loop()
+        latency = get_latency(api)
+        delay = latency.quantile(hedge.get("percentile", 0.95), hedge.get("min_samples", 20))
+        start = loop.time()
+        primary = asyncio.ensure_future(self.open(player.client, api, messages))
+        tasks = [primary]
+        winner = None
+        backup_breaker = get_breaker(backup)
+        backup_probe = False
+        try:
+            if delay is not None:
+                await asyncio.wait([primary], timeout=max(delay, hedge.get("min_delay", 0)))
+            hedging = delay is not None and not primary.done()
+            if hedging:
+                try:
+                    backup_probe = backup_breaker.before()
+                except CircuitOpenError:
+                    hedging = False
+            if not hedging:
+                winner = primary
+                result = await primary
+                latency.add(loop.time() - start)
+                return *result, None, breaker, False
+
+            async def open_backup():
+                await get_limiter(backup).acquire(0, player.game.id)
+                return await self.open(get_client(backup), backup, messages)
+            tasks.append(asyncio.ensure_future(open_backup()))
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    if task is not primary and counts_as_failure(task.exception()):
+                        backup_breaker.failure()
+            if winner is None:
+                # 两路都失败时以主地址的错误为准
+                raise primary.exception()
+            # 主地址输掉时记下已经等待的时间（实际延迟至少这么长），分位数不会因为只统计快的请求而越来越小
+            latency.add(loop.time() - start)
+            if winner is primary:
+                return *primary.result(), "primary", breaker, False
+            return *winner.result(), "backup", backup_breaker, backup_probe
+        finally:
+            if winner is None or winner is primary:
+                # 备用请求输掉、失败或者被取消，放回试探的名额
+                backup_breaker.release(backup_probe)
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+            for task in tasks:
+                if task is not winner:
+                    # 已经拿到首个片段的一路同样要关闭
+                    result = (await asyncio.gather(task, return_exceptions=True))[0]
+                    if isinstance(result, tuple):
+                        await close_response(result[0])
+
+    async def within(self, awaitable, when, deadline, message):
+        """
+        在when和整轮期限deadline中较早的时刻之前等待awaitable完成，超时抛出带说明的TimeoutError
+        """
+        try:
+            async with asyncio.timeout_at(min(when, deadline)):
+                return await awaitable
+        except TimeoutError:
+            raise TimeoutError(message if when <= deadline else "超过整轮期限") from None
+
+
+class SharedList:
+    def __init__(self, base, length = None):
+        """
+        分支共享的只追加列表：前length项直接引用父列表，之后追加的项保存在自己的tail中
+
+        ContextStore中的列表只会追加（丢弃的流式信息一定是分出之后追加的），父列表的前length项永远不会改变，
+        所以分支不必复制它们，父游戏和分支之后各自追加的信息互不可见。支持len、下标、切片（返回list）、遍历和bisect。
+
+        Args:
+            base (list): 父列表（也可以是SharedList）
+            length (int, optional): 共享的项数，默认为父列表当前的长度. Defaults to None.
+        """
+        length = len(base) if length is None else length
+        while isinstance(base, SharedList) and length <= base.length:
+            # 共享的部分完全在父列表的前缀中，直接共享更早的那一层
+            base = base.base
+        self.base = base
+        self.length = length
+        self.tail = []
+
+    def append(self, item):
+        self.tail.append(item)
+
+    def remove(self, item):
+        """移除自己追加的一项（ContextStore.discard_stream），共享的部分不会改变"""
+        self.tail.remove(item)
+
+    def __len__(self):
+        return self.length + len(self.tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            head = self.base[start:min(stop, self.length)] if start < self.length else []
+            return head + self.tail[max(start - self.length, 0):max(stop - self.length, 0)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SharedList index out of range")
+        return self.base[index] if index < self.length else self.tail[index - self.length]
+
+    def __iter__(self):
+        return itertools.chain(itertools.islice(self.base, self.length), self.tail)
+
+
+class ContextStore:
+    def __init__(self):
+        """
+        一局游戏的上下文存储
+
+        所有信息按产生顺序追加到列表中，同时按阶段和可见玩家各建一份
+        只追加的索引。查询时按偏移量切片，只需付出返回结果本身的开销，
+        不必再遍历整局游戏的全部记录。
+
+        Attributes:
+            items (list): 按顺序保存的全部信息
+            by_stage (dict): 阶段 -> 该阶段的信息列表
+            by_viewer (dict): 玩家id -> 该玩家可见的信息列表
+        """
+        self.items = []
+        self.by_stage = {}
+        self.by_viewer = {}
+
+    def append(self, context):
+        """
+        追加一条信息，并写入阶段索引和可见玩家索引
+
+        Args:
+            context (Context): 要追加的信息
+        """
+        context.seq = len(self.items)
+        self.items.append(context)
+        self.by_stage.setdefault(context.stage, []).append(context)
+        for i in context.visible_ids:
+            self.by_viewer.setdefault(i, []).append(context)
+
+    def open_stream(self, context):
+        """
+        登记一条正在流式输出的信息
+
+        流式信息只写入阶段索引，让界面可以实时显示；在输出完成之前，
+        它不会出现在任何玩家的可见信息中。
+
+        Args:
+            context (Context): 正在流式输出的信息
+        """
+        self.by_stage.setdefault(context.stage, []).append(context)
+
+    def discard_stream(self, context):
+        """
+        丢弃一条没有完成的流式信息，只需从阶段索引中移除
+
+        Args:
+            context (Context): 正在流式输出的信息
+        """
+        self.by_stage[context.stage].remove(context)
+
+    def commit_stream(self, context):
+        """
+        流式信息输出完成后，写入全局列表和可见玩家索引
+
+        Args:
+            context (Context): 已完成的流式信息
+        """
+        context.seq = len(self.items)
+        self.items.append(context)
+        for i in context.visible_ids:
+            self.by_viewer.setdefault(i, []).append(context)
+
+    def visible_to(self, viewer_id, start = 0, before = None):
+        """
+        返回某个玩家可见的信息
+
+        Args:
+            viewer_id (int): 玩家id
+            start (int, optional): 起始偏移量，用于只取上次之后新增的信息. Defaults to 0.
+            before (int, optional): 快照位置，只返回在此之前写入的信息（即len(store)的某个历史值）. Defaults to None.
+
+        Returns:
+            list: 该玩家可见的信息
+        """
+        contexts = self.by_viewer.get(viewer_id, [])
+        end = len(contexts) if before is None else bisect_left(contexts, before, key=lambda i: i.seq)
+        return contexts[start:end]
+
+    def count_visible(self, viewer_id):
+        return len(self.by_viewer.get(viewer_id, []))
+
+    def of_stage(self, stage, start = 0):
+        """
+        返回某一阶段的信息
+
+        Args:
+            stage (int): 阶段
+            start (int, optional): 起始偏移量. Defaults to 0.
+
+        Returns:
+            list: 该阶段的信息
+        """
+        return self.by_stage.get(stage, [])[start:]
+
+    def fork(self):
+        """
+        返回一个共享目前全部信息的新存储（写时复制）
+
+        已有的信息和索引不会被复制，只为每个索引建立一个SharedList，开销与信息的数量无关。
+        必须在没有正在流式输出的信息时调用（也就是两个环节之间）。
+
+        Returns:
+            ContextStore: 新的存储，之后追加的信息只出现在其中一方
+        """
+        store = ContextStore()
+        store.items = SharedList(self.items)
+        store.by_stage = {k: SharedList(v) for k, v in self.by_stage.items()}
+        store.by_viewer = {k: SharedList(v) for k, v in self.by_viewer.items()}
+        return store
+
+    def __len__(self):
+        return len(self.items)
+
+
 class Context:
     contexts = {}
-    def __init__(self,game,source_id,content,visible_ids = [],is_streaming = False, last_block = False):
+    def __init__(self,game,source_id,content,visible_ids = [],is_streaming = False,reasoning = ""):
         """
         保存游戏中的一个信息
 
+        流式输出时只创建一个Context，之后用append/append_reasoning追加片段，
+        输出完成后调用finish一次性拼接为最终内容。思考过程和发言内容分开保存，
+        思考过程只用于日志和界面展示，不会进入任何玩家的上下文。
+
         Args:
             game (Game): 游戏对象
             source_id (int): 信息的来源id
-            content (str): 信息的内容
+            content (str): 信息的内容（流式输出时为第一个片段）
             visible_ids (list, optional): 可以看到这个信息的玩家id列表. Defaults to [].
+            is_streaming (bool, optional): 是否为正在流式输出的信息. Defaults to False.
+            reasoning (str, optional): 推理模型的思考过程. Defaults to "".
         """
 
-        if game not in Context.contexts.keys():
-            Context.contexts[game] = []
-        
-        streaming = False if last_block else True
-        if is_streaming:
-            pre_block = Context.contexts[game][-1]
-            if pre_block.source_id == source_id and pre_block.is_streaming and not pre_block.last_block:
-                # 说明和前一条是一个人说的，则更新最后一条
-                content = pre_block.content + content
-                Context.contexts[game].pop(-1)
-        Context.contexts[game].append(self)
         self.game = game
         self.stage = game.stage
         self.is_streaming = is_streaming
-        self.last_block = last_block
         self.source_id = source_id
-        self.content = content
         self.visible_ids = set(visible_ids + [source_id,0] if visible_ids else [source_id,0])
+        self._pub_text = None
+        self._tokens = None
+        store = Context.get_store(game)
+        if is_streaming:
+            self.chunks = [content] if content else []
+            self.reasoning_chunks = [reasoning] if reasoning else []
+            self._content = None
+            self._reasoning = None
+            store.open_stream(self)
+        else:
+            self.chunks = None
+            self.reasoning_chunks = None
+            self._content = content
+            self._reasoning = reasoning
+            store.append(self)
+
+        self.notify()
+
+    @property
+    def content(self):
+        """
+        信息的内容。流式输出过程中返回目前已收到的部分
+        """
+        if self.is_streaming:
+            return "".join(self.chunks)
+        return self._content
+
+    @property
+    def reasoning(self):
+        """
+        思考过程。流式输出过程中返回目前已收到的部分
+        """
+        if self.is_streaming:
+            return "".join(self.reasoning_chunks)
+        return self._reasoning
+
+    def append(self, chunk):
+        """
+        向正在流式输出的信息追加一个发言片段
 
-        if self.game:
-            if not streaming:
-                self.game.logger.info(self.__str__())
-            # 强制触发日志更新（关键改进点）
-            if hasattr(self.game, 'streamlit_log_trigger'):
-                self.game.streamlit_log_trigger.set()
+        Args:
+            chunk (str): 新收到的片段
+        """
+        if chunk:
+            self.chunks.append(chunk)
+            self.notify()
+
+    def append_reasoning(self, chunk):
+        """
+        向正在流式输出的信息追加一个思考片段
+
+        Args:
+            chunk (str): 新收到的片段
+        """
+        if chunk:
+            self.reasoning_chunks.append(chunk)
+            self.notify()
+
+    def reset(self):
+        """
+        丢弃正在流式输出的信息已经收到的全部片段（请求中途失败、重新提问时使用）
+        """
+        if self.is_streaming:
+            self.chunks.clear()
+            self.reasoning_chunks.clear()
+            self.notify()
+
+    def finish(self):
+        """
+        结束流式输出：拼接全部片段，写入可见玩家索引并记录日志
+        """
+        if not self.is_streaming:
+            return
+        self._content = "".join(self.chunks)
+        self._reasoning = "".join(self.reasoning_chunks)
+        self.chunks = None
+        self.reasoning_chunks = None
+        self.is_streaming = False
+        Context.get_store(self.game).commit_stream(self)
+        self.game.logger.info("%s", self.log_text())
+        self.notify()
+
+    def discard(self):
+        """
+        放弃流式输出（请求失败时）：从界面上移除，不写入可见玩家索引和日志
+        """
+        if not self.is_streaming:
+            return
+        self._content = "".join(self.chunks)
+        self._reasoning = "".join(self.reasoning_chunks)
+        self.chunks = None
+        self.reasoning_chunks = None
+        self.is_streaming = False
+        Context.get_store(self.game).discard_stream(self)
+        self.notify()
+
+    def notify(self):
+        # 强制触发日志更新（关键改进点）
+        if hasattr(self.game, 'streamlit_log_trigger'):
+            self.game.streamlit_log_trigger.set()
+
+    def get_store(game):
+        """
+        返回游戏对应的上下文存储，不存在时创建
+
+        Args:
+            game (Game): 游戏对象
+
+        Returns:
+            ContextStore: 该游戏的上下文存储
+        """
+        store = Context.contexts.get(game)
+        if store is None:
+            store = Context.contexts[game] = ContextStore()
+        return store
+
+    def share(game, parent):
+        """
+        让game的上下文存储共享parent目前的全部信息（写时复制，见ContextStore.fork）
+
+        Args:
+            game (Game): 新的游戏对象
+            parent (Game): 被共享的游戏对象
+        """
+        Context.contexts[game] = Context.get_store(parent).fork()
+
+    def release(game):
+        """
+        删除游戏对应的上下文存储
 
-    def get_context(id,game):
+        Args:
+            game (Game): 游戏对象
+        """
+        Context.contexts.pop(game, None)
+
+    def get_context(id,game,start = 0):
         """
         根据玩家id和游戏id，返回该玩家可以看到的所有信息
 
         Args:
             id (int): 玩家id
             game (int): 游戏id
+            start (int, optional): 起始偏移量，只返回该玩家第start条可见信息之后的内容. Defaults to 0.
 
         Returns:
             list: 该玩家可以看到的所有信息
         """
-        pub_messages = []
-        for i in Context.contexts[game]:
-            if id in i.visible_ids: #自己可见的
-                pub_messages.append(re.sub(r'<think>.*?</think>', '', str(i), flags=re.DOTALL))
-        return pub_messages
-    
+        return [i.pub_text() for i in Context.get_store(game).visible_to(id, start)]
+
     def get_chat_log(game, stage):
         """
         根据游戏id和阶段，返回该阶段所有信息
@@ -138,21 +725,204 @@ class Context:
         Returns:
             list: 包含所有符合条件消息对象的列表，若无匹配项则返回空列表
         """
-        messages = []
-        # 遍历指定游戏的全部上下文记录
-        for i in Context.contexts[game]:
-            # 筛选出阶段标识匹配的记录
-            if i.stage == stage:
-                messages.append(i)
-        return messages
+        return Context.get_store(game).of_stage(stage)
+
+    def pub_text(self):
+        """
+        返回玩家上下文中使用的文本（不含思考过程），结果会被缓存
+        """
+        if self._pub_text is None:
+            self._pub_text = str(self)
+        return self._pub_text
+
+    def tokens(self):
+        """
+        返回pub_text的估计token数，结果会被缓存
+        """
+        if self._tokens is None:
+            self._tokens = estimate_tokens(self.pub_text())
+        return self._tokens
+
+    def log_text(self):
+        """
+        返回写入日志的文本，推理模型的思考过程放在<think>标签中
+        """
+        if self.reasoning:
+            return f"<think>{self.reasoning}</think>{self}"
+        return str(self)
 
     def __str__(self):
-        v_id = self.visible_ids
-        v_id.discard(0)
+        v_id = self.visible_ids - {0}
         if self.source_id == 0:
             return f"上帝:{self.content}（{v_id}可见）\n"
         return f"{self.source_id}号玩家:{self.content}（{v_id}可见）\n"
 
+class ContextBudget:
+    def __init__(self,player):
+        """
+        单个玩家的上下文预算管理
+
+        apis配置中可以为模型设置context_budget（估计的token数）。当一次请求
+        超过预算时，从最早的阶段开始，把已经结束的阶段替换为该玩家视角的摘要，
+        直到请求回到预算以内。摘要由summary_model指定的模型生成（默认使用玩家
+        自己的模型），每个阶段对每个玩家只生成一次并缓存下来。已压缩的阶段
+        不会再展开，因此之后的请求前缀仍然保持稳定。
+
+        Args:
+            player (Player): 所属玩家
+
+        Attributes:
+            summaries (dict): 阶段 -> 该阶段的摘要
+            cutoff (int): 不超过该阶段的内容都以摘要的形式发送，-1表示不压缩
+            stage_tokens (dict): 阶段 -> 该阶段的消息（完整上下文模式下还有可见信息）的估计token数，系统提示记在None下
+            counted (int): 已经计入stage_tokens的消息数
+            seen (int): 完整上下文模式下已经计入stage_tokens的可见信息数
+        """
+        self.player = player
+        self.summaries = {}
+        self.cutoff = -1
+        self.stage_tokens = {}
+        self.counted = 0
+        self.seen = 0
+
+    def config(self):
+        return self.player.game.apis[self.player.model]
+
+    def update(self,messages,stages,contexts):
+        """
+        根据本次请求的估计大小推进压缩阶段
+
+        Args:
+            messages (list): 玩家的消息列表
+            stages (list): 每条消息所属的阶段，系统提示为None
+            contexts (list): 本次请求中要附带的上下文
+
+        Returns:
+            int: 更新后的cutoff
+        """
+        budget = self.config().get("context_budget")
+        if not budget:
+            return self.cutoff
+        summary_tokens = self.config().get("summary_tokens",300)
+        # 消息只会追加（请求结束后替换的最后一条在下次调用之前就已经换好），每次只估计新增的部分
+        for message, stage in zip(messages[self.counted:],stages[self.counted:]):
+            self.stage_tokens[stage] = self.stage_tokens.get(stage,0) + estimate_tokens(message["content"])
+        self.counted = len(messages)
+        per_stage = self.stage_tokens
+        if self.player.game.incremental_context:
+            # 增量模式下这些信息会写进本次的消息，之后按消息计入，这里只临时加上
+            per_stage = dict(per_stage)
+            for i in contexts:
+                per_stage[i.stage] = per_stage.get(i.stage,0) + i.tokens()
+        else:
+            # 完整上下文模式下每次都附带全部可见信息，它们只增不减，同样只计入新增的部分
+            for i in contexts[self.seen:]:
+                per_stage[i.stage] = per_stage.get(i.stage,0) + i.tokens()
+            self.seen = len(contexts)
+        total = summary_tokens * (self.cutoff + 1) + sum(v for k,v in per_stage.items() if k is None or k > self.cutoff)
+        # 当前阶段还没有结束，不做压缩
+        for stage in range(self.cutoff + 1,self.player.game.stage):
+            if stage not in per_stage:
+                continue
+            if total <= budget:
+                break
+            total += summary_tokens * (stage - self.cutoff) - per_stage[stage]
+            self.cutoff = stage
+        return self.cutoff
+
+    async def compress(self,messages,stages):
+        """
+        返回实际发送的消息列表：已压缩阶段的消息被替换为一条摘要
+
+        Args:
+            messages (list): 玩家的消息列表
+            stages (list): 每条消息所属的阶段
+
+        Returns:
+            list: 发送给模型的消息列表
+        """
+        if self.cutoff < 0:
+            return messages
+        kept = [m for m, s in zip(messages,stages) if s is None or s > self.cutoff]
+        summary = {"role":"system","content":"此前各阶段的摘要如下：\n" + await self.summary_text()}
+        return kept[:1] + [summary] + kept[1:]
+
+    async def summary_text(self):
+        lines = []
+        for stage in range(self.cutoff + 1):
+            if stage not in self.summaries:
+                self.summaries[stage] = await self.summarize(stage)
+            if self.summaries[stage]:
+                lines.append(f"第{stage//2+1}天{'白天' if (stage+1)%2 else '晚上'}：{self.summaries[stage]}")
+        return "\n".join(lines)
+
+    async def summarize(self,stage):
+        """
+        用摘要模型总结该玩家在某一阶段能看到的全部信息
+
+        Args:
+            stage (int): 阶段
+
+        Returns:
+            str: 摘要，该阶段没有可见信息时返回空字符串
+        """
+        contexts = [i.pub_text() for i in Context.get_store(self.player.game).visible_to(self.player.id) if i.stage == stage]
+        if not contexts:
+            return ""
+        name = self.config().get("summary_model") or self.player.model
+        api = self.player.game.apis[name]
+        client = self.player.client if name == self.player.model else self.player.game.client_for(api,self.player.id)
+        messages = [
+            {"role":"system","content":f"你是狼人杀游戏中{self.player.id}号玩家的记录员。请用简短的语言总结下面这一阶段的信息，保留每名玩家的关键发言、投票、身份声明以及出局情况，不要加入推测。"},
+            {"role":"user","content":"".join(contexts)}
+        ]
+        prompt_tokens = sum(estimate_tokens(i["content"]) for i in messages)
+        policy = RetryPolicy.from_api(api)
+        breaker = get_breaker(api)
+        cassette = self.player.game.cassette
+        replaying = cassette is not None and cassette.mode == "replay"
+        limiter = None if replaying else get_limiter(api)
+        timer = CallTimer()
+        retries = []
+        try:
+            async for attempt in policy.retrying(sleep=not replaying):
+                with attempt:
+                    if retries:
+                        timer.reset()
+                    probe = False
+                    try:
+                        async with asyncio.timeout(policy.turn_timeout):
+                            if limiter is not None:
+                                timer.queued += await limiter.acquire(prompt_tokens if limiter.tpm else 0, self.player.game.id)
+                            probe = breaker.before()
+                            response = await client.chat.completions.create(
+                                model = api["model_name"],
+                                messages = messages,
+                                stream = False,
+                                **sampling(api)
+                            )
+                    except BaseException as e:
+                        if counts_as_failure(e):
+                            breaker.failure()
+                        raise
+                    finally:
+                        breaker.release(probe)
+                    breaker.success()
+                outcome = attempt.retry_state.outcome
+                if outcome is not None and outcome.failed:
+                    retries.append(f"{type(outcome.exception()).__name__}: {outcome.exception()}")
+        except BaseException as e:
+            self.player.game.telemetry.record(self.player,"summary",current_phase.get(),timer,prompt_tokens,0,0,error=e,retries=retries[:-1])
+            raise
+        timer.tick("content")
+        content = response.choices[0].message.content
+        completion = estimate_tokens(content or "")
+        if limiter is not None:
+            limiter.charge(getattr(getattr(response,"usage",None),"completion_tokens",None) or completion)
+        self.player.game.telemetry.record(self.player,"summary",current_phase.get(),timer,prompt_tokens,completion,0,getattr(response,"usage",None),retries=retries)
+        return content
+
+
 class Player:
     def __init__(self,model:str,role:str,id:int,game):
         """
@@ -166,28 +936,107 @@ class Player:
 
         Attributes:
             game: The game context passed during initialization.
-            client: An instance of OpenAI client configured with the player's model.
+            client: The shared AsyncOpenAI client for the player's base_url and api_key (wrapped when the game uses a cassette),
+                None when the player is played by a built-in agent.
+            agent: Produces the player's replies; LLMAgent unless the api config names a built-in agent (see agents.py).
             role (str): The role of the player in the game.
             id (int): The unique identifier of the player.
             model (str): The model identifier used for the player.
             alive (bool): A flag indicating whether the player is currently alive (default is True).
             messages (list): A list of messages associated with the player.
+            message_stages (list): The game stage each message was added in (None for the system prompt).
+            message_tokens (int): Estimated token count of all messages, kept up to date for telemetry.
+            context_offset (int): How many visible contexts have already been sent to the model (incremental mode only).
+            budget (ContextBudget): Compresses older stages into summaries when the model's context budget is exceeded.
             poison (bool): A flag indicating the availability of poison for the witch role (default is False).
             antidote (bool): A flag indicating the availability of antidote for the witch role (default is False).
         """
 
         self.game = game
-        self.client = OpenAI(api_key = game.apis[model]["api_key"], base_url = game.apis[model]["base_url"])
+        api = game.apis[model]
+        if api.get("agent"):
+            self.client = None
+            self.agent = AGENTS[api["agent"]](api,game.agent_seed(model))
+        else:
+            self.client = game.client_for(api,id)
+            self.agent = LLMAgent()
         self.role = role
         self.id = id
         self.model = model
         self.alive = True
         self.messages = []
+        self.message_stages = []
+        self.message_tokens = 0
+        self.context_offset = 0
+        self.budget = ContextBudget(self)
         if self.role == "witch":
             self.poison = False
             self.antidote = False
         game.players.append(self)
 
+    def close(self):
+        """
+        释放玩家对客户端的引用（客户端由连接池共享，不在这里关闭）
+        """
+        self.client = None
+
+    def snapshot(self,since = None):
+        """
+        返回检查点中保存的玩家状态
+
+        Args:
+            since (dict, optional): 已经保存过的消息数和摘要数（{"messages": ..., "summaries": ...}），
+                给出时只返回之后新增的消息和摘要，并记在since中. Defaults to None.
+
+        Returns:
+            dict: 编号、模型、角色、存活状态、女巫的药、消息历史、阶段摘要以及内置代理的状态
+        """
+        state = {
+            "id": self.id,
+            "model": self.model,
+            "role": self.role,
+            "alive": self.alive,
+            "messages": self.messages,
+            "message_stages": self.message_stages,
+            "message_tokens": self.message_tokens,
+            "context_offset": self.context_offset,
+            "summaries": self.budget.summaries,
+            "cutoff": self.budget.cutoff,
+            "agent": self.agent.state() if hasattr(self.agent,"state") else None,
+        }
+        if since is not None:
+            # 消息和摘要只增不改，只需要新增的部分
+            state["since"] = since
+            state["messages"] = self.messages[since["messages"]:]
+            state["message_stages"] = self.message_stages[since["messages"]:]
+            state["summaries"] = dict(itertools.islice(self.budget.summaries.items(),since["summaries"],None))
+        if self.role == "witch":
+            state["poison"] = self.poison
+            state["antidote"] = self.antidote
+        return state
+
+    def restore(self,state):
+        """
+        按检查点恢复玩家状态（代替init_system_prompt），与snapshot对应
+
+        Args:
+            state (dict): snapshot的返回值
+        """
+        self.alive = state["alive"]
+        # 只复制列表本身，消息不会在写入之后被修改，可以与分支的父游戏共享
+        self.messages = list(state["messages"])
+        self.message_stages = list(state["message_stages"])
+        self.message_tokens = state["message_tokens"]
+        self.context_offset = state["context_offset"]
+        # JSON的键都是字符串，摘要按阶段（整数）索引
+        self.budget.summaries = {int(k):v for k,v in state["summaries"].items()}
+        self.budget.cutoff = state["cutoff"]
+        if self.role == "witch":
+            self.poison = state["poison"]
+            self.antidote = state["antidote"]
+        if state.get("agent") is not None and hasattr(self.agent,"restore"):
+            self.agent.restore(state["agent"])
+
     def init_system_prompt(self):
         """
         Initializes the system prompt for a player based on their role and game context.
@@ -213,10 +1062,24 @@ class Player:
             wolfs = self.game.get_players("id",alive=False,role="werewolf")
             pre_instruction += f"\n以下玩家是狼人{str(wolfs)[1:-1]}，是你和你的队友"
         self.messages.append({"role":"system","content":pre_instruction})
+        self.message_stages.append(None)
+        self.message_tokens += estimate_tokens(pre_instruction)
+
+    def get_response(self,prompt,if_pub,before = None):
+        """
+        Synchronous wrapper of aget_response: runs it on the shared LLM runtime loop and waits.
+
+        Parameters:
+            prompt (str): The prompt to be given to the player.
+            if_pub (bool): Whether the response should be public (True) or private (False).
+            before (int, optional): Only show contexts written before this snapshot position.
+        """
+        return runtime.run(self.aget_response(prompt,if_pub,before))
 
-    def get_response(self,prompt,if_pub):
+    async def aget_response(self,prompt,if_pub,before = None):
         """
         Simulates a conversation with the player, given a prompt and whether the response should be public.
+        This is the coroutine behind get_response; it must run on the shared LLM runtime loop.
 
         This method is used to get a response from the player in both the night and day phases of the game.
         When the response should be public, the player is shown all publicly available messages before being asked
@@ -229,6 +1092,9 @@ class Player:
         Parameters:
             prompt (str): The prompt to be given to the player, which is used as the input for the AI model.
             if_pub (bool): Whether the response should be public (True) or private (False).
+            before (int, optional): Snapshot position (a past len() of the game's ContextStore). When given,
+                only contexts written before it are shown, so several players answering concurrently
+                all see the same transcript.
 
         Returns:
             str: The player's response to the prompt.
@@ -237,111 +1103,128 @@ class Player:
             The player's response is appended to the game's context as a new message.
         """
         visible_ids = self.game.get_players("id",alive=False) if if_pub else [self.id,0] + self.game.get_players("id",role=self.role)
-        pub_messages = Context.get_context(self.id,self.game)
         prompt0 = prompt
+        stage = self.game.stage
+        if self.game.incremental_context:
+            # 增量模式：只发送上次发言之后新出现的信息，之前的消息原样保留，
+            # 每轮请求的前缀保持不变，服务端的前缀缓存可以命中
+            new_contexts = Context.get_store(self.game).visible_to(self.id, self.context_offset, before)
+            self.context_offset += len(new_contexts)
+            contexts = [i for i in new_contexts if i.source_id != self.id]
+            intro = "\n新增的玩家发言以及公共信息如下："
+        else:
+            contexts = Context.get_store(self.game).visible_to(self.id, before=before)
+            intro = "\n此前你能得知的玩家发言以及公共信息如下："
+        # 超出上下文预算时，较早的阶段改为发送摘要
+        cutoff = self.budget.update(self.messages,self.message_stages,contexts)
+        if cutoff >= 0 and not self.game.incremental_context:
+            contexts = [i for i in contexts if i.stage > cutoff]
+            intro = "\n此后你能得知的玩家发言以及公共信息如下："
+        pub_messages = [i.pub_text() for i in contexts]
         if if_pub:
-            prompt = f"\n此前你能得知的玩家发言以及公共信息如下：{str(pub_messages)}...注意：你现在在公共发言阶段，你的所有输出会被所有玩家听到，请直接口语化的输出你想表达的信息，不要暴露你的意图。（连括号中的内容也会被看到）" + prompt
+            notice = "...注意：你现在在公共发言阶段，你的所有输出会被所有玩家听到，请直接口语化的输出你想表达的信息，不要暴露你的意图。（连括号中的内容也会被看到）"
         else:
-            prompt = f"\n此前你能得知的玩家发言以及公共信息如下：{str(pub_messages)}...注意：你现在在私聊阶段，你的输出只会被上帝听到。（如果你是狼人，你的聊天还会被同阵营的玩家听到）" + prompt
+            notice = "...注意：你现在在私聊阶段，你的输出只会被上帝听到。（如果你是狼人，你的聊天还会被同阵营的玩家听到）"
+        prompt = f"{intro}{str(pub_messages)}{notice}" + prompt
         self.messages.append({"role":"user","content":prompt})
-        response = self.client.chat.completions.create(
-            model = self.game.apis[self.model]["model_name"],
-            messages = self.messages,
-            stream = True
-        )
-        self.messages[-1]["content"] = prompt0
-
-        # 处理回复
-        if not self.game.webui_mode:
-            collected_messages = ""
-            reasoning_messages = ""
-            reasoning_model = -1 # 判断是否是推理模型，-1待判断，0不是，1是
-            print(f"玩家{self.id}（{self.role}）： ", end="", flush=True)
-            for chunk in response:
-                if reasoning_model == -1:
-                    try:
-                        reasoning_message = chunk.choices[0].delta.reasoning_content
-                        reasoning_messages += reasoning_message
-                        reasoning_model = 1
-                        reasoning = True
+        self.message_stages.append(stage)
+        # 按信息分别估计并缓存token数，不必每次扫描整个提示
+        tokens = sum(i.tokens() for i in contexts) + estimate_tokens(intro + notice + prompt0)
+        self.message_tokens += tokens
+        sent = await self.budget.compress(self.messages,self.message_stages)
+        sent_tokens = self.message_tokens if sent is self.messages else sum(estimate_tokens(i["content"]) for i in sent)
+        timer = CallTimer()
+        usage = None
+        retries = []
+        hedge = None
+        stream = None
+        try:
+            # reply返回的流在开始读取时才发出请求（重试时也会重新发送），这之前sent中必须是完整的提示
+            response = await self.agent.reply(self,prompt0,sent)
+
+            # 处理回复
+            stream = Context(self.game,self.id,"",visible_ids,is_streaming=True)
+            echo = not self.game.webui_mode
+            live = echo and live_echo.get()
+            if live:
+                print(f"玩家{self.id}（{self.role}）： ", end="", flush=True)
+            reasoning = False
+            async for kind, text in response:
+                if kind == "usage":
+                    usage = text
+                    continue
+                if kind == "queue":
+                    timer.queued += text
+                    continue
+                if kind == "hedge":
+                    hedge = text
+                    continue
+                if kind == "retry":
+                    # 请求中途失败，已经收到的片段作废，重新提问
+                    retries.append(text)
+                    stream.reset()
+                    timer.reset()
+                    if live:
+                        print(f"\n（请求失败，重新提问：{text}）")
+                    reasoning = False
+                    continue
+                timer.tick(kind)
+                if kind == "reasoning":
+                    if live and not reasoning:
                         print("思考中...\n", end="", flush=True)
-                        print(reasoning_message, end="", flush=True)
-                    except:
-                        reasoning_model = 0
-                        chunk_message = chunk.choices[0].delta.content
-                        collected_messages += chunk_message
-                        print(chunk_message, end="", flush=True)
-                elif reasoning_model == 1:
-                    reasoning_message = chunk.choices[0].delta.reasoning_content
-                    chunk_message = chunk.choices[0].delta.content
-                    if reasoning_message and reasoning:
-                        reasoning_messages += reasoning_message
-                        print(reasoning_message, end="", flush=True)
-                    elif not reasoning_message and reasoning and chunk_message:
-                        print("\n思考结束...\n")
-                        reasoning = False
-                        collected_messages += chunk_message
-                        print(chunk_message, end="", flush=True)
-                    elif not reasoning:
-                        collected_messages += chunk_message
-                        print(chunk_message, end="", flush=True)
+                    reasoning = True
+                    stream.append_reasoning(text)
                 else:
-                    chunk_message = chunk.choices[0].delta.content
-                    collected_messages += chunk_message
-                    print(chunk_message, end="", flush=True)
-
-            print("")
-            # 加入公共上下文
-            collected_messages = "<think>"+reasoning_messages+"</think>" + collected_messages if reasoning_messages else collected_messages
-            Context(self.game,self.id,collected_messages,visible_ids)
-        else:
-            collected_messages = ""
-            c = lambda content,last_block=False:Context(self.game, self.id,content,visible_ids=visible_ids,is_streaming=True,last_block=last_block)
-            reasoning_model = -1 # 判断是否是推理模型，-1待判断，0不是，1是
-            for chunk in response:
-                if reasoning_model == -1:
-                    try:
-                        reasoning_message = chunk.choices[0].delta.reasoning_content
-                        reasoning_model = 1
-                        reasoning = True
-                        collected_messages += "<think>\n" + reasoning_message
-                        c("<think>\n")
-                        c(reasoning_message)
-                    except:
-                        reasoning_model = 0
-                        chunk_message = chunk.choices[0].delta.content
-                        c(chunk_message)
-                        collected_messages += chunk_message
-                elif reasoning_model == 1:
-                    reasoning_message = chunk.choices[0].delta.reasoning_content
-                    chunk_message = chunk.choices[0].delta.content
-                    if reasoning_message and reasoning:
-                        c(reasoning_message)
-                        collected_messages += reasoning_message
-                    elif not reasoning_message and reasoning and chunk_message:
-                        c("\n</think>\n")
-                        reasoning = False
-                        collected_messages += "\n</think>\n" + chunk_message
-                        c(chunk_message)
-                    elif not reasoning:
-                        collected_messages += chunk_message
-                        c(chunk_message)
-                else:
-                    chunk_message = chunk.choices[0].delta.content
-                    collected_messages += chunk_message
-                    c(chunk_message)
-
-            # 触发前端更新
-            if hasattr(self.game, 'streamlit_log_trigger'):
-                self.game.streamlit_log_trigger.set()
-
-            # 保存完整消息
-            c("",True)
-
+                    if live and reasoning:
+                        print("\n思考结束...\n")
+                    reasoning = False
+                    stream.append(text)
+                if live:
+                    print(text, end="", flush=True)
+            if live:
+                print("")
+        except BaseException as e:
+            self.record_call(timer,sent_tokens,stream,usage,retries,hedge,e)
+            if stream is not None:
+                # 请求中途失败时丢弃没有完成的发言，界面上不会一直留着半截信息
+                stream.discard()
+            raise
+        finally:
+            if not self.game.incremental_context:
+                # 请求结束之后，历史中只保留上帝的提问，下次请求时再附上当时可见的全部信息。
+                # 换成新的消息而不是修改原来的，已经交给reply的sent不受影响
+                self.messages[-1] = {"role":"user","content":prompt0}
+                self.message_tokens += estimate_tokens(prompt0) - tokens
+        self.record_call(timer,sent_tokens,stream,usage,retries,hedge)
+
+        # 保存完整消息，思考过程不进入对话历史
+        stream.finish()
+        if echo and not live:
+            print(f"玩家{self.id}（{self.role}）： {stream.content}")
+        collected_messages = stream.content
 
         self.messages.append({"role":"assistant","content":collected_messages})
+        self.message_stages.append(stage)
+        self.message_tokens += estimate_tokens(collected_messages)
+
+    def record_call(self,timer,prompt_tokens,stream,usage,retries,hedge = None,error = None):
+        """
+        把一次发言请求写入游戏的遥测记录，回复的token数在这里统一估计，不占用流式循环的时间
+        """
+        self.game.telemetry.record(
+            self,"chat",current_phase.get(),timer,prompt_tokens,
+            estimate_tokens(stream.content) if stream is not None else 0,
+            estimate_tokens(stream.reasoning) if stream is not None else 0,
+            usage,error,retries,hedge
+        )
 
     def private_chat(self,source_id,content):
+        """
+        aprivate_chat的同步版本：在大模型事件循环中执行并等待完成
+        """
+        return runtime.run(self.aprivate_chat(source_id,content))
+
+    async def aprivate_chat(self,source_id,content):
         """
         Allows a player to send a private chat message to another player.
 
@@ -354,14 +1237,20 @@ class Player:
             Context(self.game,0,f"{content}",[self.id])
             if not self.game.webui_mode:
                 print(f"上帝：{content}")
-            self.get_response(f"上帝：{content}",False)
+            await self.aget_response(f"上帝：{content}",False)
         else:
             Context(self.game,source_id,f"{content}",[self.id])
             if not self.game.webui_mode:
                 print(f"{source_id}号玩家：{content}")
-            self.get_response(f"{source_id}号玩家：{content}",False)
+            await self.aget_response(f"{source_id}号玩家：{content}",False)
 
     def pub_chat(self,source_id,content,add_to_context = True):
+        """
+        apub_chat的同步版本：在大模型事件循环中执行并等待完成
+        """
+        return runtime.run(self.apub_chat(source_id,content,add_to_context))
+
+    async def apub_chat(self,source_id,content,add_to_context = True):
         """
         Handles public chat messages within the game context.
 
@@ -376,17 +1265,246 @@ class Player:
         """
 
         if source_id == 0:
-            self.get_response(f"上帝：{content}",True)
+            await self.aget_response(f"上帝：{content}",True)
         else:
-            self.get_response(f"{source_id}号玩家：{content}",True)
+            await self.aget_response(f"{source_id}号玩家：{content}",True)
         if add_to_context:
             Context(self.game,source_id,content,self.game.get_player(t="id",alive=False))
 
     def __str__(self):
         return f"玩家{self.id}（{self.role}）"
 
+class NightScheduler:
+    def __init__(self,span = None):
+        """
+        夜晚行动的依赖调度
+
+        每个行动声明它依赖哪些行动，没有依赖关系的行动并发执行，
+        有依赖的行动等依赖全部完成后再开始。整个夜晚的耗时约等于
+        最长的一条依赖链，而不是所有行动耗时之和。
+
+        Args:
+            span (callable, optional): Game.span，开启追踪时每个行动在自己的轨道上记录一段. Defaults to None.
+        """
+        self.actions = {}
+        self.span = span
+
+    def add(self,name,action,depends_on = ()):
+        """
+        添加一个行动
+
+        Args:
+            name (str): 行动名称
+            action (callable): 无参数的协程函数
+            depends_on (iterable, optional): 依赖的行动名称. Defaults to ().
+        """
+        self.actions[name] = (action,tuple(depends_on))
+
+    def order(self):
+        """
+        返回一个满足依赖关系的行动顺序
+
+        Returns:
+            list: 行动名称列表
+
+        Raises:
+            ValueError: 依赖了不存在的行动，或者存在循环依赖
+        """
+        order = []
+        state = {}
+        def visit(name):
+            if name not in self.actions:
+                raise ValueError(f"未知的夜晚行动：{name}")
+            if state.get(name) == 1:
+                raise ValueError(f"夜晚行动存在循环依赖：{name}")
+            if state.get(name) == 2:
+                return
+            state[name] = 1
+            for i in self.actions[name][1]:
+                visit(i)
+            state[name] = 2
+            order.append(name)
+        for name in self.actions:
+            visit(name)
+        return order
+
+    async def run(self):
+        """
+        按依赖关系执行所有行动，并发执行的行动在控制台中整条打印
+        """
+        order = self.order()
+        token = live_echo.set(len(order) <= 1)
+        tasks = {}
+        async def run_one(name):
+            action, depends_on = self.actions[name]
+            if depends_on:
+                await asyncio.gather(*(tasks[i] for i in depends_on))
+            with self.span(name,track=name) if self.span else contextlib.nullcontext():
+                await action()
+        try:
+            for name in order:
+                tasks[name] = asyncio.ensure_future(run_one(name))
+            await asyncio.gather(*tasks.values())
+        finally:
+            live_echo.reset(token)
+
+
+class GameRegistry:
+    def __init__(self, max_finished = 16):
+        """
+        进程内所有游戏的注册表，负责游戏的生命周期
+
+        进行中的游戏保存在active中；结束的游戏会关闭日志处理器和客户端，
+        并按最近使用顺序保留在finished中，方便界面继续展示结果。
+        结束的游戏超过max_finished局时，最久未使用的一局会被彻底释放，
+        它的上下文存储也会从Context.contexts中删除。所有界面会话共用这个上限，
+        仍有会话在展示的游戏（见watch）不会被释放。
+
+        Args:
+            max_finished (int, optional): 最多保留的已结束游戏数. Defaults to 16.
+        """
+        self.max_finished = max_finished
+        self.active = {}
+        self.finished = OrderedDict()
+        self.watchers = {}
+        self.free_loggers = []
+        self.loggers = 0
+        self.lock = Lock()
+
+    def new_id(self):
+        """
+        生成一个未被占用的游戏id（同一时刻创建多局游戏时避免重复）
+
+        Returns:
+            float: 游戏id
+        """
+        with self.lock:
+            game_id = time.time()
+            while game_id in self.active or game_id in self.finished:
+                game_id += 1e-6
+            # 先占位，Game初始化完成后再替换为游戏对象
+            self.active[game_id] = None
+            return game_id
+
+    def logger_name(self):
+        """
+        分配一个游戏日志记录器的名称
+
+        logging会一直保留创建过的记录器，所以名称不使用游戏id，而是在游戏关闭后回收，
+        留给之后的游戏使用，记录器的数量不会超过同时打开的游戏数
+
+        Returns:
+            str: 记录器名称
+        """
+        with self.lock:
+            if self.free_loggers:
+                return self.free_loggers.pop()
+            self.loggers += 1
+            return f"game-{self.loggers}"
+
+    def release_logger(self, name):
+        with self.lock:
+            self.free_loggers.append(name)
+
+    def register(self, game):
+        with self.lock:
+            self.active[game.id] = game
+
+    def watch(self, game):
+        """
+        登记一个正在展示这局游戏的会话，会话持有返回的句柄期间游戏不会因为超出max_finished被释放
+
+        注册表只保存句柄的弱引用，会话结束或者换了一局游戏、句柄被回收之后自动失效。
+
+        Args:
+            game (Game): 游戏对象
+
+        Returns:
+            GameHandle: 句柄，保存在会话的状态中
+        """
+        handle = GameHandle(game)
+        with self.lock:
+            self.watchers.setdefault(game.id, weakref.WeakSet()).add(handle)
+        return handle
+
+    def get(self, game_id):
+        """
+        根据id返回游戏，已结束的游戏会被标记为最近使用
+
+        Args:
+            game_id (float): 游戏id
+
+        Returns:
+            Game: 游戏对象，不存在时返回None
+        """
+        with self.lock:
+            if game_id in self.finished:
+                self.finished.move_to_end(game_id)
+                return self.finished[game_id]
+            return self.active.get(game_id)
+
+    def finish(self, game):
+        """
+        标记游戏结束：关闭日志处理器和客户端，保留上下文以供查看
+
+        Args:
+            game (Game): 游戏对象
+        """
+        game.close()
+        with self.lock:
+            self.active.pop(game.id, None)
+            self.finished[game.id] = game
+            self.finished.move_to_end(game.id)
+            evicted = []
+            # 从最久未使用的开始释放，跳过仍有会话在展示的游戏
+            for game_id in list(self.finished):
+                if len(self.finished) <= self.max_finished:
+                    break
+                if not self.watchers.get(game_id):
+                    evicted.append(self.finished.pop(game_id))
+                    self.watchers.pop(game_id, None)
+        for i in evicted:
+            Context.release(i)
+
+    def close(self, game):
+        """
+        彻底释放一局游戏（无论是否结束），包括它的上下文存储
+
+        Args:
+            game (Game): 游戏对象
+        """
+        game.close()
+        with self.lock:
+            self.active.pop(game.id, None)
+            self.finished.pop(game.id, None)
+            self.watchers.pop(game.id, None)
+        Context.release(game)
+
+    def __len__(self):
+        return len(self.active) + len(self.finished)
+
+
+class GameHandle:
+    def __init__(self, game):
+        """
+        界面会话对一局游戏的引用，见GameRegistry.watch
+
+        Args:
+            game (Game): 游戏对象
+        """
+        self.game = game
+
+
+registry = GameRegistry()
+
+# 已关闭的游戏使用的日志记录器，丢弃所有日志
+closed_logger = logging.getLogger("closed-game")
+closed_logger.addHandler(logging.NullHandler())
+closed_logger.propagate = False
+
+
 class Game:
-    def __init__(self,game_name,players_info_path,apis_path,instructions_path,webui_mode = False,from_dict = False):
+    def __init__(self,game_name,players_info_path,apis_path,instructions_path,webui_mode = False,from_dict = False,incremental_context = False,concurrent_werewolves = False,werewolf_rounds = 2,sealed_votes = False,cassette = None,telemetry = None,tracer = None,checkpoint = None,restore = None,ui_mode = "auto"):
         """
         Initialize a new game instance.
 
@@ -395,6 +1513,21 @@ class Game:
             players_info_path (str): the path to the players info json file
             apis_path (str): the path to the apis json file
             instructions_path (str): the path to the instructions json file
+            incremental_context (bool): append only newly visible contexts to each player's
+                message list instead of resending the whole history every turn
+            concurrent_werewolves (bool): let all werewolves answer each deliberation round at once
+            werewolf_rounds (int): number of werewolf deliberation rounds per night, the last one being the vote
+            sealed_votes (bool): collect all day votes concurrently and reveal them together
+            cassette (cassette.Cassette): record every LLM request and its streamed reply, or replay them instead of calling the API
+            telemetry (telemetry.Telemetry): where per-call latency and token records go; by default they are kept in memory
+                and summarized in the game log when the game is closed
+            tracer (tracing.Tracer): record a Chrome trace timeline of phases, LLM calls and UI refreshes; off by default
+            checkpoint (checkpoint.Checkpoint): save the full game state before every phase so that an interrupted game
+                can be resumed; off by default
+            restore (dict): a saved checkpoint to rebuild the players and the transcript from instead of starting a new game,
+                use Game.from_checkpoint or Game.fork rather than passing it directly
+            ui_mode (str): the webui page the game is played on, "auto" or "manual"; saved in checkpoints
+                so that a resumed game returns to the same page
 
         Attributes:
             game_name (str): the name of the game
@@ -405,28 +1538,59 @@ class Game:
             id (int): the id of the game
             stage (int): the current stage of the game
             kill_tonight (list): the players to be killed tonight
+            agent_seeds (dict): model -> seed drawn for built-in agents whose api config has no seed
+            resume_phase (str): the phase an interrupted game was saved before, None for a new game
         """
         self.game_name = game_name
         self.stage = 0
-        self.id = time.time()
-        self.set_logger()
-
-        if webui_mode and not from_dict:
-            self.instructions = json.loads(instructions_path.decode())
-            self.apis = json.loads(apis_path.decode())
-            self.players_info = json.loads(players_info_path.decode())
-        elif from_dict:
-            self.instructions = instructions_path
-            self.apis = apis_path
-            self.players_info = players_info_path
-        else:
-            self.instructions = read_json(instructions_path)
-            self.apis = read_json(apis_path)
-            self.players_info = read_json(players_info_path)
-        self.players = []
-        self.init_game()
+        self.closed = False
+        self.logger = None
+        self.incremental_context = incremental_context
+        self.concurrent_werewolves = concurrent_werewolves
+        self.werewolf_rounds = max(1,werewolf_rounds)
+        self.sealed_votes = sealed_votes
+        self.ui_mode = ui_mode
+        self.cassette = cassette
+        self.agent_seeds = {}
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.tracer = tracer
+        self.checkpoint = checkpoint
         self.kill_tonight = []
+        self.resume_phase = None
+        self.players = []
+        self.id = registry.new_id()
+        try:
+            self.set_logger()
+
+            if webui_mode and not from_dict:
+                self.instructions = json.loads(instructions_path.decode())
+                self.apis = json.loads(apis_path.decode())
+                self.players_info = json.loads(players_info_path.decode())
+            elif from_dict:
+                self.instructions = instructions_path
+                self.apis = apis_path
+                self.players_info = players_info_path
+            else:
+                self.instructions = read_json(instructions_path)
+                self.apis = read_json(apis_path)
+                self.players_info = read_json(players_info_path)
+            if cassette is not None:
+                cassette.start(self)
+            self.telemetry.start(self)
+            if tracer is not None:
+                tracer.start(self)
+            if checkpoint is not None:
+                checkpoint.start(self)
+            if restore is None:
+                self.init_game()
+            else:
+                self.restore(restore)
+        except BaseException:
+            # 初始化失败（例如api配置中缺少玩家使用的模型）时，释放已经占用的id、日志文件和客户端
+            registry.close(self)
+            raise
         self.webui_mode = webui_mode
+        registry.register(self)
 
     def set_logger(self):
         """
@@ -441,8 +1605,9 @@ class Game:
         Returns:
             None
         """
-        logger = logging.getLogger(str(self.id))
+        logger = logging.getLogger(registry.logger_name())
         logger.setLevel(logging.DEBUG)
+        self.logger = logger
 
         # 创建控制台处理器 (Console Handler)
         ch = logging.StreamHandler()
@@ -472,7 +1637,243 @@ class Game:
         with open(log_file_path, "w", encoding="UTF-8") as f:
             f.write(f"# {self.game_name}\n\n")
 
-        self.logger = logger
+    def close(self):
+        """
+        释放游戏占用的资源：把大模型请求的统计写入日志，关闭并移除日志处理器，关闭玩家的客户端
+
+        上下文存储不会在这里删除，结束后的游戏仍然可以查看聊天记录，
+        由GameRegistry决定何时彻底释放。重复调用是安全的。
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.telemetry.records:
+            self.logger.info("大模型请求统计：\n\n%s\n", format_summary(self.telemetry.summary()))
+        self.telemetry.close()
+        if self.tracer is not None and self.tracer.events:
+            # 没有开始的追踪（初始化失败）不写文件
+            self.tracer.save()
+        if self.logger is not None:
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+                handler.close()
+            # 记录器的名称交还给registry，之后这局游戏的日志直接丢弃，不会写入使用同一名称的新游戏
+            registry.release_logger(self.logger.name)
+            self.logger = closed_logger
+        for i in self.players:
+            i.close()
+        if self.cassette is not None:
+            self.cassette.close()
+
+    def archive(self):
+        """
+        返回这局游戏的精简存档
+
+        Returns:
+            dict: 游戏名称、id、胜方、玩家信息以及完整的聊天记录
+        """
+        return {
+            "game_name": self.game_name,
+            "id": self.id,
+            "stage": self.stage,
+            "winner": self.winner(),
+            "players": [{"id": i.id, "model": i.model, "role": i.role, "alive": i.alive} for i in self.players],
+            "transcript": self.transcript(),
+        }
+
+    def snapshot(self,phase = None,transcript = True,since = None):
+        """
+        返回恢复这局游戏所需的全部状态
+
+        Args:
+            phase (str, optional): 接下来要进行的环节. Defaults to None.
+            transcript (bool, optional): 是否包含聊天记录，分支直接共享上下文存储，不需要. Defaults to True.
+            since (dict, optional): 检查点已经写入的部分（Checkpoint.written），给出时聊天记录、消息历史和摘要
+                只包含之后新增的部分，用于追加增量. Defaults to None.
+
+        Returns:
+            dict: 阶段、环节、游戏选项、配置（去掉api_key）、每名玩家的状态以及完整的聊天记录
+        """
+        state = {
+            "game_name": self.game_name,
+            "id": self.id,
+            "stage": self.stage,
+            "phase": phase,
+            "kill_tonight": self.kill_tonight,
+            "options": {
+                "incremental_context": self.incremental_context,
+                "concurrent_werewolves": self.concurrent_werewolves,
+                "werewolf_rounds": self.werewolf_rounds,
+                "sealed_votes": self.sealed_votes,
+                "ui_mode": self.ui_mode,
+            },
+            "instructions": self.instructions,
+            "players_info": self.players_info,
+            "apis": {k:strip_secrets(v) for k,v in self.apis.items()},
+            "players": [i.snapshot(None if since is None else since["players"].get(i.id,{"messages":0,"summaries":0})) for i in self.players],
+        }
+        if transcript:
+            state["transcript"] = self.transcript(since["transcript"] if since else 0)
+            if since is not None:
+                state["since"] = since["transcript"]
+        return state
+
+    def transcript(self,start = 0):
+        """
+        Args:
+            start (int, optional): 从第几条开始. Defaults to 0.
+
+        Returns:
+            list: 按写入顺序排列的全部信息（阶段、来源、内容、思考过程、可见玩家）
+        """
+        return [
+            {"stage": i.stage, "source_id": i.source_id, "content": i.content, "reasoning": i.reasoning, "visible_ids": sorted(i.visible_ids)}
+            for i in Context.get_store(self).items[start:]
+        ]
+
+    def save_checkpoint(self,phase):
+        """
+        开启检查点时，在环节开始前保存游戏状态
+
+        Args:
+            phase (str): 即将进行的环节
+        """
+        if self.checkpoint is None:
+            return
+        with self.span("checkpoint",phase=phase):
+            self.checkpoint.save(self.snapshot(phase,since=self.checkpoint.written))
+
+    def restore(self,state):
+        """
+        按检查点恢复玩家和聊天记录（代替init_game）
+
+        Args:
+            state (dict): snapshot的返回值；分支（见fork）用parent给出父游戏，直接共享它的聊天记录
+        """
+        for i in state["players"]:
+            Player(i["model"],i["role"],i["id"],self).restore(i)
+        if "parent" in state:
+            Context.share(self,state["parent"])
+        else:
+            for i in state["transcript"]:
+                # 按原来的顺序重新写入，玩家的增量上下文偏移量（context_offset）仍然有效
+                self.stage = i["stage"]
+                Context(self,i["source_id"],i["content"],i["visible_ids"],reasoning=i["reasoning"] or "")
+        self.stage = state["stage"]
+        self.kill_tonight = list(state["kill_tonight"])
+        self.resume_phase = state["phase"]
+        days,morning_dusk = self.get_game_stage()
+        self.logger.info("从%s恢复：第%s天%s，从%s继续，共%s条记录","分支" if "parent" in state else "检查点",
+                         days,'白天' if morning_dusk else '晚上',self.resume_phase,len(Context.get_store(self)))
+
+    def fork(self,game_name = None,phase = None,models = None,seed = None,apis = None,**kwargs):
+        """
+        从当前局面分出一局新游戏（分支），用于比较同一局面下的不同走向，例如换一个随机种子，或者把某名玩家换成另一个模型
+
+        分支与本局共享到目前为止的聊天记录（写时复制，见ContextStore.fork），已有的Context不会被复制；
+        玩家的消息列表只复制引用，消息本身也是共享的。之后双方各自追加，互不影响，本局也可以继续进行。
+        只能在两个环节之间调用。多个分支用play_branches同时进行。
+
+        Args:
+            game_name (str, optional): 分支的名称. Defaults to 本局的名称.
+            phase (str, optional): 分支从哪个环节开始（与检查点中的phase相同），默认沿用resume_phase，
+                从检查点恢复之后直接分出时就是中断的环节. Defaults to None.
+            models (dict, optional): 玩家编号 -> 换用的模型简称，该玩家的消息历史不变，由新的模型接着回答. Defaults to None.
+            seed (int, optional): 写入所有模型配置的seed：内置代理的随机数种子（代理的其它状态保留），
+                以及大模型请求的seed参数. Defaults to None.
+            apis (dict, optional): 补充或替换的api配置，换用的模型不在本局的配置中时在这里给出. Defaults to None.
+            **kwargs: 其它Game参数，例如checkpoint、telemetry、tracer、cassette
+
+        Returns:
+            Game: 分支
+        """
+        apis = {**self.apis,**(apis or {})}
+        if seed is not None:
+            apis = {k:{**v,"seed":seed} for k,v in apis.items()}
+        models = {int(k):v for k,v in (models or {}).items()}
+        players_info = {k:({**v,"model":models[int(k)]} if str(k) != "0" and int(k) in models else v) for k,v in self.players_info.items()}
+        state = self.snapshot(self.resume_phase if phase is None else phase,transcript=False)
+        state["parent"] = self
+        for i in state["players"]:
+            if i["id"] in models:
+                i["model"] = models[i["id"]]
+                i["agent"] = None
+            elif seed is not None and i["agent"] is not None:
+                # 随机数按新的种子重新生成
+                i["agent"] = {k:v for k,v in i["agent"].items() if k != "rng"}
+        return Game(game_name or self.game_name,players_info,apis,self.instructions,webui_mode=self.webui_mode,from_dict=True,
+                    restore=state,**state["options"],**kwargs)
+
+    @classmethod
+    def from_checkpoint(cls,path,apis = None,webui_mode = False,**kwargs):
+        """
+        从检查点文件恢复一局中断的游戏，之后用auto_play从中断的环节继续
+
+        Args:
+            path (str): 检查点文件路径
+            apis (dict, optional): api配置，检查点中不保存api_key，使用大模型的玩家需要在这里重新提供；
+                没有给出的模型沿用检查点中的配置（内置代理不需要api_key）. Defaults to None.
+            webui_mode (bool, optional): 是否在webui中运行. Defaults to False.
+            **kwargs: 其它Game参数，例如checkpoint（传入Checkpoint(path)会继续写同一个文件）、telemetry、tracer、cassette
+
+        Returns:
+            Game: 恢复后的游戏
+        """
+        state = load_checkpoint(path)
+        return cls(state["game_name"],state["players_info"],{**state["apis"],**(apis or {})},state["instructions"],
+                   webui_mode=webui_mode,from_dict=True,restore=state,**state["options"],**kwargs)
+
+    def span(self,name,track = "游戏",**args):
+        """
+        开启追踪时返回记录with块耗时的上下文管理器，否则什么也不做
+
+        Args:
+            name (str): 名称
+            track (str, optional): 轨道名称. Defaults to "游戏".
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name,track,**args)
+
+    def client_for(self,api,player_id):
+        """
+        返回玩家请求大模型时使用的客户端，录制或回放时包装在cassette中
+
+        Args:
+            api (dict): apis配置中的一项
+            player_id (int): 发起请求的玩家编号
+
+        Returns:
+            AsyncOpenAI: 异步客户端（或接口相同的包装）
+        """
+        client = get_client(api)
+        if self.cassette is not None:
+            client = self.cassette.client(client,player_id)
+        return client
+
+    def agent_seed(self,model):
+        """
+        返回内置代理使用的随机种子：api配置中的seed，没有时在这局游戏中为每个模型随机取一个，
+        使用同一模型的玩家（例如狼人队友）得到相同的种子
+
+        Args:
+            model (str): 模型简称
+
+        Returns:
+            int: 随机种子
+        """
+        api = self.apis[model]
+        if "seed" in api:
+            return api["seed"]
+        if model not in self.agent_seeds:
+            self.agent_seeds[model] = random.getrandbits(64)
+        return self.agent_seeds[model]
+
+    def chat_log(self,stage):
+        """
+        返回这局游戏某一阶段的所有信息，见Context.get_chat_log
+        """
+        return Context.get_chat_log(self,stage)
 
     def init_game(self):
         """
@@ -551,6 +1952,14 @@ class Game:
         return players_pending
 
     def werewolf_killing(self):
+        """
+        awerewolf_killing的同步版本：在大模型事件循环中执行并等待完成
+        """
+        self.save_checkpoint("werewolf_killing")
+        with self.span("werewolf_killing"):
+            return runtime.run(self.awerewolf_killing())
+
+    async def awerewolf_killing(self):
         """
         Executes the werewolf killing phase during the night.
 
@@ -562,22 +1971,38 @@ class Game:
         the player's elimination. If no decision is reached, a failure message is
         logged.
 
+        The werewolves talk for `werewolf_rounds` rounds, the last of which is the
+        vote. With `concurrent_werewolves`, every wolf answers each round at the
+        same time against the same snapshot of the wolf channel, so the phase
+        costs one LLM round trip per round instead of one per wolf per round.
+
         The function updates the `kill_tonight` list with the id of the player
         chosen to be killed.
 
         Returns:
             None
         """
+        current_phase.set("werewolf_killing")
 
         players_pending = self.get_players(role="werewolf")
         if not players_pending:
             return
-        content = "今晚你想杀谁？"
-        for i in players_pending:
-            i.private_chat(0,content)
-        content = "请进行杀人投票，杀人投票结果用[]包围，其中只包含编号数字，例如[1]。在此阶段你可以自由发言解释杀人理由。"
-        for i in players_pending:
-            i.private_chat(0,content)
+        # 前werewolf_rounds-1轮自由讨论，最后一轮投票
+        for r in range(self.werewolf_rounds):
+            if r < self.werewolf_rounds - 1:
+                content = "今晚你想杀谁？"
+            else:
+                content = "请进行杀人投票，杀人投票结果用[]包围，其中只包含编号数字，例如[1]。在此阶段你可以自由发言解释杀人理由。"
+            if self.concurrent_werewolves:
+                # 同一轮中所有狼人基于同一份狼人频道快照同时发言
+                for i in players_pending:
+                    Context(self,0,content,[i.id])
+                if not self.webui_mode:
+                    print(f"上帝：{content}")
+                await self.aask_concurrently(players_pending,f"上帝：{content}",False)
+            else:
+                for i in players_pending:
+                    await i.aprivate_chat(0,content)
         result = {i.id:0 for i in self.get_players()}
         for i in players_pending:
             voted = extract_numbers_from_brackets(i.messages[-1]['content'])
@@ -590,7 +2015,78 @@ class Game:
         else:
             Context(self,0,f"击杀失败",self.get_players(t="id",role="werewolf",alive=False))
 
+    async def aask_concurrently(self,players,prompt,if_pub):
+        """
+        让多名玩家同时回答同一个问题
+
+        所有请求都基于调用时的同一份上下文快照，本轮中任何玩家的回复
+        都不会出现在其他玩家的这次请求里。
+
+        Args:
+            players (list): 玩家列表
+            prompt (str): 问题
+            if_pub (bool): 回复是否公开
+        """
+        snapshot = len(Context.get_store(self))
+        token = live_echo.set(False)
+        try:
+            await asyncio.gather(*(i.aget_response(prompt,if_pub,snapshot) for i in players))
+        finally:
+            live_echo.reset(token)
+
+    def night_scheduler(self):
+        """
+        返回夜晚行动的依赖关系：女巫需要知道今晚谁被杀，所以依赖狼人杀人；
+        预言家查验与其它行动无关，可以和狼人同时进行
+
+        Returns:
+            NightScheduler: 夜晚行动调度器
+        """
+        scheduler = NightScheduler(self.span)
+        scheduler.add("werewolf_killing",self.awerewolf_killing)
+        scheduler.add("seer_seeing",self.aseer_seeing)
+        scheduler.add("witch_operation",self.awitch_operation,depends_on=["werewolf_killing"])
+        return scheduler
+
+    def night(self):
+        """
+        anight的同步版本：在大模型事件循环中执行并等待完成
+        """
+        self.save_checkpoint("night")
+        with self.span("night"):
+            return runtime.run(self.anight())
+
+    def resume_night(self,phase = None):
+        """
+        进行夜晚行动，从检查点恢复时只进行尚未完成的部分
+
+        检查点保存在预言家查验或女巫操作之前时（逐个进行夜晚行动），狼人已经杀过人、kill_tonight已经记下，
+        从中断的行动接着进行，不会再杀一次人或者再查验一次；其它情况进行整个夜晚。
+
+        Args:
+            phase (str, optional): 检查点中的环节（resume_phase）. Defaults to None.
+        """
+        actions = ["seer_seeing","witch_operation"]
+        if phase not in actions:
+            return self.night()
+        for i in actions[actions.index(phase):]:
+            getattr(self,i)()
+
+    async def anight(self):
+        """
+        执行整个夜晚的角色行动（狼人杀人、预言家查验、女巫操作）
+        """
+        await self.night_scheduler().run()
+
     def seer_seeing(self):
+        """
+        aseer_seeing的同步版本：在大模型事件循环中执行并等待完成
+        """
+        self.save_checkpoint("seer_seeing")
+        with self.span("seer_seeing"):
+            return runtime.run(self.aseer_seeing())
+
+    async def aseer_seeing(self):
         """
         Now it's the seer's turn to see someone's role.
 
@@ -602,17 +2098,26 @@ class Game:
         Seer -> Server: "[7]号玩家"
         Server -> Seer: "你今晚要查的玩家是7号玩家，他的身份是witch"
         """
+        current_phase.set("seer_seeing")
         seer = self.get_players(role="seer",alive=False)
         if not seer:
             return
         seer = seer[0]
         if not seer.alive:
             return
-        seer.private_chat(0,"你今晚要查谁？要查询的玩家编号请用[]包围，例如'我要查询[7]号玩家'。可以简短的给出理由。")
+        await seer.aprivate_chat(0,"你今晚要查谁？要查询的玩家编号请用[]包围，例如'我要查询[7]号玩家'。可以简短的给出理由。")
         target = extract_numbers_from_brackets(seer.messages[-1]['content'])
-        seer.private_chat(0,f"你今晚要查的玩家是{self.get_players_by_ids(target)[0]}，他的身份是{self.get_players_by_ids(target)[0].role}")
+        await seer.aprivate_chat(0,f"你今晚要查的玩家是{self.get_players_by_ids(target)[0]}，他的身份是{self.get_players_by_ids(target)[0].role}")
 
     def witch_operation(self):
+        """
+        awitch_operation的同步版本：在大模型事件循环中执行并等待完成
+        """
+        self.save_checkpoint("witch_operation")
+        with self.span("witch_operation"):
+            return runtime.run(self.awitch_operation())
+
+    async def awitch_operation(self):
         """
         女巫的操作
         如果今晚有人被杀，女巫可以选择救他或者不救
@@ -621,6 +2126,7 @@ class Game:
         如果女巫选择毒杀，女巫将被标记为毒药
         如果女巫没有毒药，女巫不能毒杀
         """
+        current_phase.set("witch_operation")
         witch = self.get_players(role="witch",alive=False)
         if not witch:
             return
@@ -629,7 +2135,7 @@ class Game:
             return
         if self.kill_tonight:
             if not witch.poison and not witch.antidote:
-                witch.private_chat(0,f"今晚{self.kill_tonight}号玩家被杀了，你可以选择救或者不救，选择结果用[]包围，例如要救{self.kill_tonight[0]}号玩家，请写[{self.kill_tonight[0]}]，不救请写[0]，你可以简短的给出理由。另外，你今晚还有毒药，如果不救，你可以选择毒杀别人，如果不救，是否毒杀将在下一条消息中选择，本次回复无需选择，只需要回答救或者不救这一问题。")
+                await witch.aprivate_chat(0,f"今晚{self.kill_tonight}号玩家被杀了，你可以选择救或者不救，选择结果用[]包围，例如要救{self.kill_tonight[0]}号玩家，请写[{self.kill_tonight[0]}]，不救请写[0]，你可以简短的给出理由。另外，你今晚还有毒药，如果不救，你可以选择毒杀别人，如果不救，是否毒杀将在下一条消息中选择，本次回复无需选择，只需要回答救或者不救这一问题。")
                 voted = extract_numbers_from_brackets(witch.messages[-1]['content'])
                 if voted and int(voted[-1]):
                     witch.antidote = True
@@ -637,7 +2143,7 @@ class Game:
                     self.kill_tonight.remove(int(voted[-1]))
                 else:
                     Context(self,0,f"今晚{self.kill_tonight}号玩家被杀了，你选择了不救他",self.get_players(t="id",alive=False,role="witch"))
-                    witch.private_chat(0,f"你可以选择毒杀别人，选择结果用[]包围，毒杀结果请写在[]中，例如你要杀1号玩家，请写[1]，不毒杀请写[0]。")
+                    await witch.aprivate_chat(0,f"你可以选择毒杀别人，选择结果用[]包围，毒杀结果请写在[]中，例如你要杀1号玩家，请写[1]，不毒杀请写[0]。")
                     voted = extract_numbers_from_brackets(witch.messages[-1]['content'])
                     if int(voted[-1]):
                         witch.poison = True
@@ -646,14 +2152,15 @@ class Game:
                     else:
                         Context(self,0,f"今晚{self.kill_tonight}号玩家被杀了，你选择了不毒杀",self.get_players(t="id",alive=False,role="witch"))
             elif not witch.antidote and witch.poison:
-                witch.private_chat(0,f"今晚{self.kill_tonight}号玩家被杀了，你可以选择救他或者不救，选择结果用[]包围，救请写[1]，不救请写[0]，你可以简短的给出理由。另外，你今晚没有毒药了。")
+                await witch.aprivate_chat(0,f"今晚{self.kill_tonight}号玩家被杀了，你可以选择救他或者不救，选择结果用[]包围，救请写[1]，不救请写[0]，你可以简短的给出理由。另外，你今晚没有毒药了。")
                 voted = extract_numbers_from_brackets(witch.messages[-1]['content'])
                 if voted and int(voted[-1]) == 1:
                     witch.antidote = True
                     Context(self,0,f"今晚{self.kill_tonight}号玩家被杀了，你选择了救他",self.get_players(t="id",alive=False,role="witch"))
-                    self.kill_tonight.remove(int(voted[-1]))
+                    # 这里的[1]表示救，不是玩家编号
+                    self.kill_tonight.clear()
             elif witch.antidote and not witch.poison:
-                witch.private_chat(0,"你可以选择毒杀别人，选择结果用[]包围，毒杀结果请写在[]中，例如你要杀1号玩家，请写[1]，不毒杀请写[0]。")
+                await witch.aprivate_chat(0,"你可以选择毒杀别人，选择结果用[]包围，毒杀结果请写在[]中，例如你要杀1号玩家，请写[1]，不毒杀请写[0]。")
                 voted = extract_numbers_from_brackets(witch.messages[-1]['content'])
                 if int(voted[-1]):
                     witch.poison = True
@@ -665,7 +2172,7 @@ class Game:
                 pass
         else:
             if not witch.poison:
-                witch.private_chat(0,"你可以选择毒杀别人，选择结果用[]包围，毒杀结果请写在[]中，例如你要杀1号玩家，请写[1]，不毒杀请写[0]。")
+                await witch.aprivate_chat(0,"你可以选择毒杀别人，选择结果用[]包围，毒杀结果请写在[]中，例如你要杀1号玩家，请写[1]，不毒杀请写[0]。")
                 voted = extract_numbers_from_brackets(witch.messages[-1]['content'])
                 if int(voted[-1]):
                     witch.poison = True
@@ -677,6 +2184,14 @@ class Game:
                 pass
 
     def public_discussion(self):
+        """
+        apublic_discussion的同步版本：在大模型事件循环中执行并等待完成
+        """
+        self.save_checkpoint("public_discussion")
+        with self.span("public_discussion"):
+            return runtime.run(self.apublic_discussion())
+
+    async def apublic_discussion(self):
         """
         Public discussion process. Sends a message to all players to discuss,
         then collects all the discussion content and shows it to all players.
@@ -686,11 +2201,12 @@ class Game:
         Returns:
             bool: True if a werewolf exploded, False otherwise
         """
+        current_phase.set("public_discussion")
         players_pending = self.get_players()
         content = "请公开讨论，在此阶段你可以简短发言，解释讨论理由。如果你是狼人，可以通过在发言中包含[自爆]来结束白天。"
         Context(self,0,content,self.get_players(t="id",alive=False))
         for i in players_pending:
-            i.pub_chat(0,content,add_to_context=False)
+            await i.apub_chat(0,content,add_to_context=False)
             # 检查是否有狼人自爆
             if "[自爆]" in i.messages[-1]['content'] and i.role == "werewolf":
                 self.broadcast(f"{i.id}号玩家狼人自爆！")
@@ -698,7 +2214,15 @@ class Game:
                 return True
         return False
 
-    def vote(self) -> dict:
+    def vote(self):
+        """
+        avote的同步版本：在大模型事件循环中执行并等待完成
+        """
+        self.save_checkpoint("vote")
+        with self.span("vote"):
+            return runtime.run(self.avote())
+
+    async def avote(self) -> dict:
         """
         Voting process. First, sends a message to all players to vote. Then,
         collects all the votes and returns a dictionary where the keys are the
@@ -706,16 +2230,26 @@ class Game:
         If a werewolf decides to explode during voting, they will be eliminated
         and the day phase will end immediately.
 
+        With `sealed_votes`, every player votes at the same time against the same
+        transcript snapshot, so no voter sees another ballot before casting their
+        own. The ballots are then read in seat order, exactly as in the sequential
+        mode: the first werewolf ballot containing [自爆] ends the day.
+
         Returns:
             dict: A dictionary where the keys are the player ids and the values
                 are the number of votes they got. Returns None if a werewolf exploded.
         """
+        current_phase.set("vote")
         players_pending = self.get_players()
         content = "请投票，投票结果用[]包围，其中只包含编号数字，例如[1]。在此阶段你可以简短发言，解释投票理由。如果你是狼人，可以通过在发言中包含[自爆]来结束白天。"
         Context(self,0,content,self.get_players(t="id",alive=False))
         result = {i.id:0 for i in players_pending}
+        if self.sealed_votes:
+            # 密封投票：所有玩家基于同一份聊天记录同时投票，全部完成后再按座位顺序统一揭晓
+            await self.aask_concurrently(players_pending,f"上帝：{content}",True)
         for i in players_pending:
-            i.pub_chat(0,content,add_to_context=False)
+            if not self.sealed_votes:
+                await i.apub_chat(0,content,add_to_context=False)
             # 检查是否有狼人自爆
             if "[自爆]" in i.messages[-1]['content'] and i.role == "werewolf":
                 self.broadcast(f"{i.id}号玩家狼人自爆！")
@@ -726,6 +2260,21 @@ class Game:
                 result[int(voted[-1])] += 1
         return result
 
+    def vote_out(self):
+        """
+        投票并让得票最多的玩家出局，平票时无人出局，有狼人自爆时自爆的狼人已经出局
+
+        Returns:
+            int: 出局的玩家编号，平票时为0，有狼人自爆时为None
+        """
+        result = self.vote()
+        if result is None:
+            return None
+        out = find_max_key(result)
+        if out:
+            self.out([out])
+        return out
+
     def game_over(self) -> int:
         """
         Determines if the game is over and declares the winner.
@@ -747,14 +2296,24 @@ class Game:
         else:
             return 0
 
+    def winner(self):
+        """
+        返回胜方，但不广播任何信息
+
+        Returns:
+            str: "狼人"或"好人"，游戏未结束时返回None
+        """
+        if len(self.get_players(alive=True)) - 2*len(self.get_players(alive=True,role="werewolf")) < 0:
+            return "狼人"
+        elif len(self.get_players(alive=True,role="werewolf")) == 0:
+            return "好人"
+        return None
+
     def get_winner(self) -> str:
-        if self.game_over():
-            if len(self.get_players(alive=True)) - 2*len(self.get_players(alive=True,role="werewolf")) < 0:
-                Context(self,0,f"游戏结束，狼人获胜",self.get_players(t="id",alive=False))
-                return "狼人"
-            elif len(self.get_players(alive=True,role="werewolf")) == 0:
-                Context(self,0,f"游戏结束，好人获胜",self.get_players(t="id",alive=False))
-                return "好人"
+        winner = self.winner()
+        if winner:
+            Context(self,0,f"游戏结束，{winner}获胜",self.get_players(t="id",alive=False))
+        return winner
 
     def private_chat(self,player_id:int,content:str):
         """
@@ -834,17 +2393,19 @@ class Game:
         it announces that no deaths occurred overnight.
         """
 
-        self.stage += 1
-        days,morning_dusk = self.get_game_stage()
-        self.broadcast(f"现在是第{days}天{'白天' if morning_dusk else '晚上'}")
-        if morning_dusk == 1 and days > 1:
-            if self.kill_tonight:
-                self.kill_tonight = list(set(self.kill_tonight))
-                self.broadcast(f"昨晚{str(self.kill_tonight)[1:-1]}号玩家被杀了")
-                self.out(self.kill_tonight)
-                self.kill_tonight = []
-            else:
-                self.broadcast(f"昨晚是个平安夜，没有人被杀")
+        self.save_checkpoint("day_night_change")
+        with self.span("day_night_change"):
+            self.stage += 1
+            days,morning_dusk = self.get_game_stage()
+            self.broadcast(f"现在是第{days}天{'白天' if morning_dusk else '晚上'}")
+            if morning_dusk == 1 and days > 1:
+                if self.kill_tonight:
+                    self.kill_tonight = list(set(self.kill_tonight))
+                    self.broadcast(f"昨晚{str(self.kill_tonight)[1:-1]}号玩家被杀了")
+                    self.out(self.kill_tonight)
+                    self.kill_tonight = []
+                else:
+                    self.broadcast(f"昨晚是个平安夜，没有人被杀")
 
     def get_game_stage(self):
         """
@@ -880,17 +2441,85 @@ class Game:
         return self.id == value.id
 
 
+def auto_play(game,max_days = None):
+    """
+    全自动进行游戏直到结束：昼夜交替、夜晚行动、昼夜交替、公开讨论、投票出局，平票时无人出局
+
+    从检查点恢复的游戏从中断的环节（game.resume_phase）开始，之后按正常流程进行。
+    夜晚的检查点保存在狼人杀人、预言家查验或女巫操作之前时（手动逐个进行夜晚行动），只进行尚未完成的行动，
+    已经完成的杀人和查验不会再进行一次。
+
+    Args:
+        game (Game): 游戏
+        max_days (int, optional): 天数上限，防止无人出局时无限进行，None表示不限. Defaults to None.
+
+    Returns:
+        str: 胜方，超过天数上限时为None
+    """
+    # 环节 -> 在一天的流程中的位置：0 入夜，1 夜晚行动，2 天亮，3 公开讨论，4 投票
+    step = {
+        "night": 1, "werewolf_killing": 1, "seer_seeing": 1, "witch_operation": 1,
+        "public_discussion": 3, "vote": 4,
+    }.get(game.resume_phase,0)
+    if game.resume_phase == "day_night_change" and game.stage % 2:
+        step = 2
+    resume = game.resume_phase
+    game.resume_phase = None
+    while True:
+        if step == 0:
+            if game.game_over() or (max_days is not None and game.stage >= max_days * 2):
+                break
+            game.day_night_change()
+        elif step == 1:
+            game.resume_night(resume)
+            resume = None
+        elif step == 2:
+            game.day_night_change()
+            if game.game_over():
+                break
+        elif step == 3:
+            if game.public_discussion():
+                # 有狼人自爆，直接进入夜晚
+                step = 0
+                continue
+        else:
+            game.vote_out()
+        step = (step + 1) % 5
+    return game.get_winner()
+
+
+def play_branches(branches,max_days = None):
+    """
+    同时进行多个分支（Game.fork的返回值），直到全部结束
+
+    每个分支在自己的线程中按auto_play的流程进行，所有大模型请求都在共享的事件循环中并发执行，
+    总耗时接近最慢的一个分支，而不是所有分支之和。同一服务商的限流额度由各分支轮流使用。
+
+    Args:
+        branches (list): 分支
+        max_days (int, optional): 天数上限，见auto_play. Defaults to None.
+
+    Returns:
+        list: 每个分支的胜方，顺序与branches相同
+    """
+    with ThreadPoolExecutor(max_workers=max(len(branches),1)) as executor:
+        return list(executor.map(lambda game: auto_play(game,max_days),branches))
+
+
 if __name__ == "__main__":
     # 输入路径配置
     # 控制台运行程序
     instructions_path = "./config/instructions.json"
     apis_path = "./config/apis.json"
     players_info_path = "./config/player_info.json"
-    game_name = input("请输入游戏名称：")
+    resume_path = input("继续中断的游戏请输入检查点文件路径，直接回车开始新游戏：").strip()
+    if resume_path:
+        game = Game.from_checkpoint(resume_path,apis=read_json(apis_path),checkpoint=Checkpoint(resume_path))
+    else:
+        game_name = input("请输入游戏名称：")
+        game = Game(game_name,players_info_path,apis_path,instructions_path,checkpoint=Checkpoint())
     mode = input("请输入游戏模式（1、全自动模式，2、手动模式）：")
 
-    game = Game(game_name,players_info_path,apis_path,instructions_path)
-    
     if mode == "2":
         # 增加手动控制游戏逻辑
         # 手动控制游戏进程
@@ -928,10 +2557,14 @@ if __name__ == "__main__":
                 game.public_discussion()
                 print("公共讨论阶段结束")
             elif cmd == "6":
-                # 投票
-                result = find_max_key(game.vote())
-                game.out([result])
-                print("投票阶段结束")
+                # 投票，平票时无人出局
+                out = game.vote_out()
+                if out is None:
+                    print("有狼人自爆，投票阶段结束")
+                elif out:
+                    print(f"{out}号玩家被投票出局，投票阶段结束")
+                else:
+                    print("平票，无人出局，投票阶段结束")
             elif cmd == "7":
                 # 显示当前状态
                 print(f"\n当前游戏状态:")
@@ -943,7 +2576,7 @@ if __name__ == "__main__":
             elif cmd == "8":
                 # 结束游戏
                 print("游戏已手动结束")
-                exit(0)
+                break
             else:
                 print("无效的命令,请重新输入")
                 
@@ -954,23 +2587,8 @@ if __name__ == "__main__":
     elif mode == "1":
         # 全自动模式
         print("\n游戏开始! 自动控制游戏进程:")
-        # 在全自动模式中
-        while not game.game_over():
-            game.day_night_change()
-            game.werewolf_killing()
-            game.seer_seeing()
-            game.witch_operation()
-            game.day_night_change()
-            if game.game_over():
-                game.get_winner()
-                break
-            # 检查公共讨论阶段是否有自爆
-            if game.public_discussion():
-                continue  # 如果有自爆，直接进入下一个循环（夜晚）
-            # 检查投票阶段是否有自爆
-            result = game.vote()
-            if result is None:  # 有自爆发生
-                continue
-            game.out([find_max_key(result)])
+        # 在全自动模式中，每个环节开始前保存检查点，中断后可以从检查点继续
+        auto_play(game)
     else:
-        print("无效的命令，进程自动退出...")
\ No newline at end of file
+        print("无效的命令，进程自动退出...")
+    registry.finish(game)
\ No newline at end of file
@@ -0,0 +1,259 @@
+"""
+模型评分：根据锦标赛结果计算每个模型、每个模型在每个角色上的等级分
+
+采用 Elo 背后的 Bradley-Terry 模型：一局中狼人阵营获胜的概率为
+    P = sigmoid(阵营优势 + 狼人方平均实力 - 好人方平均实力)
+所有对局一起用牛顿法求极大后验估计（实力带有高斯先验），而不是按对局顺序逐局更新，
+因此结果与对局顺序无关，并且可以从海森矩阵得到置信区间。等级分以所有参赛对象的平均实力为1500。
+
+阵容相同的对局只会占用一行（记录局数和狼人胜局数），锦标赛中阵容数量远少于对局数量，
+所以重新计算十万局也只需要很短时间；新结果到来时只需要累加计数，再从上一次的结果出发迭代一两步。
+
+运行：python ratings.py results/run1.jsonl [--by model|role] [--min-games 10]
+"""
+import argparse
+import json
+import math
+
+import numpy as np
+
+SCALE = 400 / math.log(10)  # 把logit换算成Elo分
+BASE = 1500
+Z95 = 1.959964
+
+
+def load_results(path):
+    """
+    读取 tournament.py 写出的结果文件
+
+    Args:
+        path (str): 结果文件（JSON Lines）
+
+    Returns:
+        list: 对局结果列表
+    """
+    results = []
+    with open(path, encoding="UTF-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                results.append(json.loads(line))
+    return results
+
+
+def model_key(player):
+    return player["model"]
+
+
+def model_role_key(player):
+    return f"{player['model']}/{player['role']}"
+
+
+class RatingTable:
+    def __init__(self, key = model_key, prior_sd = 350, side_prior_sd = 1000):
+        """
+        一组参赛对象（模型或模型+角色）的等级分
+
+        Args:
+            key (callable, optional): 从结果中的玩家信息得到参赛对象名称. Defaults to model_key.
+            prior_sd (float, optional): 实力先验的标准差（Elo分），越小越保守. Defaults to 350.
+            side_prior_sd (float, optional): 阵营优势先验的标准差（Elo分）. Defaults to 1000.
+
+        Attributes:
+            names (list): 参赛对象名称，下标即在实力向量中的位置
+            rows (dict): 阵容 -> [狼人胜局数, 局数]，阵容为((下标, 权重), ...)
+            strength (np.ndarray): 实力（logit），第0项为狼人阵营优势
+        """
+        self.key = key
+        self.prior = 1 / (prior_sd / SCALE) ** 2
+        self.side_prior = 1 / (side_prior_sd / SCALE) ** 2
+        self.names = []
+        self.index = {}
+        self.rows = {}
+        self.games = []
+        self.wins = []
+        self.strength = np.zeros(1)
+        self.covariance = None
+        self.dirty = False
+
+    def entity(self, name):
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+            self.games.append(0)
+            self.wins.append(0)
+        return i
+
+    def add(self, results):
+        """
+        加入新的对局结果，只累加计数，不重新求解
+
+        出错或没有分出胜负的对局会被跳过。
+
+        Args:
+            results (list): tournament.run_game 返回的结果
+
+        Returns:
+            int: 实际加入的局数
+        """
+        added = 0
+        for result in results:
+            if result.get("error") or result.get("winner") not in ("狼人", "好人"):
+                continue
+            teams = {"狼人": [], "好人": []}
+            for player in result["players"]:
+                teams[player["team"]].append(self.entity(self.key(player)))
+            if not teams["狼人"] or not teams["好人"]:
+                continue
+            weights = {}
+            for team, sign in (("狼人", 1), ("好人", -1)):
+                for i in teams[team]:
+                    weights[i] = weights.get(i, 0) + sign / len(teams[team])
+                # 同一对象在一局中占多个座位时只计一局
+                for i in set(teams[team]):
+                    self.games[i] += 1
+                    self.wins[i] += result["winner"] == team
+            lineup = tuple(sorted((i, w) for i, w in weights.items() if w))
+            row = self.rows.setdefault(lineup, [0, 0])
+            row[0] += result["winner"] == "狼人"
+            row[1] += 1
+            added += 1
+        self.dirty = self.dirty or added > 0
+        return added
+
+    def design(self):
+        """
+        Returns:
+            tuple: 阵容矩阵X（第0列为阵营优势）、每行狼人胜局数、每行局数
+        """
+        X = np.zeros((len(self.rows), len(self.names) + 1))
+        X[:, 0] = 1
+        for r, lineup in enumerate(self.rows):
+            for i, w in lineup:
+                X[r, i + 1] = w
+        counts = np.array(list(self.rows.values()), dtype=float).reshape(-1, 2)
+        return X, counts[:, 0], counts[:, 1]
+
+    def fit(self, max_iterations = 50, tol = 1e-8):
+        """
+        用牛顿法求极大后验估计，从上一次的结果出发
+
+        Returns:
+            int: 迭代次数
+        """
+        if not self.rows:
+            return 0
+        X, wolf_wins, games = self.design()
+        strength = np.zeros(X.shape[1])
+        strength[:len(self.strength)] = self.strength
+        prior = np.full(X.shape[1], self.prior)
+        prior[0] = self.side_prior
+        for n in range(1, max_iterations + 1):
+            p = 1 / (1 + np.exp(-(X @ strength)))
+            gradient = X.T @ (wolf_wins - games * p) - prior * strength
+            hessian = (X.T * (games * p * (1 - p))) @ X + np.diag(prior)
+            step = np.linalg.solve(hessian, gradient)
+            strength += step
+            if np.max(np.abs(step)) < tol:
+                break
+        self.strength = strength
+        self.covariance = np.linalg.inv(hessian)
+        self.dirty = False
+        return n
+
+    def update(self, results):
+        """
+        加入新结果并重新求解
+
+        Returns:
+            int: 实际加入的局数
+        """
+        added = self.add(results)
+        if self.dirty:
+            self.fit()
+        return added
+
+    def side_advantage(self):
+        """
+        Returns:
+            tuple: 狼人阵营相对好人阵营的优势（Elo分）及其95%置信区间的半宽
+        """
+        if self.dirty or self.covariance is None:
+            self.fit()
+        if self.covariance is None:
+            return 0.0, float("inf")
+        return self.strength[0] * SCALE, Z95 * math.sqrt(self.covariance[0, 0]) * SCALE
+
+    def leaderboard(self, min_games = 0):
+        """
+        按等级分从高到低排列
+
+        Args:
+            min_games (int, optional): 至少参加的局数. Defaults to 0.
+
+        Returns:
+            list: 每项包含name、rating、low、high、games、wins
+        """
+        if self.dirty or self.covariance is None:
+            self.fit()
+        if self.covariance is None:
+            return []
+        # 实力只有差值有意义，等级分和置信区间都相对于所有参赛对象的平均实力
+        strength = self.strength[1:]
+        covariance = self.covariance[1:, 1:]
+        variance = np.diag(covariance) - 2 * covariance.mean(axis=1) + covariance.mean()
+        ratings = BASE + (strength - strength.mean()) * SCALE
+        margins = Z95 * np.sqrt(np.maximum(variance, 0)) * SCALE
+        board = [
+            {"name": name, "rating": float(ratings[i]), "low": float(ratings[i] - margins[i]), "high": float(ratings[i] + margins[i]),
+             "games": self.games[i], "wins": self.wins[i]}
+            for i, name in enumerate(self.names) if self.games[i] >= min_games
+        ]
+        return sorted(board, key=lambda x: -x["rating"])
+
+
+class Ratings:
+    def __init__(self, **kwargs):
+        """
+        同时维护模型总体等级分和模型在各角色上的等级分
+
+        Args:
+            kwargs: 传给 RatingTable 的参数
+        """
+        self.by_model = RatingTable(model_key, **kwargs)
+        self.by_role = RatingTable(model_role_key, **kwargs)
+
+    def update(self, results):
+        results = list(results)
+        self.by_role.update(results)
+        return self.by_model.update(results)
+
+
+def print_leaderboard(table, title, min_games = 0):
+    advantage, margin = table.side_advantage()
+    print(f"\n## {title}（狼人阵营优势：{advantage:+.0f} ± {margin:.0f}）")
+    print(f"{'名次':>4}  {'名称':<24}{'等级分':>8}  {'95%置信区间':<15}{'局数':>6}{'胜率':>8}")
+    for n, row in enumerate(table.leaderboard(min_games), 1):
+        print(f"{n:>4}  {row['name']:<24}{row['rating']:>8.0f}  [{row['low']:.0f}, {row['high']:.0f}]".ljust(57)
+              + f"{row['games']:>6}{row['wins'] / row['games']:>8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="根据锦标赛结果计算等级分")
+    parser.add_argument("results", nargs="+", help="tournament.py 写出的结果文件")
+    parser.add_argument("--by", choices=["model", "role", "both"], default="both")
+    parser.add_argument("--min-games", type=int, default=0)
+    args = parser.parse_args()
+
+    ratings = Ratings()
+    for path in args.results:
+        ratings.update(load_results(path))
+    if args.by in ("model", "both"):
+        print_leaderboard(ratings.by_model, "模型", args.min_games)
+    if args.by in ("role", "both"):
+        print_leaderboard(ratings.by_role, "模型/角色", args.min_games)
+
+
+if __name__ == "__main__":
+    main()
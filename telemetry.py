@@ -0,0 +1,252 @@
+"""
+大模型请求的遥测
+
+每次请求（玩家发言以及上下文摘要）记录一条：
+- 开始时间、首个片段的延迟（ttft）、思考结束后首个发言片段的延迟（ttfc）、总耗时、生成速度（tokens_per_sec）
+- 提示、回复和思考过程的token数：服务端在流中给出usage时使用实际值，否则用estimate_tokens估计（usage为"estimate"）
+- 模型、玩家、角色、阶段（stage）和游戏环节（phase，例如 vote、werewolf_killing）
+- 重试次数和每次重试的原因（超时、限流、断流、熔断等），最终失败时的错误
+- 在限流器中排队的时间（queue_wait），首个片段的延迟从发起请求算起，包含排队的时间
+- 对冲（hedge）：没有向备用地址发出请求时为None，否则为最终使用的一路（"primary"或"backup"）
+
+流式循环中每个片段只做一次时间判断，token数在请求结束后统一计算，对热路径的影响可以忽略。
+记录保存在内存中，游戏结束时把汇总写入游戏日志；指定路径时同时逐条写入JSONL文件。
+
+汇总多个文件：python telemetry.py telemetry/*.jsonl [--by model phase]
+"""
+import argparse
+import json
+import os
+import time
+
+FIELDS = ("calls", "errors", "retries", "hedged", "hedge_wins", "queue_wait_p50", "queue_wait_p95", "ttft_p50", "ttft_p95", "ttfc_p50",
+          "duration_p50", "duration_p95", "tokens_per_sec", "prompt_tokens", "completion_tokens", "reasoning_tokens")
+
+
+def percentile(values, q):
+    """
+    线性插值的分位数
+
+    Args:
+        values (list): 数值
+        q (float): 0到1之间的分位
+
+    Returns:
+        float: 分位数，values为空时返回None
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+class CallTimer:
+    """一次请求的计时，只在收到首个片段和首个发言片段时读取时钟，queued为在限流器中排队的总时间"""
+    __slots__ = ("wall", "start", "first", "first_content", "queued")
+
+    def __init__(self):
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.first = None
+        self.first_content = None
+        self.queued = 0.0
+
+    def tick(self, kind):
+        if self.first_content is None:
+            now = time.perf_counter()
+            if self.first is None:
+                self.first = now
+            if kind == "content":
+                self.first_content = now
+
+    def reset(self):
+        """重新提问时调用，首个片段的时间从新的一次请求算起（仍然相对于最初的开始时间）"""
+        self.first = None
+        self.first_content = None
+
+
+class Telemetry:
+    def __init__(self, path = None):
+        """
+        一局游戏的请求遥测
+
+        Args:
+            path (str, optional): JSONL文件路径，不指定时只保存在内存中. Defaults to None.
+        """
+        self.path = path
+        self.records = []
+        self.file = None
+        self.game = None
+
+    def start(self, game):
+        self.game = game
+        if self.path:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "a", encoding="UTF-8")
+
+    def record(self, player, kind, phase, timer, prompt_tokens, completion_tokens, reasoning_tokens, usage = None, error = None, retries = (), hedge = None):
+        """
+        记录一次请求
+
+        Args:
+            player (Player): 发起请求的玩家
+            kind (str): "chat"（玩家发言）或"summary"（上下文摘要）
+            phase (str): 游戏环节
+            timer (CallTimer): 本次请求的计时
+            prompt_tokens (int): 估计的提示token数
+            completion_tokens (int): 估计的回复token数（不含思考过程）
+            reasoning_tokens (int): 估计的思考过程token数
+            usage (optional): 服务端返回的usage，有时覆盖估计值. Defaults to None.
+            error (BaseException, optional): 请求出错时的异常. Defaults to None.
+            retries (list, optional): 每次重试的原因. Defaults to ().
+            hedge (str, optional): 对冲时最终使用的一路，"primary"或"backup". Defaults to None.
+
+        Returns:
+            dict: 记录
+        """
+        end = time.perf_counter()
+        source = "estimate"
+        if usage is not None and getattr(usage, "completion_tokens", None) is not None:
+            source = "api"
+            prompt_tokens = usage.prompt_tokens
+            # completion_tokens包含思考过程，服务端没有给出思考部分的用量时沿用估计值
+            details = getattr(usage, "completion_tokens_details", None)
+            if getattr(details, "reasoning_tokens", None) is not None:
+                reasoning_tokens = details.reasoning_tokens
+            completion_tokens = max(usage.completion_tokens - reasoning_tokens, 0)
+        generating = end - timer.first if timer.first is not None else 0
+        api = self.game.apis.get(player.model, {}) if self.game is not None else {}
+        record = {
+            "game_id": getattr(self.game, "id", None),
+            "stage": getattr(self.game, "stage", None),
+            "phase": phase or None,
+            "kind": kind,
+            "player": player.id,
+            "role": player.role,
+            "model": player.model,
+            "model_name": api.get("model_name") or api.get("agent"),
+            "start": round(timer.wall, 3),
+            "ttft": round(timer.first - timer.start, 4) if timer.first is not None else None,
+            "ttfc": round(timer.first_content - timer.start, 4) if timer.first_content is not None else None,
+            "duration": round(end - timer.start, 4),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "reasoning_tokens": reasoning_tokens,
+            "tokens_per_sec": round((completion_tokens + reasoning_tokens) / generating, 2) if generating > 0 else None,
+            "usage": source,
+            "retries": len(retries),
+            "retry_reasons": list(retries),
+            "queue_wait": round(timer.queued, 4),
+            "hedge": hedge,
+            "error": f"{type(error).__name__}: {error}" if error is not None else None,
+        }
+        self.records.append(record)
+        tracer = getattr(self.game, "tracer", None)
+        if tracer is not None:
+            tracer.call(player, record, timer, end)
+        if self.file is not None:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+        return record
+
+    def summary(self, by = ("model",)):
+        return summarize(self.records, by)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def summarize(records, by = ("model",)):
+    """
+    按字段分组汇总请求记录
+
+    Args:
+        records (list): 请求记录
+        by (tuple, optional): 分组字段. Defaults to ("model",).
+
+    Returns:
+        dict: 分组（字段值的元组） -> 汇总数据，分位数只统计成功的请求
+    """
+    groups = {}
+    for i in records:
+        groups.setdefault(tuple(i.get(k) for k in by), []).append(i)
+    result = {}
+    for key, rows in sorted(groups.items(), key=lambda x: tuple(str(k) for k in x[0])):
+        ok = [i for i in rows if not i["error"]]
+        speeds = [i["tokens_per_sec"] for i in ok if i["tokens_per_sec"] is not None]
+        result[key] = {
+            "calls": len(rows),
+            "errors": len(rows) - len(ok),
+            "retries": sum(i.get("retries", 0) for i in rows),
+            "hedged": sum(1 for i in rows if i.get("hedge")),
+            "hedge_wins": sum(1 for i in rows if i.get("hedge") == "backup"),
+            "queue_wait_p50": percentile([i.get("queue_wait", 0) for i in rows], 0.5),
+            "queue_wait_p95": percentile([i.get("queue_wait", 0) for i in rows], 0.95),
+            "ttft_p50": percentile([i["ttft"] for i in ok if i["ttft"] is not None], 0.5),
+            "ttft_p95": percentile([i["ttft"] for i in ok if i["ttft"] is not None], 0.95),
+            "ttfc_p50": percentile([i["ttfc"] for i in ok if i["ttfc"] is not None], 0.5),
+            "duration_p50": percentile([i["duration"] for i in ok], 0.5),
+            "duration_p95": percentile([i["duration"] for i in ok], 0.95),
+            "tokens_per_sec": percentile(speeds, 0.5),
+            "prompt_tokens": sum(i["prompt_tokens"] or 0 for i in rows),
+            "completion_tokens": sum(i["completion_tokens"] or 0 for i in rows),
+            "reasoning_tokens": sum(i["reasoning_tokens"] or 0 for i in rows),
+        }
+    return result
+
+
+def format_summary(summary, by = ("model",)):
+    """
+    把汇总格式化为markdown表格
+
+    Args:
+        summary (dict): summarize的返回值
+        by (tuple, optional): 分组字段. Defaults to ("model",).
+
+    Returns:
+        str: markdown表格
+    """
+    def cell(value):
+        if value is None:
+            return "-"
+        return f"{value:.3f}" if isinstance(value, float) else str(value)
+    lines = ["| " + " | ".join(list(by) + list(FIELDS)) + " |", "|" + "---|" * (len(by) + len(FIELDS))]
+    for key, row in summary.items():
+        lines.append("| " + " | ".join([cell(k) for k in key] + [cell(row[i]) for i in FIELDS]) + " |")
+    return "\n".join(lines)
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path, encoding="UTF-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 写入时被中断的最后一行
+                    continue
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="汇总大模型请求的遥测记录")
+    parser.add_argument("files", nargs="+", help="JSONL遥测文件")
+    parser.add_argument("--by", nargs="+", default=["model"], help="分组字段，例如 model phase role player kind")
+    args = parser.parse_args()
+    records = load_records(args.files)
+    print(f"{len(records)}次请求")
+    print(format_summary(summarize(records, tuple(args.by)), tuple(args.by)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+测试的公共设置
+
+每个测试在单独的临时目录中运行（游戏日志写在./log），创建的游戏在测试结束后交给registry释放。
+HashClient 按请求内容（以及seed参数）决定回复，相同的对话总是得到相同的回复，用于比较恢复、分支等之后的走向。
+"""
+import hashlib
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from main import Game, find_max_key, registry
+
+ROLES = ["werewolf", "werewolf", "villager", "villager", "villager", "witch", "seer", "werewolf"]
+INSTRUCTIONS = {"general": "", "werewolf": "", "villager": "", "witch": "", "seer": ""}
+RULE_APIS = {"mock": {"agent": "rule", "seed": 0}}
+
+
+def players_info():
+    """8名玩家的配置，都使用名为mock的api"""
+    info = {"0": "这是一局有8名玩家的狼人杀游戏"}
+    for i, role in enumerate(ROLES, 1):
+        info[str(i)] = {"role": role, "model": "mock"}
+    return info
+
+
+def llm_apis(base_url = "http://llm.test/v1", **options):
+    """使用大模型的api配置，测试中不会真的发出请求"""
+    return {"mock": {"api_key": "sk-test", "base_url": base_url, "model_name": "mock", **options}}
+
+
+def chunk(content):
+    delta = SimpleNamespace(content=content, reasoning_content=None)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+async def stream_of(*chunks):
+    """与AsyncOpenAI的流式回复一样可以用async for遍历"""
+    for i in chunks:
+        yield i
+
+
+class HashCompletions:
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, model, messages, stream = False, **kwargs):
+        self.requests.append([dict(i) for i in messages])
+        if not stream:
+            message = SimpleNamespace(content="摘要：没有特别的信息", reasoning_content=None)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+        digest = hashlib.sha256(json.dumps([model, messages, kwargs.get("seed")], ensure_ascii=False).encode()).digest()
+        # 女巫的救人/毒人问题回答[0]，其余问题按请求内容选择一名玩家
+        question = messages[-1]["content"].rsplit("上帝：", 1)[-1]
+        target = 0 if "请写[0]" in question else digest[0] % 8 + 1
+        return stream_of(chunk("我认为这个玩家很可疑"), chunk(f"[{target}]"))
+
+
+class HashClient:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=HashCompletions())
+
+
+def use_clients(game):
+    """让每名玩家使用自己的HashClient，返回 玩家编号 -> 客户端"""
+    clients = {}
+    for i in game.players:
+        i.client = clients[i.id] = HashClient()
+    return clients
+
+
+def play(game, days):
+    """按控制台全自动模式的流程进行至多days天"""
+    for _ in range(days):
+        if game.game_over():
+            break
+        game.day_night_change()
+        game.werewolf_killing()
+        game.seer_seeing()
+        game.witch_operation()
+        game.day_night_change()
+        if game.game_over() or game.public_discussion():
+            continue
+        result = game.vote()
+        # 平票时没有人出局
+        if result is not None and find_max_key(result):
+            game.out([find_max_key(result)])
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def games():
+    """记录测试中创建的游戏，结束时统一释放"""
+    created = []
+    yield created
+    for i in created:
+        registry.close(i)
+
+
+@pytest.fixture
+def make_game(games):
+    def make(apis = None, **options):
+        game = Game("test", players_info(), apis or llm_apis(), INSTRUCTIONS, webui_mode=True, from_dict=True, **options)
+        games.append(game)
+        return game
+    return make
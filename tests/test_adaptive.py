@@ -0,0 +1,43 @@
+import random
+
+from conftest import ROLES, players_info
+from tournament import AdaptiveScheduler, team_of
+
+TRUTH = {"weak": -300, "mid": 0, "strong": 300}
+
+
+def play_synthetic(lineup, rng, side = 60):
+    """按已知实力（Elo分）模拟一局，返回与 tournament.run_game 相同格式的结果"""
+    diff = side + TRUTH[lineup["werewolf_model"]] - TRUTH[lineup["good_model"]]
+    winner = "狼人" if rng.random() < 1 / (1 + 10 ** (-diff / 400)) else "好人"
+    players = [{"id": int(seat), "model": player["model"], "role": player["role"], "team": team_of(player["role"])}
+               for seat, player in lineup["players_info"].items() if seat != "0"]
+    return {**{k: lineup[k] for k in ("key", "seed", "werewolf_model", "good_model")}, "winner": winner, "players": players, "error": None}
+
+
+def test_stops_once_every_pair_is_decided():
+    rng = random.Random(0)
+    scheduler = AdaptiveScheduler(list(TRUTH), players_info(), max_games=500)
+    games = 0
+    while not scheduler.done():
+        lineups = scheduler.next_lineups(4)
+        assert lineups
+        for lineup in lineups:
+            assert [lineup["players_info"][str(i)]["role"] for i in range(1, 9)] == ROLES
+            scheduler.record(play_synthetic(lineup, rng))
+            games += 1
+    # 实力差距明显，远在上限之前就能确定，并且高低判断正确
+    assert games < 3 * 500
+    for row in scheduler.status():
+        a, b = row["pair"]
+        assert row["decided"] == "确定"
+        assert (row["diff"] > 0) == (TRUTH[a] > TRUTH[b])
+    assert scheduler.next_lineups(4) == []
+
+
+def test_pending_games_spread_across_pairs():
+    scheduler = AdaptiveScheduler(list(TRUTH), players_info())
+    lineups = scheduler.next_lineups(6)
+    # 同时安排的几局不会集中在同一个阵容上，而是分散到所有模型对和两种阵营分配
+    assert len({(i["werewolf_model"], i["good_model"]) for i in lineups}) == 6
+    assert len({i["key"] for i in lineups}) == 6
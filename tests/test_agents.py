@@ -0,0 +1,20 @@
+from conftest import RULE_APIS, play
+
+
+def test_seeded_rule_games_are_reproducible(make_game):
+    first, second = make_game(RULE_APIS), make_game(RULE_APIS)
+    play(first, 4)
+    play(second, 4)
+    # 两局的游戏id不同，对局只由种子决定
+    assert first.id != second.id
+    assert first.archive()["transcript"] == second.archive()["transcript"]
+
+
+def test_werewolves_share_a_seed_without_one_in_the_config(make_game):
+    game = make_game({"mock": {"agent": "rule"}})
+    wolves = [i for i in game.players if i.role == "werewolf"]
+    assert len({i.agent.seed for i in wolves}) == 1
+    game.day_night_change()
+    game.werewolf_killing()
+    # 狼人队友选择同一个目标，当晚一定有人被杀
+    assert len(game.kill_tonight) == 1
@@ -0,0 +1,48 @@
+import gzip
+
+import pytest
+
+from benchmarks.mock_server import MockConfig, MockServer
+from cassette import Cassette, replay_game
+from conftest import INSTRUCTIONS, llm_apis, players_info
+from main import Game, registry
+from tournament import play
+
+
+def spoken(game):
+    """玩家的发言，按进入聊天记录的先后排列；主持人的提示在狼人同时发言时可能穿插在不同位置"""
+    return [(i["stage"], i["source_id"], i["content"]) for i in game.archive()["transcript"] if i["source_id"]]
+
+
+@pytest.fixture
+def mock_url():
+    server = MockServer(config=MockConfig(ttft=0, tps=0, reply_tokens=8))
+    yield server.start()
+    server.stop()
+
+
+def test_strict_replay_of_a_recorded_game(mock_url, games):
+    cassette = Cassette.record("game.jsonl.gz")
+    game = Game("recorded", players_info(), llm_apis(mock_url), INSTRUCTIONS, webui_mode=True, from_dict=True,
+                concurrent_werewolves=True, cassette=cassette)
+    games.append(game)
+    winner = play(game, 3)
+    speeches = spoken(game)
+    alive = [i.alive for i in game.players]
+    registry.close(game)
+
+    replayed, replay = replay_game("game.jsonl.gz", strict=True, max_days=3)
+    games.append(replayed)
+    assert replay.mismatches == []
+    assert replay.unused() == 0
+    assert spoken(replayed) == speeches
+    assert [i.alive for i in replayed.players] == alive
+    assert replayed.winner() == winner
+
+
+def test_cassette_header_does_not_store_secrets(make_game):
+    apis = llm_apis("http://primary.test/v1", hedge={"base_url": "http://backup.test/v1", "api_key": "sk-backup"})
+    make_game(apis, cassette=Cassette.record("game.jsonl.gz")).cassette.close()
+    with open("game.jsonl.gz", "rb") as f:
+        header = gzip.decompress(f.read())
+    assert b"sk-" not in header and b".test" not in header
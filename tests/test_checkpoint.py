@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+import shutil
+
+import pytest
+
+from checkpoint import Checkpoint, load
+from conftest import RULE_APIS, llm_apis, use_clients
+from main import Game, auto_play
+
+
+class KeepAll(Checkpoint):
+    """保留每一次保存的检查点"""
+    def save(self, state):
+        super().save(state)
+        shutil.copy(self.path, f"saved-{self.saved}.json.gz")
+
+
+def comparable(state):
+    return {k: v for k, v in state.items() if k != "id"}
+
+
+def test_round_trip_restores_every_field(make_game, games):
+    game = make_game(RULE_APIS, checkpoint=Checkpoint("cp.json.gz"))
+    auto_play(game, max_days=2)
+    game.save_checkpoint("vote")
+    assert load("cp.json.gz")["phase"] == "vote"
+    restored = Game.from_checkpoint("cp.json.gz")
+    games.append(restored)
+    assert restored.resume_phase == "vote"
+    assert comparable(restored.snapshot("vote")) == comparable(game.snapshot("vote"))
+    seer = next(i for i in restored.players if i.role == "seer")
+    assert seer.agent.known == next(i for i in game.players if i.role == "seer").agent.known
+
+
+def test_resumed_game_returns_to_its_webui_page(make_game, games):
+    make_game(RULE_APIS, checkpoint=Checkpoint("cp.json.gz"), ui_mode="manual").save_checkpoint("vote")
+    restored = Game.from_checkpoint("cp.json.gz")
+    games.append(restored)
+    assert restored.ui_mode == "manual"
+
+
+def test_checkpoint_does_not_store_api_keys(make_game):
+    apis = llm_apis(hedge={"base_url": "http://backup.test/v1", "api_key": "sk-backup"})
+    make_game(apis, checkpoint=Checkpoint("cp.json.gz")).save_checkpoint("night")
+    with open("cp.json.gz", "rb") as f:
+        assert b"sk-" not in gzip.decompress(f.read())
+
+
+def test_load_rejects_other_files(workdir):
+    (workdir / "other.json").write_text("{}")
+    with pytest.raises(ValueError):
+        load("other.json")
+
+
+def test_resume_from_any_checkpoint_matches_uninterrupted_game(make_game, games):
+    apis = llm_apis(context_budget=1500, summary_tokens=100)
+    game = make_game(apis, checkpoint=KeepAll("cp.json.gz"), incremental_context=True)
+    use_clients(game)
+    winner = auto_play(game, max_days=20)
+    expected = game.transcript()
+    assert game.checkpoint.saved > 5
+    for n in range(1, game.checkpoint.saved + 1):
+        resumed = Game.from_checkpoint(f"saved-{n}.json.gz", apis=apis)
+        games.append(resumed)
+        use_clients(resumed)
+        assert auto_play(resumed, max_days=20) == winner
+        assert resumed.transcript() == expected
+        assert [i.messages for i in resumed.players] == [i.messages for i in game.players]
+
+
+def test_saves_append_only_what_is_new(make_game):
+    game = make_game(RULE_APIS, checkpoint=Checkpoint("cp.json"))
+    auto_play(game, max_days=3)
+    game.save_checkpoint("day_night_change")
+    with open("cp.json", encoding="UTF-8") as f:
+        header, *records = [json.loads(i) for i in f]
+    assert "instructions" in header and all("instructions" not in i for i in records)
+    assert len(records) == game.checkpoint.saved > 5
+    # 每条聊天记录和消息只写入一次
+    assert sum(len(i["transcript"]) for i in records) == len(game.transcript())
+    for player in game.players:
+        saved = [m for i in records for p in i["players"] if p["id"] == player.id for m in p["messages"]]
+        assert len(saved) == len(player.messages)
+
+
+@pytest.mark.parametrize("path", ["cp.json", "cp.json.gz"])
+def test_load_ignores_a_half_written_record(make_game, path):
+    game = make_game(RULE_APIS, checkpoint=Checkpoint(path))
+    game.day_night_change()
+    size = os.path.getsize(path)
+    game.night()
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:size + (len(data) - size) // 2])
+    # 停在上一个检查点
+    state = load(path)
+    assert state["phase"] == "day_night_change" and state["stage"] == 0
+    assert len(state["transcript"]) == 1
+
+
+def test_resume_inside_the_night_does_not_repeat_finished_actions(make_game, games):
+    game = make_game(RULE_APIS, checkpoint=Checkpoint("cp.json.gz"))
+    game.day_night_change()
+    game.werewolf_killing()
+    game.seer_seeing()
+    game.save_checkpoint("witch_operation")
+    resumed = Game.from_checkpoint("cp.json.gz")
+    games.append(resumed)
+    assert resumed.kill_tonight == game.kill_tonight and len(game.kill_tonight) == 1
+    auto_play(resumed, max_days=1)
+    game.witch_operation()
+    game.resume_phase = "day_night_change"
+    auto_play(game, max_days=1)
+    # 狼人没有再杀一次人，预言家也没有再查验一次
+    assert resumed.transcript() == game.transcript()
+    assert [i.messages for i in resumed.players] == [i.messages for i in game.players]
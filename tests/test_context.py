@@ -0,0 +1,79 @@
+import httpx
+import openai
+
+import main
+from conftest import llm_apis, play, use_clients
+from main import Context, ContextBudget
+
+
+def test_incremental_requests_keep_a_stable_prefix(make_game):
+    game = make_game(llm_apis(), incremental_context=True)
+    clients = use_clients(game)
+    play(game, 2)
+    checked = 0
+    for client in clients.values():
+        requests = client.chat.completions.requests
+        checked += max(len(requests) - 1, 0)
+        for previous, current in zip(requests, requests[1:]):
+            # 每次请求都以上一次请求的全部消息开头，服务端的前缀缓存可以命中
+            assert current[:len(previous)] == previous
+            assert len(current) == len(previous) + 2
+    assert checked > 10
+
+
+def test_full_context_request_contains_transcript(make_game):
+    game = make_game(llm_apis())
+    clients = use_clients(game)
+    intro = game.players_info["0"]
+    play(game, 1)
+    requests = [r for c in clients.values() for r in c.chat.completions.requests]
+    assert requests
+    for request in requests:
+        # 发出的最后一条消息带着当时可见的全部信息，而不只是上帝的提问
+        assert "此前你能得知的玩家发言以及公共信息如下" in request[-1]["content"]
+        assert intro in request[-1]["content"]
+    for player in game.players:
+        # 请求结束之后，历史中只保留上帝的提问
+        assert all(intro not in m["content"] for m in player.messages if m["role"] == "user")
+
+
+def test_retry_resends_the_full_prompt(make_game):
+    game = make_game(llm_apis("http://retry.test/v1", backoff=0.001, max_backoff=0.001))
+    clients = use_clients(game)
+    completions = clients[1].chat.completions
+    create = completions.create
+    failed = []
+
+    async def flaky(model, messages, stream = False, **kwargs):
+        completions.requests.append([dict(i) for i in messages])
+        if not failed:
+            failed.append(True)
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://retry.test/v1"))
+        return await create(model, messages, stream, **kwargs)
+    completions.create = flaky
+    game.day_night_change()
+    game.public_discussion()
+    first, retry = completions.requests[:2]
+    assert first == retry
+    assert game.players_info["0"] in retry[-1]["content"]
+
+
+def test_budget_only_counts_new_messages(make_game, monkeypatch):
+    game = make_game(llm_apis(context_budget=1500, summary_tokens=100))
+    use_clients(game)
+    play(game, 2)
+    store = Context.get_store(game)
+    for player in game.players:
+        contexts = store.visible_to(player.id)
+        cutoff = player.budget.update(player.messages, player.message_stages, contexts)
+        # 缓存的各阶段token数与从头统计的结果相同
+        fresh = ContextBudget(player)
+        fresh.update(player.messages, player.message_stages, contexts)
+        assert fresh.stage_tokens == player.budget.stage_tokens
+        # 没有新增的消息和信息时不再估计任何文本
+        calls = []
+        monkeypatch.setattr(main, "estimate_tokens", lambda text: calls.append(text) or 0)
+        assert player.budget.update(player.messages, player.message_stages, contexts) == cutoff
+        assert not calls
+        monkeypatch.undo()
+    assert any(i.budget.cutoff >= 0 for i in game.players)
@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import pytest
+
+from main import Context, ContextStore, SharedList
+
+
+def item(stage, *viewers):
+    return SimpleNamespace(stage=stage, visible_ids={0, *viewers})
+
+
+def test_indexes_follow_append_order():
+    store = ContextStore()
+    a, b, c = item(0, 1, 2), item(0, 2), item(1, 1)
+    for i in (a, b, c):
+        store.append(i)
+    assert [i.seq for i in (a, b, c)] == [0, 1, 2]
+    assert store.of_stage(0) == [a, b]
+    assert store.of_stage(0, 1) == [b]
+    assert store.of_stage(5) == []
+    assert store.visible_to(1) == [a, c]
+    assert store.visible_to(2) == [a, b]
+    assert store.visible_to(0) == [a, b, c]
+    assert store.visible_to(1, start=1) == [c]
+    assert store.count_visible(2) == 2
+    assert len(store) == 3
+
+
+def test_visible_to_before_snapshot():
+    store = ContextStore()
+    a, b = item(0, 1), item(0, 1)
+    store.append(a)
+    snapshot = len(store)
+    store.append(b)
+    assert store.visible_to(1, before=snapshot) == [a]
+    assert store.visible_to(1, before=len(store)) == [a, b]
+
+
+def test_stream_is_hidden_until_committed():
+    store = ContextStore()
+    a, stream, b = item(0, 1), item(0, 1), item(0, 1)
+    store.append(a)
+    store.open_stream(stream)
+    store.append(b)
+    # 界面按阶段实时显示正在输出的信息，玩家在输出完成之前看不到
+    assert store.of_stage(0) == [a, stream, b]
+    assert store.visible_to(1) == [a, b]
+    store.commit_stream(stream)
+    assert store.visible_to(1) == [a, b, stream]
+    assert stream.seq == 2
+
+
+def broken_client():
+    """发出半句话之后断开的客户端"""
+    async def chunks():
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="说到一半"))])
+        raise ConnectionError("断流")
+
+    async def create(**kwargs):
+        return chunks()
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_failed_stream_is_discarded(make_game):
+    game = make_game()
+    player = game.players[0]
+    player.client = broken_client()
+    with pytest.raises(ConnectionError):
+        player.get_response("请发言", True)
+    # 界面上不会留下没有说完的发言
+    assert all(i.content != "说到一半" for i in Context.get_store(game).of_stage(game.stage))
+
+
+def test_context_objects_are_indexed_per_game(make_game):
+    game = make_game()
+    store = Context.get_store(game)
+    before = len(store)
+    Context(game, 0, "只有1号玩家可见", [1])
+    assert len(store) == before + 1
+    assert store.visible_to(1)[-1].content == "只有1号玩家可见"
+    assert all(i.content != "只有1号玩家可见" for i in store.visible_to(2))
+
+
+def test_shared_list_prefix_and_tail():
+    base = list(range(10))
+    a = SharedList(base, 6)
+    a.append("x")
+    b = SharedList(a)
+    b.append("y")
+    assert list(a) == [0, 1, 2, 3, 4, 5, "x"]
+    assert a[2:8] == [2, 3, 4, 5, "x"]
+    assert a[-1] == "x"
+    assert a[::2] == [0, 2, 4, "x"]
+    assert list(b) == [0, 1, 2, 3, 4, 5, "x", "y"]
+    assert b[5:] == [5, "x", "y"]
+    # 共享的部分完全在更早的列表中时直接引用那一层
+    assert SharedList(b, 3).base is base
+    base.append(10)
+    assert len(a) == 7
+
+
+def test_forked_store_isolation():
+    store = ContextStore()
+    a = item(0, 1)
+    store.append(a)
+    fork = store.fork()
+    b, c = item(0, 1), item(1, 1)
+    store.append(b)
+    fork.append(c)
+    assert list(store.items) == [a, b]
+    assert list(fork.items) == [a, c]
+    assert store.visible_to(1) == [a, b]
+    assert fork.visible_to(1) == [a, c]
+    assert fork.of_stage(0) == [a]
+    assert c.seq == 1
+
+
+def test_forked_store_discards_its_own_stream():
+    store = ContextStore()
+    a = item(0, 1)
+    store.append(a)
+    fork = store.fork()
+    stream = item(0, 1)
+    fork.open_stream(stream)
+    fork.discard_stream(stream)
+    assert fork.of_stage(0) == [a]
+    assert store.of_stage(0) == [a]
@@ -0,0 +1,70 @@
+from conftest import RULE_APIS, llm_apis, use_clients
+from main import Context, auto_play, play_branches
+
+
+def paused_game(make_game, **options):
+    """进行到第2天开始之前暂停的游戏"""
+    game = make_game(llm_apis(), **options)
+    use_clients(game)
+    auto_play(game, max_days=1)
+    game.resume_phase = "day_night_change"
+    assert not game.game_over()
+    return game
+
+
+def test_branch_shares_prefix_without_copying(make_game, games):
+    parent = paused_game(make_game)
+    branch = parent.fork()
+    games.append(branch)
+    shared, own = Context.get_store(parent), Context.get_store(branch)
+    assert len(own) == len(shared)
+    assert all(a is b for a, b in zip(own.items, shared.items))
+    for a, b in zip(parent.players, branch.players):
+        assert a.messages == b.messages and a.messages is not b.messages
+        assert all(x is y for x, y in zip(a.messages, b.messages))
+
+
+def test_branch_does_not_touch_parent(make_game, games):
+    parent = paused_game(make_game, incremental_context=True)
+    length = len(Context.get_store(parent))
+    messages = [len(i.messages) for i in parent.players]
+    alive = [i.alive for i in parent.players]
+    branch = parent.fork()
+    grandchild = branch.fork()
+    games.extend([branch, grandchild])
+    use_clients(branch)
+    auto_play(branch, max_days=20)
+    assert len(Context.get_store(parent)) == length
+    assert [len(i.messages) for i in parent.players] == messages
+    assert [i.alive for i in parent.players] == alive
+    assert len(Context.get_store(grandchild)) == length
+    # 父游戏之后的走向与没有改动的分支相同
+    auto_play(parent, max_days=20)
+    assert parent.transcript() == branch.transcript()
+
+
+def test_branches_run_concurrently_with_their_own_changes(make_game, games):
+    parent = paused_game(make_game)
+    other = {"other": {**llm_apis()["mock"], "model_name": "other"}}
+    swapped = parent.get_players("id")[0]
+    branches = [parent.fork(seed=i) for i in range(3)] + [parent.fork(models={swapped: "other"}, apis=other)]
+    games.extend(branches)
+    for i in branches:
+        use_clients(i)
+    winners = play_branches(branches, max_days=20)
+    assert len(winners) == 4
+    assert len({str(i.transcript()) for i in branches[:3]}) > 1
+    swap = branches[-1]
+    assert {r["model"] for r in swap.telemetry.records if r["player"] == swapped} == {"other"}
+    assert swap.players_info[str(swapped)]["model"] == "other"
+
+
+def test_new_seed_reseeds_agents_and_keeps_their_memory(make_game, games):
+    parent = make_game(RULE_APIS)
+    auto_play(parent, max_days=1)
+    parent.resume_phase = "day_night_change"
+    branch = parent.fork(seed=5)
+    games.append(branch)
+    assert {i.agent.seed for i in branch.players} == {5}
+    seer = next(i for i in branch.players if i.role == "seer")
+    assert seer.agent.known == next(i for i in parent.players if i.role == "seer").agent.known
@@ -0,0 +1,151 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+import main
+from conftest import HashClient, llm_apis, use_clients
+from llm_client import CircuitBreaker, CircuitOpenError, RateLimiter, get_breaker, get_latency
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures=3, reset=60)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open" and breaker.trips == 1
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_breaker_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker(failures=1, reset=0.01)
+    breaker.failure()
+    time.sleep(0.02)
+    breaker.before()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+    breaker.success()
+    assert breaker.state == "closed"
+    breaker.before()
+
+
+def test_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker(failures=1, reset=0.01)
+    breaker.failure()
+    time.sleep(0.02)
+    breaker.before()
+    breaker.failure()
+    assert breaker.state == "open" and breaker.trips == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_breaker_released_probe_lets_the_next_request_probe():
+    breaker = CircuitBreaker(failures=1, reset=0.01)
+    breaker.failure()
+    time.sleep(0.02)
+    probe = breaker.before()
+    assert probe
+    # 限流或被取消：既不算成功也不算失败
+    breaker.release(probe)
+    assert breaker.state == "half_open"
+    assert breaker.before()
+    breaker.success()
+    # 已经有结果之后release什么也不做
+    breaker.release(True)
+    assert breaker.state == "closed" and breaker.before() is False
+
+
+def test_breaker_half_open_probe_rate_limited(make_game):
+    game = make_game(llm_apis("http://probe.test/v1", breaker_failures=1, breaker_reset=0.01, backoff=0.001, max_backoff=0.001))
+    breaker = get_breaker(game.apis["mock"])
+    breaker.failure()
+    time.sleep(0.02)
+    clients = use_clients(game)
+    completions = clients[1].chat.completions
+    create = completions.create
+    limited = []
+
+    async def rate_limited(model, messages, stream = False, **kwargs):
+        if not limited:
+            limited.append(True)
+            raise openai.RateLimitError("429", response=httpx.Response(429, request=httpx.Request("POST", "http://probe.test/v1")), body=None)
+        return await create(model, messages, stream, **kwargs)
+    completions.create = rate_limited
+    game.day_night_change()
+    game.public_discussion()
+    # 被限流的试探请求放回了名额，重试的请求继续试探并成功
+    assert limited and breaker.state == "closed"
+
+
+def test_breaker_losing_backup_probe_is_released(make_game, monkeypatch):
+    backup = {"base_url": "http://backup-probe.test/v1", "breaker_failures": 1, "breaker_reset": 0.01, "min_samples": 1, "min_delay": 0.01}
+    game = make_game(llm_apis("http://primary-probe.test/v1", hedge=backup))
+    get_latency(game.apis["mock"]).add(0)
+    backup_breaker = get_breaker({**game.apis["mock"], **backup})
+    backup_breaker.failure()
+    time.sleep(0.02)
+    slow = HashClient()
+    hedged = []
+
+    async def never(model, messages, stream = False, **kwargs):
+        hedged.append(messages)
+        await asyncio.sleep(10)
+    slow.chat.completions.create = never
+    monkeypatch.setattr(main, "get_client", lambda api: slow)
+    for completions in (i.chat.completions for i in use_clients(game).values()):
+        async def delayed(model, messages, stream = False, create = completions.create, **kwargs):
+            await asyncio.sleep(0.05)
+            return await create(model, messages, stream, **kwargs)
+        completions.create = delayed
+    game.day_night_change()
+    game.public_discussion()
+    # 备用请求发出过并且输给了主地址，试探的名额放了回去
+    assert hedged
+    assert backup_breaker.state == "half_open" and backup_breaker.before()
+
+
+def run_requests(limiter, requests):
+    """按顺序发出请求（游戏, token数），返回放行的顺序"""
+    order = []
+
+    async def request(key, tokens):
+        await limiter.acquire(tokens, key)
+        order.append(key)
+
+    async def main():
+        await asyncio.gather(*(request(key, tokens) for key, tokens in requests))
+    asyncio.run(main())
+    return order
+
+
+def test_limiter_passes_requests_while_under_quota():
+    limiter = RateLimiter(rpm=100)
+    assert run_requests(limiter, [("A", 0)] * 5) == ["A"] * 5
+    assert limiter.snapshot()["delayed"] == 0
+
+
+def test_limiter_alternates_between_games():
+    limiter = RateLimiter(rpm=6000)
+    limiter.requests.level = 0
+    order = run_requests(limiter, [("A", 0)] * 5 + [("B", 0)] * 2)
+    # 请求多的一局不会让另一局一直等待
+    assert order == ["A", "B", "A", "B", "A", "A", "A"]
+    stats = limiter.snapshot()
+    assert stats["granted"] == 7 and stats["delayed"] == 7 and stats["queued"] == 0
+
+
+def test_limiter_reserves_tokens():
+    limiter = RateLimiter(tpm=60000)
+    start = time.monotonic()
+    # 桶里一开始有一分钟的额度，第二个请求要等补回1000个token（1秒）
+    run_requests(limiter, [("A", 60000), ("A", 1000)])
+    assert 0.9 < time.monotonic() - start < 2
@@ -0,0 +1,51 @@
+import numpy as np
+
+from conftest import ROLES
+from ratings import BASE, SCALE, RatingTable, model_key
+
+
+def simulate(truth, games, rng, side = 60):
+    """按已知的实力（Elo分）和狼人阵营优势随机生成对局结果，每个座位随机分配模型"""
+    wolves = np.array([i == "werewolf" for i in ROLES])
+    seats = rng.integers(0, len(truth), size=(games, len(ROLES)))
+    diff = truth[seats][:, wolves].mean(axis=1) - truth[seats][:, ~wolves].mean(axis=1)
+    wolf_won = rng.random(games) < 1 / (1 + np.exp(-(side + diff) / SCALE))
+    return [
+        {"winner": "狼人" if won else "好人",
+         "players": [{"model": f"m{m}", "role": role, "team": "狼人" if role == "werewolf" else "好人"} for m, role in zip(row, ROLES)]}
+        for row, won in zip(seats.tolist(), wolf_won.tolist())
+    ]
+
+
+def test_recovers_known_strengths():
+    rng = np.random.default_rng(0)
+    truth = np.array([-200.0, -50.0, 50.0, 200.0])
+    table = RatingTable(model_key)
+    table.update(simulate(truth, 20000, rng))
+    board = {i["name"]: i for i in table.leaderboard()}
+    assert [i["name"] for i in table.leaderboard()] == ["m3", "m2", "m1", "m0"]
+    for m, rating in enumerate(truth + BASE):
+        row = board[f"m{m}"]
+        assert abs(row["rating"] - rating) < 40
+        assert row["low"] < rating < row["high"]
+    advantage, margin = table.side_advantage()
+    assert abs(advantage - 60) < margin
+
+
+def test_incremental_update_matches_a_full_fit():
+    results = simulate(np.array([-100.0, 0.0, 100.0]), 3000, np.random.default_rng(1))
+    full = RatingTable(model_key)
+    full.update(results)
+    incremental = RatingTable(model_key)
+    for start in range(0, len(results), 500):
+        incremental.update(results[start:start + 500])
+    # 结果与对局的顺序和分批方式无关
+    assert np.allclose(full.strength, incremental.strength, atol=1e-6)
+    assert full.rows == incremental.rows
+
+
+def test_errors_and_draws_are_skipped():
+    table = RatingTable(model_key)
+    players = [{"model": "a", "role": "werewolf", "team": "狼人"}, {"model": "b", "role": "villager", "team": "好人"}]
+    assert table.add([{"error": "boom", "winner": None, "players": players}, {"winner": None, "players": players}]) == 0
+    assert table.leaderboard() == []
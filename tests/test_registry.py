@@ -0,0 +1,52 @@
+import gc
+import logging
+
+import pytest
+
+import main
+from conftest import INSTRUCTIONS, players_info
+from main import Context, Game, GameRegistry
+
+
+def test_finished_games_are_evicted_least_recently_used_first(make_game):
+    registry = GameRegistry(max_finished=2)
+    games = [make_game() for _ in range(3)]
+    for game in games:
+        registry.finish(game)
+    assert list(registry.finished) == [games[1].id, games[2].id]
+    assert games[0] not in Context.contexts and games[2] in Context.contexts
+
+
+def test_watched_games_are_not_evicted(make_game):
+    registry = GameRegistry(max_finished=1)
+    watched, *others = [make_game() for _ in range(3)]
+    handle = registry.watch(watched)
+    for game in [watched, *others]:
+        registry.finish(game)
+    # 仍在展示的游戏保留下来，其它游戏照常按上限释放
+    assert list(registry.finished) == [watched.id]
+    assert watched in Context.contexts and all(i not in Context.contexts for i in others)
+    del handle
+    gc.collect()
+    registry.finish(make_game())
+    assert watched.id not in registry.finished and watched not in Context.contexts
+
+
+def test_closed_games_hand_their_logger_to_the_next_game(make_game):
+    first = make_game()
+    name = first.logger.name
+    main.registry.close(first)
+    second = make_game()
+    assert second.logger.name == name
+    assert len(second.logger.handlers) == 2
+    # 关闭之后的日志不会写进新游戏的日志文件
+    assert first.logger is not second.logger
+
+
+def test_failed_construction_releases_everything():
+    active = dict(main.registry.active)
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            Game("test", players_info(), {}, INSTRUCTIONS, webui_mode=True, from_dict=True)
+    assert main.registry.active == active
+    assert all(not logging.getLogger(i).handlers for i in main.registry.free_loggers)
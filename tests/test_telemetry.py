@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import chunk, play, use_clients
+from telemetry import Telemetry, load_records, percentile
+
+
+def test_every_reply_is_recorded(make_game):
+    telemetry = Telemetry("telemetry/game.jsonl")
+    game = make_game(telemetry=telemetry)
+    use_clients(game)
+    play(game, 2)
+    replies = sum(1 for i in game.players for m in i.messages if m["role"] == "assistant")
+    assert len(telemetry.records) == replies
+    summary = telemetry.summary()[("mock",)]
+    assert summary["calls"] == replies and summary["errors"] == 0
+    assert summary["ttft_p50"] is not None
+    assert summary["completion_tokens"] > 0
+    # 逐条写入的文件与内存中的记录一致
+    assert load_records(["telemetry/game.jsonl"]) == telemetry.records
+
+
+def test_failed_call_is_recorded_as_an_error(make_game):
+    async def chunks():
+        yield chunk("说到一半")
+        raise ConnectionError("断流")
+
+    async def create(**kwargs):
+        return chunks()
+
+    game = make_game()
+    player = game.players[0]
+    player.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    with pytest.raises(ConnectionError):
+        player.get_response("请发言", True)
+    (record,) = game.telemetry.records
+    assert record["error"] == "ConnectionError: 断流"
+    assert record["completion_tokens"] > 0
+    assert game.telemetry.summary()[("mock",)]["errors"] == 1
+
+
+def test_percentile_interpolates():
+    assert percentile([4, 1, 3, 2], 0.5) == 2.5
+    assert percentile([1, 2, 3, 4, 5], 0.95) == pytest.approx(4.8)
+    assert percentile([], 0.5) is None
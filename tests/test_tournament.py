@@ -0,0 +1,52 @@
+import json
+
+from conftest import INSTRUCTIONS, ROLES, players_info
+from tournament import build_lineups, finished_keys, rotate_roles, run_tournament
+
+
+def test_lineups_cover_every_pairing_and_seed():
+    lineups = build_lineups(["a", "b", "c"], players_info(), seeds=2)
+    assert len(lineups) == 3 * 2 * 2
+    assert len({i["key"] for i in lineups}) == len(lineups)
+    for lineup in lineups:
+        assert lineup["werewolf_model"] != lineup["good_model"]
+        for seat, role in enumerate(ROLES, 1):
+            player = lineup["players_info"][str(seat)]
+            assert player["role"] == role
+            assert player["model"] == (lineup["werewolf_model"] if role == "werewolf" else lineup["good_model"])
+
+
+def test_rotation_puts_every_role_on_every_seat():
+    template = players_info()
+    for block in range(3):
+        seatings = [rotate_roles(template, seed) for seed in range(block * 8, block * 8 + 8)]
+        for seat in range(1, 9):
+            # 每连续8个种子组成一个拉丁方：每个座位恰好轮到每个位置上的角色一次
+            assert sorted(i[str(seat)]["role"] for i in seatings) == sorted(ROLES)
+        for seating in seatings:
+            assert sorted(seating[str(i)]["role"] for i in range(1, 9)) == sorted(ROLES)
+            assert seating["0"] == template["0"]
+    assert rotate_roles(template, 5) == rotate_roles(template, 5)
+
+
+def test_mirrored_lineups_share_the_seating():
+    lineups = build_lineups(["a", "b"], players_info(), seeds=8, rotate=True)
+    seating = {}
+    for lineup in lineups:
+        roles = [lineup["players_info"][str(i)]["role"] for i in range(1, 9)]
+        assert seating.setdefault(lineup["seed"], roles) == roles
+    assert len({tuple(i) for i in seating.values()}) == 8
+
+
+def test_rerun_skips_finished_games(workdir):
+    lineups = build_lineups(["a", "b"], players_info(), seeds=2)
+    out = workdir / "results" / "run.jsonl"
+    out.parent.mkdir()
+    # 上次运行完成了一局，并在写入下一行时中断
+    out.write_text(json.dumps({"key": lineups[0]["key"], "error": None}) + "\n{\"key\"", encoding="UTF-8")
+    # apis中没有参赛的模型，其余对局都在创建游戏时出错
+    summary = run_tournament(lineups, {}, INSTRUCTIONS, str(out), workers=2)
+    assert summary["skipped"] == 1
+    assert summary["errors"] == len(lineups) - 1 and summary["games"] == 0
+    # 出错的对局不算完成，下次运行时会重新进行
+    assert finished_keys(str(out)) == {lineups[0]["key"]}
@@ -0,0 +1,46 @@
+import json
+
+from conftest import play, use_clients
+from main import registry
+from tracing import Tracer
+
+
+def unmatched(events):
+    """
+    把每个完整事件（ph为X）拆成开始和结束，按轨道检查它们是否成对嵌套，返回不匹配的事件
+
+    时间戳和时长分别取整到0.1微秒，相接的两段允许相差这么多
+    """
+    spans = {}
+    for i in events:
+        if i["ph"] == "X":
+            spans.setdefault(i["tid"], []).append((i["ts"], i["ts"] + i["dur"], i["name"]))
+    bad = []
+    for tid, items in spans.items():
+        stack = []
+        for start, end, name in sorted(items, key=lambda x: (x[0], -x[1])):
+            while stack and stack[-1][1] <= start + 0.2:
+                stack.pop()
+            if stack and end > stack[-1][1] + 0.2:
+                bad.append((tid, name))
+            stack.append((start, end, name))
+    return bad
+
+
+def test_trace_is_a_well_formed_chrome_trace(make_game):
+    game = make_game(tracer=Tracer("trace.json"), concurrent_werewolves=True)
+    use_clients(game)
+    play(game, 2)
+    calls = len(game.telemetry.records)
+    registry.close(game)
+
+    with open("trace.json", encoding="UTF-8") as f:
+        trace = json.load(f)
+    events = trace["traceEvents"]
+    assert {i["ph"] for i in events} == {"M", "X"}
+    assert all(i["dur"] >= 0 for i in events if i["ph"] == "X")
+    assert unmatched(events) == []
+    # 每次大模型请求在玩家的轨道上各有一段，附带遥测记录
+    assert sum(1 for i in events if i.get("cat") == "llm" and "args" in i) == calls
+    tracks = {i["args"]["name"] for i in events if i["name"] == "thread_name"}
+    assert "游戏" in tracks and "1号玩家（werewolf）" in tracks
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import agents
+from conftest import chunk, llm_apis, stream_of
+from main import runtime
+
+
+class BallotCompletions:
+    """后面的座位先投完；1号和8号（狼人）都在投票时自爆"""
+    asked = []
+    running = 0
+    peak = 0
+
+    def __init__(self, player_id):
+        self.player_id = player_id
+
+    async def create(self, model, messages, stream = False, **kwargs):
+        BallotCompletions.asked.append((self.player_id, "".join(i["content"] for i in messages)))
+        BallotCompletions.running += 1
+        BallotCompletions.peak = max(BallotCompletions.peak, BallotCompletions.running)
+        await asyncio.sleep((9 - self.player_id) * 0.01)
+        BallotCompletions.running -= 1
+        return stream_of(chunk(f"选票{self.player_id}：" + ("[自爆]" if self.player_id in (1, 8) else "[3]")))
+
+
+@pytest.fixture
+def ballots():
+    BallotCompletions.asked, BallotCompletions.running, BallotCompletions.peak = [], 0, 0
+
+    def use(game):
+        for i in game.players:
+            i.client = SimpleNamespace(chat=SimpleNamespace(completions=BallotCompletions(i.id)))
+    return use
+
+
+def test_sealed_votes_are_read_in_seat_order(make_game, ballots):
+    game = make_game(llm_apis(), sealed_votes=True)
+    ballots(game)
+    game.stage = 1
+    assert runtime.run(game.avote()) is None
+    # 所有人同时投票，8号最先投完，但按座位顺序揭晓时1号的自爆先生效
+    assert BallotCompletions.peak == 8
+    assert [i.id for i in game.players if not i.alive] == [1]
+    # 每名玩家投票时都看不到同一轮中其他人的选票
+    assert sorted(i for i, _ in BallotCompletions.asked) == list(range(1, 9))
+    for voter, prompt in BallotCompletions.asked:
+        assert not any(f"选票{i}" in prompt for i in range(1, 9) if i != voter)
+
+
+def test_sequential_votes_see_earlier_ballots(make_game, ballots):
+    game = make_game(llm_apis())
+    ballots(game)
+    game.stage = 1
+    assert runtime.run(game.avote()) is None
+    assert BallotCompletions.peak == 1
+    assert [i.id for i in game.players if not i.alive] == [1]
+    assert [i for i, _ in BallotCompletions.asked] == [1]
+
+
+class RingAgent:
+    """每名玩家投给下一个座位，所有人都是一票，形成平票"""
+    def __init__(self, api = None, seed = None):
+        pass
+
+    async def reply(self, player, question, messages):
+        return agents.single(f"[{player.id % 8 + 1}]")
+
+
+def test_vote_out_on_a_tie_eliminates_nobody(make_game, monkeypatch):
+    monkeypatch.setitem(agents.AGENTS, "ring", RingAgent)
+    game = make_game({"mock": {"agent": "ring"}})
+    game.stage = 1
+    assert game.vote_out() == 0
+    assert all(i.alive for i in game.players)
+
+
+def test_vote_out_after_an_explosion(make_game, ballots):
+    game = make_game(llm_apis())
+    ballots(game)
+    game.stage = 1
+    assert game.vote_out() is None
+    assert [i.id for i in game.players if not i.alive] == [1]
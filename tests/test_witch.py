@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+
+from conftest import chunk, stream_of
+
+
+class AnswerCompletions:
+    def __init__(self, answer):
+        self.answer = answer
+
+    async def create(self, model, messages, stream = False, **kwargs):
+        return stream_of(chunk(self.answer))
+
+
+def test_antidote_answer_saves_the_victim(make_game):
+    game = make_game()
+    witch = next(i for i in game.players if i.role == "witch")
+    witch.client = SimpleNamespace(chat=SimpleNamespace(completions=AnswerCompletions("救[1]")))
+    # 毒药已经用过，只问救不救，[1]表示救
+    witch.poison = True
+    game.stage = 1
+    game.kill_tonight = [3]
+    game.witch_operation()
+    assert game.kill_tonight == []
+    assert witch.antidote
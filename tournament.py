@@ -0,0 +1,538 @@
+"""
+无界面锦标赛：按阵容矩阵（模型 × 阵营 × 种子）批量对局
+
+每局游戏在进程池中的一个工作进程里独立运行（各自拥有自己的 Game、事件循环和连接池），
+每结束一局就把结果作为一行 JSON 追加到结果文件中，中途退出后再次运行会跳过已经完成的对局。
+
+加上 --adaptive 时不再按固定矩阵对局，而是由 AdaptiveScheduler 根据已有结果挑选信息量最大的阵容，
+两个模型的实力差距已经可以确定时就不再安排它们对局。
+
+运行：python tournament.py --models qwq deepseek --seeds 5 --workers 8 --out results/run1.jsonl
+     python tournament.py --models qwq deepseek glm --adaptive --workers 8 --out results/run2.jsonl
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+import numpy as np
+
+from agents import AGENTS
+from cassette import Cassette
+from llm_client import pool
+from main import Game, auto_play, read_json, registry
+from ratings import SCALE, RatingTable, load_results
+from telemetry import Telemetry
+from tracing import Tracer
+
+TEAMS = {"werewolf": "狼人"}
+
+
+def team_of(role):
+    """
+    返回角色所属的阵营，与 Game.winner 的返回值一致
+
+    Args:
+        role (str): 角色
+
+    Returns:
+        str: "狼人"或"好人"
+    """
+    return TEAMS.get(role, "好人")
+
+
+def rotate_roles(players_info, seed):
+    """
+    按种子轮换座位上的角色（随机化的循环拉丁方）
+
+    座位决定发言和投票的顺序。把模板中的角色序列循环移动若干位，每连续 n 个种子（n为座位数）
+    组成一个拉丁方：移动的位数取遍 0..n-1，顺序由这一组的序号随机打乱，
+    因此每个角色在每个座位上恰好出现一次。同一个种子总是得到同样的座位安排，
+    所以两个模型交换阵营的镜像对局坐在相同的位置上。
+
+    Args:
+        players_info (dict): 玩家配置模板
+        seed (int): 种子
+
+    Returns:
+        dict: 角色轮换后的玩家配置
+    """
+    seats = sorted((i for i in players_info if str(i) != "0"), key=int)
+    shifts = list(range(len(seats)))
+    random.Random(seed // len(seats)).shuffle(shifts)
+    shift = shifts[seed % len(seats)]
+    info = {"0": players_info["0"]}
+    for n, seat in enumerate(seats):
+        source = players_info[seats[(n + shift) % len(seats)]]
+        info[seat] = {**players_info[seat], "role": source["role"]}
+    return info
+
+
+def build_lineups(models, players_info, seeds = 1, self_play = False, rotate = False):
+    """
+    生成阵容矩阵：每一对（狼人方模型，好人方模型）在每个种子下各对局一次
+
+    同一个种子下A对B和B对A互为镜像：两个模型交换阵营，座位安排相同。
+
+    Args:
+        models (list): 参赛模型简称（apis配置中的主键）
+        players_info (dict): 玩家配置模板，决定座位、角色和游戏说明，其中的模型会被替换
+        seeds (int, optional): 每个阵容重复的局数. Defaults to 1.
+        self_play (bool, optional): 是否包含同一模型对阵自己的阵容. Defaults to False.
+        rotate (bool, optional): 按种子轮换座位上的角色，见 rotate_roles. Defaults to False.
+
+    Returns:
+        list: 阵容列表，每一项包含key、seed、werewolf_model、good_model和players_info
+    """
+    pairs = [(w, g) for w, g in itertools.product(models, models) if self_play or w != g or len(models) == 1]
+    return [make_lineup(wolf_model, good_model, players_info, seed, rotate) for seed in range(seeds) for wolf_model, good_model in pairs]
+
+
+def make_lineup(wolf_model, good_model, players_info, seed, rotate = False):
+    """
+    狼人阵营全部由wolf_model扮演、好人阵营全部由good_model扮演的一局
+
+    Returns:
+        dict: 阵容，包含key、seed、werewolf_model、good_model和players_info
+    """
+    if rotate:
+        players_info = rotate_roles(players_info, seed)
+    info = {"0": players_info["0"]}
+    for seat, player in players_info.items():
+        if str(seat) == "0":
+            continue
+        model = wolf_model if team_of(player["role"]) == "狼人" else good_model
+        info[str(seat)] = {"role": player["role"], "model": model}
+    return {
+        "key": f"{wolf_model}-vs-{good_model}-seed{seed}",
+        "seed": seed,
+        "werewolf_model": wolf_model,
+        "good_model": good_model,
+        "players_info": info,
+    }
+
+
+class AdaptiveScheduler:
+    def __init__(self, models, players_info, z = 2.576, min_games = 4, max_games = 200, rotate = False):
+        """
+        按期望信息增益挑选下一局的阵容，并在两个模型的差距确定后停止安排它们对局
+
+        评分使用 ratings.RatingTable 的后验（实力的均值和协方差）。一局阵容为x的对局能提供的
+        信息量约为 p(1-p)，其中p为预测的狼人胜率；对后验的熵减少 0.5*log(1 + p(1-p) x'Σx)。
+        每次在仍未确定的模型对中挑选熵减少最多的阵容。挑选不需要知道结果，所以已经安排、
+        尚未结束的对局先按上式缩小协方差，同时进行的多局会自然分散到不同的模型对上。
+
+        一对模型的实力差的置信区间不包含0时，就认为二者的高低已经确定（序贯检验），
+        由于会反复查看结果，默认使用99%的置信水平。
+
+        Args:
+            models (list): 参赛模型简称
+            players_info (dict): 玩家配置模板
+            z (float, optional): 置信区间的z值. Defaults to 2.576.
+            min_games (int, optional): 每对模型至少对局的局数，之前不做判断. Defaults to 4.
+            max_games (int, optional): 每对模型最多对局的局数，实力非常接近时在这里停止. Defaults to 200.
+            rotate (bool, optional): 按种子轮换座位上的角色，见 rotate_roles. Defaults to False.
+        """
+        self.models = list(models)
+        self.players_info = players_info
+        self.z = z
+        self.min_games = min_games
+        self.max_games = max_games
+        self.rotate = rotate
+        self.table = RatingTable()
+        for i in self.models:
+            self.table.entity(i)
+        self.pairs = list(itertools.combinations(self.models, 2))
+        self.played = {i: 0 for i in self.pairs}
+        self.counter = {}
+
+    def pair(self, lineup):
+        key = (lineup["werewolf_model"], lineup["good_model"])
+        return key if key in self.played else key[::-1]
+
+    def record(self, result):
+        """
+        记录一局结束的对局（出错的对局不计入）
+        """
+        if result.get("error"):
+            return
+        self.table.add([result])
+        pair = self.pair(result)
+        if pair in self.played:
+            self.played[pair] += 1
+        self.counter[(result["werewolf_model"], result["good_model"])] = max(
+            self.counter.get((result["werewolf_model"], result["good_model"]), 0), result["seed"] + 1)
+
+    def posterior(self):
+        """
+        Returns:
+            tuple: 实力向量和协方差矩阵（logit单位，第0项为阵营优势）
+        """
+        if self.table.dirty:
+            self.table.fit()
+        if self.table.covariance is None:
+            prior = np.full(len(self.models) + 1, 1 / self.table.prior)
+            prior[0] = 1 / self.table.side_prior
+            return np.zeros(len(self.models) + 1), np.diag(prior)
+        return self.table.strength, self.table.covariance
+
+    def row(self, wolf_model, good_model):
+        x = np.zeros(len(self.models) + 1)
+        x[0] = 1
+        x[self.table.index[wolf_model] + 1] += 1
+        x[self.table.index[good_model] + 1] -= 1
+        return x
+
+    def status(self):
+        """
+        每对模型的实力差（Elo分）及其置信区间
+
+        Returns:
+            list: 每项包含pair、games、diff、margin和decided（"确定"、"达到上限"或None）
+        """
+        strength, covariance = self.posterior()
+        rows = []
+        for a, b in self.pairs:
+            i, j = self.table.index[a] + 1, self.table.index[b] + 1
+            diff = (strength[i] - strength[j]) * SCALE
+            margin = self.z * math.sqrt(max(covariance[i, i] + covariance[j, j] - 2 * covariance[i, j], 0)) * SCALE
+            decided = None
+            if self.played[(a, b)] >= self.min_games and abs(diff) > margin:
+                decided = "确定"
+            elif self.played[(a, b)] >= self.max_games:
+                decided = "达到上限"
+            rows.append({"pair": (a, b), "games": self.played[(a, b)], "diff": diff, "margin": margin, "decided": decided})
+        return rows
+
+    def done(self):
+        return all(i["decided"] for i in self.status())
+
+    def next_lineups(self, n, pending = ()):
+        """
+        挑选接下来的n局
+
+        Args:
+            n (int): 局数
+            pending (list, optional): 已经安排但还没有结束的阵容. Defaults to ().
+
+        Returns:
+            list: 阵容，所有模型对都已确定时可能少于n局
+        """
+        strength, covariance = self.posterior()
+        covariance = covariance.copy()
+        scheduled = {i: 0 for i in self.pairs}
+
+        def observe(x):
+            nonlocal covariance
+            p = 1 / (1 + math.exp(-x @ strength))
+            information = p * (1 - p)
+            sx = covariance @ x
+            covariance = covariance - np.outer(sx, sx) * information / (1 + information * x @ sx)
+
+        for lineup in pending:
+            scheduled[self.pair(lineup)] += 1
+            observe(self.row(lineup["werewolf_model"], lineup["good_model"]))
+        active = [i["pair"] for i in self.status() if not i["decided"]]
+        lineups = []
+        for _ in range(n):
+            best, best_gain = None, 0
+            for a, b in active:
+                if self.played[(a, b)] + scheduled[(a, b)] >= self.max_games:
+                    continue
+                for wolf_model, good_model in ((a, b), (b, a)):
+                    x = self.row(wolf_model, good_model)
+                    p = 1 / (1 + math.exp(-x @ strength))
+                    gain = 0.5 * math.log1p(p * (1 - p) * (x @ covariance @ x))
+                    if gain > best_gain:
+                        best, best_gain = (wolf_model, good_model), gain
+            if best is None:
+                break
+            seed = self.counter.get(best, 0)
+            self.counter[best] = seed + 1
+            scheduled[self.pair({"werewolf_model": best[0], "good_model": best[1]})] += 1
+            observe(self.row(*best))
+            lineups.append(make_lineup(best[0], best[1], self.players_info, seed, self.rotate))
+        return lineups
+
+
+def play(game, max_days = 20):
+    """
+    与 main.py 全自动模式相同的流程（main.auto_play），直到游戏结束或超过天数上限
+
+    平票时无人出局。
+
+    Args:
+        game (Game): 游戏
+        max_days (int, optional): 天数上限，防止无人出局时无限进行. Defaults to 20.
+
+    Returns:
+        str: 胜方，超过天数上限时为None
+    """
+    return auto_play(game, max_days)
+
+
+def init_worker(log_dir, workers = 1):
+    """
+    工作进程初始化：日志写入 log_dir/log，关闭控制台日志输出，各进程平分api配置中的rpm和tpm额度
+    """
+    pool.share = 1 / workers
+    os.makedirs(log_dir, exist_ok=True)
+    os.chdir(log_dir)
+    sys.stderr = open(os.devnull, "w")
+
+
+def run_game(lineup, apis, instructions, game_options, max_days = 20, record = False, trace = False):
+    """
+    在工作进程中完整运行一局游戏，每次请求的遥测记录写入日志目录下的 telemetry/<key>.jsonl
+
+    Args:
+        lineup (dict): build_lineups 生成的阵容
+        apis (dict): apis配置
+        instructions (dict): 游戏说明配置
+        game_options (dict): 传给 Game 的其它参数，例如 incremental_context
+        max_days (int, optional): 天数上限. Defaults to 20.
+        record (bool, optional): 把所有请求录制到日志目录下的 cassettes/<key>.jsonl.gz，见 cassette.py. Defaults to False.
+        trace (bool, optional): 把这局的时间线写入日志目录下的 traces/<key>.trace.json，见 tracing.py. Defaults to False.
+
+    Returns:
+        dict: 对局结果，出错时error字段为错误信息
+    """
+    random.seed(lineup["seed"])
+    start = time.time()
+    result = {
+        "key": lineup["key"],
+        "seed": lineup["seed"],
+        "werewolf_model": lineup["werewolf_model"],
+        "good_model": lineup["good_model"],
+        "winner": None,
+        "days": 0,
+        "seconds": 0,
+        "players": [],
+        "error": None,
+    }
+    game = None
+    try:
+        cassette = Cassette.record(f"cassettes/{lineup['key']}.jsonl.gz") if record else None
+        telemetry = Telemetry(f"telemetry/{lineup['key']}.jsonl")
+        tracer = Tracer(f"traces/{lineup['key']}.trace.json") if trace else None
+        game = Game(lineup["key"], lineup["players_info"], apis, instructions, webui_mode=True, from_dict=True,
+                    cassette=cassette, telemetry=telemetry, tracer=tracer, **game_options)
+        result["winner"] = play(game, max_days)
+    except Exception:
+        result["error"] = traceback.format_exc(limit=5)
+    finally:
+        if game is not None:
+            result["game_id"] = game.id
+            result["days"] = game.get_game_stage()[0]
+            result["players"] = [
+                {"id": i.id, "model": i.model, "role": i.role, "team": team_of(i.role), "alive": i.alive}
+                for i in game.players
+            ]
+            registry.finish(game)
+    result["seconds"] = round(time.time() - start, 3)
+    return result
+
+
+def finished_keys(out_path):
+    """
+    读取结果文件中已经成功完成的对局
+
+    Returns:
+        set: 已完成对局的key
+    """
+    keys = set()
+    if not os.path.exists(out_path):
+        return keys
+    with open(out_path, encoding="UTF-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not record.get("error"):
+                keys.add(record["key"])
+    return keys
+
+
+def prepare_output(out_path, log_dir = None):
+    """
+    Returns:
+        tuple: 结果文件和对局日志目录的绝对路径
+    """
+    out_path = os.path.abspath(out_path)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    return out_path, os.path.abspath(log_dir or os.path.dirname(out_path))
+
+
+def record_result(f, result, summary, n, total, start):
+    """
+    把一局的结果写入结果文件，更新汇总信息并打印进度
+    """
+    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    f.flush()
+    if result["error"]:
+        summary["errors"] += 1
+        status = "出错：" + result["error"].strip().splitlines()[-1]
+    else:
+        summary["games"] += 1
+        summary["wins"][result["winner"]] += 1
+        status = f"{result['winner'] or '未分胜负'}，共{result['days']}天"
+    elapsed = time.time() - start
+    print(f"[{n}/{total or '?'}] {result['key']}：{status}，用时{result['seconds']:.1f}秒，"
+          f"当前速度{n / elapsed * 3600:.1f}局/小时", flush=True)
+
+
+def finish_summary(summary, start):
+    summary["seconds"] = round(time.time() - start, 3)
+    summary["games_per_hour"] = round(summary["games"] / summary["seconds"] * 3600, 1) if summary["seconds"] else 0
+    return summary
+
+
+def run_tournament(lineups, apis, instructions, out_path, workers = 4, game_options = None, max_days = 20, log_dir = None, record = False,
+                   trace = False):
+    """
+    用进程池并发运行所有阵容，每结束一局立即写入结果文件
+
+    Args:
+        lineups (list): build_lineups 生成的阵容
+        apis (dict): apis配置
+        instructions (dict): 游戏说明配置
+        out_path (str): 结果文件（JSON Lines），已存在时追加并跳过已完成的对局
+        workers (int, optional): 工作进程数，即同时进行的对局数. Defaults to 4.
+        game_options (dict, optional): 传给 Game 的其它参数. Defaults to None.
+        max_days (int, optional): 天数上限. Defaults to 20.
+        log_dir (str, optional): 对局日志目录，默认为结果文件所在目录.
+        record (bool, optional): 录制每局的所有请求，见 run_game. Defaults to False.
+        trace (bool, optional): 记录每局的时间线，见 run_game. Defaults to False.
+
+    Returns:
+        dict: 汇总信息，包括完成局数、失败局数、耗时和每小时局数
+    """
+    out_path, log_dir = prepare_output(out_path, log_dir)
+    done = finished_keys(out_path)
+    pending = [i for i in lineups if i["key"] not in done]
+    summary = {"games": 0, "errors": 0, "skipped": len(lineups) - len(pending), "wins": {"狼人": 0, "好人": 0, None: 0}}
+    print(f"共{len(lineups)}局，已完成{summary['skipped']}局，本次运行{len(pending)}局，{workers}个工作进程", flush=True)
+
+    start = time.time()
+    with open(out_path, "a", encoding="UTF-8") as f, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(log_dir, workers)) as executor:
+        futures = [executor.submit(run_game, i, apis, instructions, game_options or {}, max_days, record, trace) for i in pending]
+        for n, future in enumerate(as_completed(futures), 1):
+            record_result(f, future.result(), summary, n, len(pending), start)
+    return finish_summary(summary, start)
+
+
+def run_adaptive(scheduler, apis, instructions, out_path, workers = 4, game_options = None, max_days = 20, log_dir = None,
+                 max_total = None, max_errors = 20, record = False, trace = False):
+    """
+    由 AdaptiveScheduler 逐局挑选阵容，直到所有模型对都已确定
+
+    结果文件已存在时，其中的结果会先交给调度器，然后从中断的地方继续。
+
+    Args:
+        scheduler (AdaptiveScheduler): 调度器
+        max_total (int, optional): 本次运行最多进行的局数. Defaults to None.
+        max_errors (int, optional): 出错局数达到这个数时不再安排新的对局. Defaults to 20.
+        其余参数与 run_tournament 相同
+
+    Returns:
+        dict: 汇总信息
+    """
+    out_path, log_dir = prepare_output(out_path, log_dir)
+    previous = load_results(out_path) if os.path.exists(out_path) else []
+    for i in previous:
+        scheduler.record(i)
+    summary = {"games": 0, "errors": 0, "skipped": len(previous), "wins": {"狼人": 0, "好人": 0, None: 0}}
+    print(f"自适应调度，已有{len(previous)}局结果，{workers}个工作进程", flush=True)
+
+    start = time.time()
+    running = {}
+    n = 0
+    with open(out_path, "a", encoding="UTF-8") as f, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(log_dir, workers)) as executor:
+        while True:
+            slots = workers - len(running)
+            if max_total is not None:
+                slots = min(slots, max_total - n - len(running))
+            if slots > 0 and summary["errors"] < max_errors:
+                for lineup in scheduler.next_lineups(slots, list(running.values())):
+                    running[executor.submit(run_game, lineup, apis, instructions, game_options or {}, max_days, record, trace)] = lineup
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                running.pop(future)
+                result = future.result()
+                scheduler.record(result)
+                n += 1
+                record_result(f, result, summary, n, None, start)
+    return finish_summary(summary, start)
+
+
+def print_status(scheduler):
+    print(f"\n{'模型对':<30}{'局数':>6}{'实力差':>8}{'置信区间半宽':>10}  结论")
+    for i in scheduler.status():
+        a, b = i["pair"]
+        print(f"{a + ' vs ' + b:<30}{i['games']:>6}{i['diff']:>+8.0f}{i['margin']:>10.0f}    {i['decided'] or '未确定'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量运行模型对局")
+    parser.add_argument("--models", nargs="+", required=True, help="参赛模型简称，对应apis配置中的主键")
+    parser.add_argument("--seeds", type=int, default=1, help="每个阵容重复的局数")
+    parser.add_argument("--self-play", action="store_true", help="包含同一模型对阵自己的阵容")
+    parser.add_argument("--rotate", action="store_true", help="按种子轮换座位上的角色（拉丁方），镜像对局座位相同")
+    parser.add_argument("--workers", type=int, default=4, help="工作进程数，即同时进行的对局数")
+    parser.add_argument("--max-days", type=int, default=20)
+    parser.add_argument("--out", default="./results/tournament.jsonl")
+    parser.add_argument("--log-dir", default=None, help="对局日志目录，默认为结果文件所在目录")
+    parser.add_argument("--players", default="./config/player_info.json", help="玩家配置模板，决定座位和角色")
+    parser.add_argument("--apis", default="./config/apis.json")
+    parser.add_argument("--instructions", default="./config/instructions.json")
+    parser.add_argument("--incremental-context", action="store_true")
+    parser.add_argument("--concurrent-werewolves", action="store_true")
+    parser.add_argument("--werewolf-rounds", type=int, default=2)
+    parser.add_argument("--sealed-votes", action="store_true")
+    parser.add_argument("--record", action="store_true", help="录制每局的所有请求，可以用 cassette.py 回放")
+    parser.add_argument("--trace", action="store_true", help="记录每局的时间线（Chrome Trace格式），可以用 ui.perfetto.dev 查看")
+    parser.add_argument("--adaptive", action="store_true", help="按信息增益挑选阵容，模型之间的高低确定后停止")
+    parser.add_argument("--max-games", type=int, default=200, help="自适应模式下每对模型最多对局的局数")
+    parser.add_argument("--max-total", type=int, default=None, help="自适应模式下本次运行最多进行的局数")
+    args = parser.parse_args()
+
+    # 内置代理（见 agents.py）不需要配置，可以直接作为参赛模型
+    apis = {name: {"agent": name} for name in AGENTS}
+    if os.path.exists(args.apis):
+        apis.update(read_json(args.apis))
+    unknown = [i for i in args.models if i not in apis]
+    if unknown:
+        parser.error(f"apis配置中没有这些模型：{', '.join(unknown)}")
+    players_info = read_json(args.players)
+    game_options = {
+        "incremental_context": args.incremental_context,
+        "concurrent_werewolves": args.concurrent_werewolves,
+        "werewolf_rounds": args.werewolf_rounds,
+        "sealed_votes": args.sealed_votes,
+    }
+    if args.adaptive:
+        scheduler = AdaptiveScheduler(args.models, players_info, max_games=args.max_games, rotate=args.rotate)
+        summary = run_adaptive(scheduler, apis, read_json(args.instructions), args.out, args.workers, game_options, args.max_days,
+                               args.log_dir, args.max_total, record=args.record, trace=args.trace)
+        print_status(scheduler)
+    else:
+        lineups = build_lineups(args.models, players_info, args.seeds, args.self_play, args.rotate)
+        summary = run_tournament(lineups, apis, read_json(args.instructions), args.out, args.workers, game_options, args.max_days, args.log_dir,
+                                 args.record, args.trace)
+    print(f"\n完成{summary['games']}局，出错{summary['errors']}局，用时{summary['seconds']:.1f}秒，"
+          f"{summary['games_per_hour']}局/小时；狼人胜{summary['wins']['狼人']}局，好人胜{summary['wins']['好人']}局")
+
+
+if __name__ == "__main__":
+    main()
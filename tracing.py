@@ -0,0 +1,129 @@
+"""
+游戏时间线追踪，导出为 Chrome Trace Event 格式（JSON）
+
+用 chrome://tracing 或 https://ui.perfetto.dev 打开导出的文件，可以看到一局游戏的时间都花在哪里：
+- “游戏”轨道：昼夜更替、夜晚以及白天的各个环节
+- 夜晚同时进行的行动（狼人杀人、预言家查验、女巫操作）各占一条轨道
+- 每名玩家一条轨道：该玩家的每次大模型请求，请求内部再分为等待首个片段（其中开头是在限流器中排队的时间）、思考和发言三段
+- “界面”轨道：webui刷新聊天记录的耗时
+
+同一时刻只有一条玩家轨道在忙，说明这一段是串行执行的。
+
+默认不开启，创建游戏时传入 Game(..., tracer=Tracer()) 后，游戏结束（close）时写入 log/<游戏名>-id=<id>.trace.json。
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    def __init__(self, path = None):
+        """
+        一局游戏的时间线
+
+        Args:
+            path (str, optional): 导出的文件路径，不指定时写在游戏日志旁边. Defaults to None.
+        """
+        self.path = path
+        self.origin = time.perf_counter()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def start(self, game):
+        if self.path is None:
+            self.path = f"./log/{game.game_name}-id={game.id}.trace.json"
+        self.events.append({"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": game.game_name}})
+        self.track("游戏")
+
+    def ts(self, t):
+        """perf_counter时间 -> 相对于开始时间的微秒数"""
+        return round((t - self.origin) * 1e6, 1)
+
+    def track(self, name, sort_index = None):
+        """
+        返回轨道编号，第一次出现时按出现顺序分配并写入轨道名称
+
+        Args:
+            name (str): 轨道名称
+            sort_index (int, optional): 显示顺序，默认为出现顺序. Defaults to None.
+        """
+        tid = self.tracks.get(name)
+        if tid is None:
+            with self.lock:
+                tid = self.tracks.get(name)
+                if tid is None:
+                    tid = self.tracks[name] = len(self.tracks)
+                    self.events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}})
+                    self.events.append({"name": "thread_sort_index", "ph": "M", "pid": 1, "tid": tid, "args": {"sort_index": tid if sort_index is None else sort_index}})
+        return tid
+
+    def complete(self, name, track, start, end, cat = "phase", args = None):
+        """
+        记录一段已经结束的时间
+
+        Args:
+            name (str): 名称
+            track (str): 轨道名称
+            start (float): 开始时间（perf_counter）
+            end (float): 结束时间（perf_counter）
+            cat (str, optional): 分类. Defaults to "phase".
+            args (dict, optional): 附加信息. Defaults to None.
+        """
+        event = {"name": name, "cat": cat, "ph": "X", "pid": 1, "tid": self.track(track),
+                 "ts": self.ts(start), "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, track = "游戏", cat = "phase", **args):
+        """
+        记录with块执行的时间，同一轨道上时间范围相互包含的段会显示为嵌套
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, track, start, time.perf_counter(), cat, args)
+
+    def call(self, player, record, timer, end):
+        """
+        在玩家的轨道上记录一次大模型请求及其内部的等待、思考和发言三段
+
+        Args:
+            player (Player): 发起请求的玩家
+            record (dict): 遥测记录，作为附加信息
+            timer (telemetry.CallTimer): 本次请求的计时
+            end (float): 结束时间（perf_counter）
+        """
+        track = f"{player.id}号玩家（{player.role}）"
+        # 玩家轨道按编号排在环节轨道之后
+        self.track(track, 1000 + player.id)
+        self.complete(record["phase"] or record["kind"], track, timer.start, end, "llm", record)
+        first = timer.first if timer.first is not None else end
+        content = timer.first_content if timer.first_content is not None else end
+        self.complete("等待首个片段", track, timer.start, first, "llm")
+        if timer.queued:
+            # 排队可能分散在几次重试之前，这里合在一起画在开头
+            self.complete("排队", track, timer.start, min(timer.start + timer.queued, first), "llm")
+        if content > first:
+            self.complete("思考", track, first, content, "llm")
+        if timer.first_content is not None:
+            self.complete("发言", track, content, end, "llm")
+
+    def save(self, path = None):
+        """
+        写入Chrome Trace Event格式的JSON文件
+
+        Returns:
+            str: 文件路径
+        """
+        path = path or self.path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="UTF-8") as f:
+            json.dump({"traceEvents": list(self.events), "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return path
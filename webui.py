@@ -1,6 +1,11 @@
 import streamlit as st
-from main import Game, Context, find_max_key, read_json
+from main import Game, Context, read_json, registry
+from tracing import Tracer
+from checkpoint import Checkpoint
+from llm_client import limiter_stats
 import time
+import glob
+import os
 from threading import Thread, Lock, Event
 from queue import Queue
 import json
@@ -39,6 +44,8 @@ def init_session_state():
         st.session_state.current_page = 'config'
     if 'game' not in st.session_state:
         st.session_state.game = None
+    if 'game_handle' not in st.session_state:
+        st.session_state.game_handle = None
     if 'initialized' not in st.session_state:
         st.session_state.initialized = False
     if 'game_lock' not in st.session_state:
@@ -226,6 +233,33 @@ def config_page():
                     st.error(f"配置导入失败: {str(e)}")
 
 
+        # 从检查点继续中断的游戏
+        with st.expander("♻️ 继续中断的游戏", expanded=False):
+            checkpoints = sorted(glob.glob("./log/*.checkpoint.json.gz"), key=os.path.getmtime, reverse=True)
+            if not checkpoints:
+                st.caption("log文件夹中还没有检查点，游戏的每个环节开始前都会自动保存")
+            else:
+                checkpoint_path = st.selectbox("检查点", checkpoints, format_func=os.path.basename, key="resume_checkpoint",
+                                               help="检查点中不保存api_key，会使用“模型管理”中同名模型的配置")
+                if st.button("▶️ 从检查点继续", use_container_width=True):
+                    try:
+                        game = Game.from_checkpoint(
+                            checkpoint_path,
+                            apis={m["name"]: m for m in st.session_state.models},
+                            webui_mode=True,
+                            checkpoint=Checkpoint(checkpoint_path)
+                        )
+                    except Exception as e:
+                        st.error(f"恢复失败: {str(e)}")
+                    else:
+                        st.session_state.game = game
+                        st.session_state.game_handle = registry.watch(game)
+                        # 回到中断时所在的页面
+                        st.session_state.current_page = 'manual_game' if game.ui_mode == "manual" else 'auto_game'
+                        st.session_state.initialized = True
+                        st.rerun()
+
+
     st.title("⚙️ 游戏配置 - 分步设置")
 
     # 步骤导航
@@ -481,6 +515,14 @@ def config_page():
                     break
 
             game_mode = st.selectbox("选择游戏模式", ["全自动模式", "人工模式（你是上帝❗）"], key="webui_mode",index = 1 if has_custom_role else 0)
+            incremental_context = st.checkbox("增量上下文", key="incremental_context", help="每轮只向模型追加新出现的信息，历史消息保持不变，可以命中服务端的前缀缓存，节省token")
+            wolf_cols = st.columns(2)
+            with wolf_cols[0]:
+                concurrent_werewolves = st.checkbox("狼人同时发言", key="concurrent_werewolves", help="每一轮所有狼人基于同一份聊天记录同时发言，夜晚耗时只与轮数有关")
+            with wolf_cols[1]:
+                werewolf_rounds = st.number_input("狼人每晚讨论轮数（最后一轮为投票）", min_value=1, max_value=5, value=2, step=1, key="werewolf_rounds")
+            sealed_votes = st.checkbox("密封投票", key="sealed_votes", help="白天投票时所有玩家同时投票，投票结果统一揭晓，避免发言顺序带来的影响")
+            trace = st.checkbox("记录时间线", key="trace", help="游戏结束时在log文件夹中写入.trace.json，可以用 https://ui.perfetto.dev 查看各阶段和每次请求的耗时")
 
             if has_custom_role and game_mode != "人工模式（你是上帝❗）":
                 validation_errors.append("存在自定义角色时只能选择人工模式")
@@ -519,11 +561,20 @@ def config_page():
                         apis_path=config["apis"],
                         instructions_path=config["instructions"],
                         webui_mode=True,
-                        from_dict=True
+                        from_dict=True,
+                        incremental_context=incremental_context,
+                        concurrent_werewolves=concurrent_werewolves,
+                        werewolf_rounds=werewolf_rounds,
+                        sealed_votes=sealed_votes,
+                        tracer=Tracer() if trace else None,
+                        checkpoint=Checkpoint(),
+                        ui_mode="auto" if game_mode == "全自动模式" else "manual"
                     )
 
                     # 保存游戏状态
                     st.session_state.game = game
+                    # 展示期间registry不会释放这局游戏
+                    st.session_state.game_handle = registry.watch(game)
                     st.session_state.current_page = 'auto_game' if game_mode == "全自动模式" else 'manual_game'
                     st.session_state.initialized = True
                     st.rerun()
@@ -542,24 +593,15 @@ def format_log_message(context, game):
     )
     
     # 处理思考过程折叠
-    content = context.content
-    if '<think>' in content and '</think>' in content:
-        import re
-        content = re.sub(
-            r'<think>\s*\n(.*?)\n</think>',  # 匹配思考内容
-            r'<details style="margin-top: 5px;"><summary>🤔 思考结束（点击展开）</summary><div style="padding: 8px; background: rgba(0,0,0,0.05);">\1</div></details>',
-            content,
-            flags=re.DOTALL
-        )
-    elif '<think>' in content:
-        import re
-        content = re.sub(
-            r'(<think>[\s\S]*)',  # 匹配思考内容
-            r'<details style="margin-top: 5px;"><summary>🚧🤔 思考中（点击展开）...</summary><div style="padding: 8px; background: rgba(0,0,0,0.05);">\1</div></details>',
-            content,
-            flags=re.DOTALL
-        )
-    content = content.replace('\n', '<br>')  # 处理普通换行
+    content = context.content.replace('\n', '<br>')  # 处理普通换行
+    reasoning = context.reasoning
+    if reasoning:
+        if context.is_streaming and not content:
+            summary = "🚧🤔 思考中（点击展开）..."
+        else:
+            summary = "🤔 思考结束（点击展开）"
+        reasoning = reasoning.replace('\n', '<br>')
+        content = f'<details style="margin-top: 5px;"><summary>{summary}</summary><div style="padding: 8px; background: rgba(0,0,0,0.05);">{reasoning}</div></details>' + content
 
     return f"""<div style='
     padding: 10px;
@@ -575,6 +617,24 @@ def format_log_message(context, game):
 </div>"""
 
 
+def finish_game(game):
+    """游戏结束时宣布胜方并交给registry，每个会话只做一次
+
+    streamlit每次刷新都会重新执行整个页面，结束分支会被反复执行，
+    之后的刷新直接返回记下的胜方，不会重复写入“游戏结束”的信息
+
+    Args:
+        game: 游戏对象
+
+    Returns:
+        str: 胜方
+    """
+    if st.session_state.get("finished_game") != game.id:
+        st.session_state.winner = game.get_winner()
+        registry.finish(game)
+        st.session_state.finished_game = game.id
+    return st.session_state.winner
+
 # 新增函数：执行游戏阶段并处理狼人自爆
 def auto_game_phase(game, phase_name):
     """执行游戏的一个阶段，并处理可能的狼人自爆
@@ -597,11 +657,9 @@ def auto_game_phase(game, phase_name):
         werewolf_exploded = game.public_discussion()
         return werewolf_exploded  # 如果有狼人自爆，返回True
     elif phase_name == "投票出局":
-        # 检查是否有狼人自爆
-        result = game.vote()
-        if result is None:  # 有狼人自爆
+        # 检查是否有狼人自爆，平票时无人出局
+        if game.vote_out() is None:  # 有狼人自爆
             return True
-        game.out([find_max_key(result)])
     return False  # 默认返回False表示正常完成阶段
 
 def auto_game_page():
@@ -629,12 +687,21 @@ def auto_game_page():
                             time.sleep(1)
                             st.session_state.phase_thread = None
 
-            # 重置游戏状态
+            # 重置游戏状态，释放游戏占用的资源
+            if st.session_state.game:
+                registry.close(st.session_state.game)
             st.session_state.current_page = 'config'
             st.session_state.game = None
+            st.session_state.game_handle = None
             st.session_state.initialized = False
             st.rerun()
 
+        # 同一进程中的所有游戏共用各服务商的限流器，配置了rpm或tpm时显示排队情况
+        for base_url, stats in limiter_stats().items():
+            if stats["rpm"] or stats["tpm"]:
+                st.caption(f"⏳ {base_url}：排队{stats['queued']}个请求（{stats['games_waiting']}局游戏），"
+                           f"平均等待{stats['wait_avg']:.1f}秒，最长{stats['wait_max']:.1f}秒")
+
     if st.session_state.game and st.session_state.initialized:
         game = st.session_state.game
 
@@ -654,6 +721,10 @@ def auto_game_page():
             log_container = st.empty()
 
             def update_logs():
+                with game.span("update_logs",track="界面"):
+                    render_logs()
+
+            def render_logs():
                 current_logs = Context.get_chat_log(game, stages.index(display_stage)) if Context.get_chat_log(game, stages.index(display_stage)) else []
                 formatted_logs = "".join([str(format_log_message(c, game)) for c in current_logs])
 
@@ -682,7 +753,7 @@ def auto_game_page():
 
             if game.game_over():
                 st.balloons()
-                game.get_winner()
+                finish_game(game)
                 st.success("游戏结束！")
                 update_logs()
                 st.stop()
@@ -727,20 +798,21 @@ def auto_game_page():
                                     progress_event.set()
                                     return
 
-                                if not game.game_over() and not progress_event.is_set():game.day_night_change()
+                                # 从检查点恢复的游戏从中断的环节继续，已经开始的昼夜交替不再重复
+                                resume = game.resume_phase
+                                game.resume_phase = None
+                                if resume in (None, "day_night_change") and not game.game_over() and not progress_event.is_set():game.day_night_change()
                                 days, phase = game.get_game_stage()
 
                                 if not phase:
                                     # 每个操作前检查状态
                                     # game对象会自动生成killing toninght列表，在昼夜更替的时候踢出玩家
-                                    if not game.game_over() and not progress_event.is_set(): game.werewolf_killing()
-                                    if not game.game_over() and not progress_event.is_set(): game.seer_seeing()
-                                    if not game.game_over() and not progress_event.is_set(): game.witch_operation()
+                                    # 狼人杀人和预言家查验同时进行，女巫在狼人之后行动
+                                    if not game.game_over() and not progress_event.is_set(): game.resume_night(resume)
                                 else:
-                                    if not game.game_over() and not progress_event.is_set(): game.public_discussion()
+                                    if resume != "vote" and not game.game_over() and not progress_event.is_set(): game.public_discussion()
                                     if not game.game_over() and not progress_event.is_set():
-                                        result = game.vote()
-                                        game.out([find_max_key(result)])
+                                        game.vote_out()
 
 
                             except Exception as e:
@@ -754,7 +826,7 @@ def auto_game_page():
                             st.session_state.phase_thread.start()
             if game.game_over():
                 st.balloons()
-                game.get_winner()
+                finish_game(game)
                 st.success("游戏结束！")
                 update_logs()
                 st.stop()
@@ -778,7 +850,7 @@ def auto_game_page():
 
         if game.game_over():
             st.balloons()
-            game.get_winner()
+            finish_game(game)
             st.success("游戏结束！")
             update_logs()
             st.stop()
@@ -800,6 +872,9 @@ def manual_game_page():
 
     st.title("🎭 狼人杀！")
     game = st.session_state.game
+    if game is not None and game.resume_phase:
+        st.info(f"已从检查点恢复，中断在“{game.resume_phase}”环节之前，请从这个环节继续操作")
+        game.resume_phase = None
 
     # 侧边栏显示控制按钮
     with st.sidebar:
@@ -816,8 +891,11 @@ def manual_game_page():
                             time.sleep(1)
                             st.session_state.msg_thread = None
 
+            if st.session_state.game:
+                registry.close(st.session_state.game)
             st.session_state.current_page = 'config'
             st.session_state.game = None
+            st.session_state.game_handle = None
             st.session_state.initialized = False
             st.rerun()
 
@@ -933,7 +1011,10 @@ def manual_game_page():
             log_container = st.empty()
 
             def update_logs():
-        
+                with game.span("update_logs",track="界面"):
+                    render_logs()
+
+            def render_logs():
                 current_logs = Context.get_chat_log(game, stages.index(display_stage)) if Context.get_chat_log(game, stages.index(display_stage)) else []
                 formatted_logs = "".join([str(format_log_message(c, game)) for c in current_logs])
 
@@ -985,7 +1066,7 @@ def manual_game_page():
         # 游戏结束处理
         if game.game_over():
             st.balloons()
-            winner = game.get_winner()
+            winner = finish_game(game)
             st.success(f"游戏结束！胜利方：{winner}")
             st.stop()
     else: